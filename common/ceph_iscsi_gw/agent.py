@@ -0,0 +1,486 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+import traceback
+
+from logging.handlers import RotatingFileHandler
+
+try:
+    import SocketServer as socketserver
+except ImportError:
+    import socketserver
+
+SOCKET_PATH = '/var/run/ceph_iscsi_gw/agent.sock'
+LOG_FILE = '/var/log/igw-agent.log'
+
+# seconds between rereads of the config object, in case a notify from a committer is missed
+POLL_INTERVAL = 5
+
+# a request that takes longer than this is assumed to have failed (reconcile may need to
+# wait for other gateways, so it is given longer)
+REQUEST_TIMEOUT = 60
+RECONCILE_TIMEOUT = 600
+
+
+class AgentUnavailable(Exception):
+    pass
+
+
+class AgentClient(object):
+    """
+    Client side of the agent protocol - each request is a single line of JSON, answered
+    by a single line of JSON
+    """
+
+    def __init__(self, socket_path=SOCKET_PATH):
+        self.socket_path = socket_path
+
+    def available(self):
+        """
+        Check whether an agent is listening
+        :return: Boolean
+        """
+
+        try:
+            self.request('ping')
+        except AgentUnavailable:
+            return False
+        return True
+
+    def request(self, action, timeout=REQUEST_TIMEOUT, **args):
+        """
+        Send a request to the agent
+        :param action: name of the action (str)
+        :param timeout: seconds to wait for the response
+        :param args: arguments for the action
+        :return: response data
+        """
+
+        if not os.path.exists(self.socket_path):
+            raise AgentUnavailable("agent socket {} not found".format(self.socket_path))
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(self.socket_path)
+            # the protocol is utf-8 text, sent as bytes (python 3 sockets don't take str)
+            sock.sendall((json.dumps({"action": action, "args": args}) + '\n').encode('utf-8'))
+            response = sock.makefile('rb').readline().decode('utf-8')
+        except socket.error as err:
+            raise AgentUnavailable("agent request '{}' failed - {}".format(action, err))
+        finally:
+            sock.close()
+
+        if not response:
+            raise AgentUnavailable("agent closed the connection during '{}'".format(action))
+
+        reply = json.loads(response)
+        if reply['rc'] != 0:
+            raise RuntimeError(reply['error'])
+
+        return reply['data']
+
+
+def find_agent(pool, cfg_name, socket_path=SOCKET_PATH):
+    """
+    Look for a running agent serving a given config object - an agent serves a single
+    gateway group, so an agent for another group is ignored
+    :param pool: pool holding the config object
+    :param cfg_name: config object name
+    :param socket_path: agent socket
+    :return: AgentClient, or None if no suitable agent is running
+    """
+
+    client = AgentClient(socket_path)
+    try:
+        agent_info = client.request('ping')
+    except (AgentUnavailable, RuntimeError):
+        return None
+
+    if agent_info['pool'] != pool or agent_info['config_name'] != cfg_name:
+        return None
+
+    return client
+
+
+class AgentRequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+
+        agent = self.server.agent
+        try:
+            request = json.loads(line.decode('utf-8'))
+            data = agent.dispatch(request['action'], request.get('args', {}))
+            reply = {"rc": 0, "data": data, "error": ''}
+        except Exception as err:
+            agent.logger.error("(AgentRequestHandler.handle) request failed - {}".format(traceback.format_exc()))
+            reply = {"rc": 1, "data": None, "error": str(err)}
+
+        self.wfile.write((json.dumps(reply) + '\n').encode('utf-8'))
+
+
+class AgentServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class GatewayAgent(object):
+    """
+    Long lived process holding a connected rados session, the current config (kept fresh
+    through a watch on the config object) and an indexed snapshot of LIO, serving requests
+    from the igw modules over a local unix socket
+    """
+
+    def __init__(self, logger, socket_path=SOCKET_PATH, pool='rbd', cfg_name='gateway.conf'):
+
+        # imported here, so the thin client side of this module stays cheap to import
+        from ceph_iscsi_gw.common import Config
+
+        self.logger = logger
+        self.this_host = socket.gethostname().split('.')[0]
+        self.socket_path = socket_path
+        self.config = Config(logger, cfg_name=cfg_name, pool=pool, use_agent=False)
+        if self.config.error:
+            raise RuntimeError(self.config.error_msg)
+
+        # serialises use of the shared Config object (commits, locks and refreshes)
+        self.mutex = threading.RLock()
+
+        # the config lock is taken on behalf of a client (identified by the holder token it
+        # sends), so another client's lock or commit waits until that client releases it
+        self.lock_holder = None
+        self.lock_released = threading.Condition(self.mutex)
+        self.lock_time_limit = Config.lock_time_limit
+        self.lio = None
+        self.lio_iqn = None
+        self.lio_marker = ''
+        self.watch = None
+        self.watch_ioctx = None
+        self.running = False
+
+        # set by the watch callback - the refresh itself is left to the poll thread, since
+        # the callback must not wait for the mutex (a commit by this agent holds it while
+        # notifying the watchers)
+        self.refresh_needed = threading.Event()
+
+    def dispatch(self, action, args):
+        handler = getattr(self, 'do_{}'.format(action), None)
+        if handler is None:
+            raise ValueError("unknown agent action '{}'".format(action))
+        return handler(**args)
+
+    def do_ping(self):
+        return {"pid": os.getpid(),
+                "pool": self.config.pool,
+                "config_name": self.config.config_name,
+                "epoch": self.config.config.get('epoch')}
+
+    def do_get_config(self):
+        with self.mutex:
+            return self.config.config
+
+    def do_heartbeats(self):
+        return self.config.heartbeats()
+
+    def do_lock(self, holder):
+        """
+        Take the config lock for a client
+        :param holder: the client's holder token
+        """
+
+        with self.mutex:
+            try:
+                if self._wait_for_lock(holder) and self.lock_holder != holder:
+                    self.config.lock()
+                    if self.config.config_locked:
+                        self.lock_holder = holder
+                return self._status(holder)
+            finally:
+                self.config.error = False
+                self.config.error_msg = ''
+
+    def do_unlock(self, holder):
+        """
+        Release the config lock held by a client - a client that doesn't hold it is left as is
+        :param holder: the client's holder token
+        """
+
+        with self.mutex:
+            try:
+                if self.lock_holder == holder:
+                    self.config.unlock()
+                    self._lock_released()
+                return self._status(holder)
+            finally:
+                self.config.error = False
+                self.config.error_msg = ''
+
+    def do_commit(self, txns, reset=False, holder=None):
+        """
+        Apply a list of transactions (from a module's Config object) to the config object
+        :param txns: list of transaction dicts
+        :param reset: Boolean - reset the config epoch
+        :param holder: the client's holder token - a client holding the config lock has it
+                       released by the commit, otherwise the lock is taken for the commit
+        """
+
+        with self.mutex:
+            try:
+                if not self._wait_for_lock(holder):
+                    return self._status(holder)
+
+                self._refresh_config()
+                for txn in txns:
+                    if txn['action'] == 'delete':
+                        # already gone from the current config, nothing to do
+                        if txn['item_name'] in self.config.config.get(txn['type'], {}):
+                            self.config.del_item(txn['type'], txn['item_name'])
+                    else:
+                        self.config.update_item(txn['type'], txn['item_name'], txn['item_content'])
+
+                if self.config.changed:
+                    self.config.reset = reset
+                    self.config.commit('retain')
+                elif self.config.config_locked:
+                    # nothing to write, but the caller expects the commit to release its lock
+                    self.config.unlock()
+
+                status = self._status(holder)
+            except Exception:
+                # never leave the lock held for a client that has been told the commit failed
+                if self.config.config_locked:
+                    self.config.unlock()
+                raise
+            finally:
+                self._lock_released()
+                # the Config object is shared by every request, so a commit that fails (or
+                # raises) must not leave its transactions or errors to the next one
+                del self.config.txn_list[:]
+                self.config.changed = False
+                self.config.reset = False
+                self.config.error = False
+                self.config.error_msg = ''
+
+            self._refresh_config()
+            return status
+
+    def do_lio(self):
+        """
+        Summary of the LIO snapshot - storage objects, tpg luns and client lun maps
+        """
+
+        with self.mutex:
+            lio = self._lio_snapshot()
+            return {"storage_objects": sorted(lio.storage_objects.keys()),
+                    "tpg_luns": sorted(lio.tpg_luns.keys()),
+                    "clients": dict((iqn, sorted(lio.mapped_luns[iqn].keys())) for iqn in lio.mapped_luns)}
+
+    def do_reconcile(self, gateway_iqn, rbd_devices, client_connections, mode='plan', this_host=None):
+        """
+        Plan (or apply) the gateway configuration using the agent's session and snapshots
+        """
+
+        from ceph_iscsi_gw.reconcile import Reconciler
+
+        with self.mutex:
+            # an apply commits through the shared Config object, so it mustn't use (and
+            # release) a lock held for another client
+            if not self._wait_for_lock(None):
+                error_msg, self.config.error, self.config.error_msg = self.config.error_msg, False, ''
+                return {"error": error_msg, "plan": [], "changes": 0, "timings": {}}
+
+            self._refresh_config()
+            reconciler = Reconciler(self.logger, self.config, gateway_iqn, rbd_devices,
+                                    client_connections, this_host or self.this_host,
+                                    lio=self._lio_snapshot(gateway_iqn))
+            plan = reconciler.build_plan()
+            if not reconciler.error and mode == 'apply':
+                reconciler.apply()
+                # LIO has changed, so rebuild the snapshot on the next request
+                self.lio = None
+            self._lock_released()
+
+            self.config.error = False
+            self.config.error_msg = ''
+
+            return {"error": reconciler.error_msg if reconciler.error else '',
+                    "plan": [step.as_dict() for step in plan],
+                    "changes": reconciler.changes,
+                    "timings": reconciler.timings}
+
+    def _wait_for_lock(self, holder):
+        """
+        Wait (releasing the mutex meanwhile) until the config lock isn't held for another
+        client. Must be called with the mutex held
+        :param holder: the client's holder token
+        :return: Boolean - False if the wait timed out (the error attributes are set)
+        """
+
+        deadline = time.time() + self.lock_time_limit
+        while self.lock_holder not in [None, holder]:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                self.config.error = True
+                self.config.error_msg = ("Timed out ({}) waiting for excl lock on {} object, held for another "
+                                         "client".format(self.lock_time_limit, self.config.config_name))
+                self.logger.error("(GatewayAgent._wait_for_lock) {}".format(self.config.error_msg))
+                return False
+            self.lock_released.wait(remaining)
+
+        return True
+
+    def _lock_released(self):
+        """
+        Wake the clients waiting for the config lock, once it has been released
+        """
+
+        if not self.config.config_locked:
+            self.lock_holder = None
+            self.lock_released.notify_all()
+
+    def _status(self, holder):
+        return {"error": self.config.error,
+                "error_msg": self.config.error_msg,
+                "config_locked": self.config.config_locked and self.lock_holder == holder,
+                "epoch": self.config.config.get('epoch')}
+
+    def _lio_snapshot(self, iqn=None):
+        """
+        Return the LIO snapshot, rebuilding it only if the LIO generation marker has changed
+        :param iqn: gateway iqn the snapshot should describe (None for the first iscsi target)
+        """
+
+        from ceph_iscsi_gw.fingerprint import lio_generation
+        from ceph_iscsi_gw.lio import LIOSnapshot
+
+        marker = lio_generation()
+        if self.lio is None or marker != self.lio_marker or iqn != self.lio_iqn:
+            self.logger.debug("(GatewayAgent._lio_snapshot) rebuilding the LIO snapshot")
+            self.lio = LIOSnapshot(iqn)
+            self.lio_iqn = iqn
+            self.lio_marker = marker
+        return self.lio
+
+    def _refresh_config(self):
+        with self.mutex:
+            cfg = self.config.get_config()
+            if cfg:
+                self.config.config = cfg
+
+    def _notified(self, *args):
+        self.logger.debug("(GatewayAgent._notified) config object change notification received")
+        self.refresh_needed.set()
+
+    def _poll(self):
+        """
+        Refresh the config when the watch reports a change, and as a safety net for the
+        watch, every POLL_INTERVAL. The object's mtime can't stand in for a reread - it only
+        has a resolution of a second, so a commit in the same second as the last read would
+        be missed for good
+        """
+
+        while self.running:
+            self.refresh_needed.clear()
+            try:
+                self._refresh_config()
+            except Exception as err:
+                self.logger.warning("(GatewayAgent._poll) unable to refresh the config - {}".format(err))
+            self.refresh_needed.wait(POLL_INTERVAL)
+
+    def _heartbeat(self):
+        """
+        Publish this gateway's heartbeat, so the other gateways know it's alive
+        """
+
+        from ceph_iscsi_gw import heartbeat
+
+        ioctx = self.config.ceph.cluster.open_ioctx(self.config.pool)
+        while self.running:
+            try:
+                heartbeat.publish(ioctx, self.this_host, self.config.config_name)
+            except Exception as err:
+                self.logger.warning("(GatewayAgent._heartbeat) unable to publish the heartbeat - {}".format(err))
+            time.sleep(heartbeat.HEARTBEAT_INTERVAL)
+        ioctx.close()
+
+    def serve(self):
+
+        self.running = True
+
+        # watch the config object, so commits from other gateways are seen immediately
+        self.watch_ioctx = self.config.ceph.cluster.open_ioctx(self.config.pool)
+        if hasattr(self.watch_ioctx, 'watch'):
+            self.watch = self.watch_ioctx.watch(self.config.config_name, self._notified)
+        else:
+            self.logger.info("(GatewayAgent.serve) rados watch unavailable - polling the config object")
+
+        for task in [self._poll, self._heartbeat]:
+            thread = threading.Thread(target=task)
+            thread.daemon = True
+            thread.start()
+
+        socket_dir = os.path.dirname(self.socket_path)
+        if not os.path.isdir(socket_dir):
+            os.makedirs(socket_dir)
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+        old_umask = os.umask(0o077)         # root only
+        server = AgentServer(self.socket_path, AgentRequestHandler)
+        os.umask(old_umask)
+        server.agent = self
+
+        self.logger.info("(GatewayAgent.serve) listening on {}".format(self.socket_path))
+        try:
+            server.serve_forever()
+        finally:
+            self.running = False
+            server.server_close()
+            os.remove(self.socket_path)
+            if self.watch:
+                self.watch.close()
+            self.watch_ioctx.close()
+            self.config.ceph.shutdown()
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="ceph iSCSI gateway agent")
+    parser.add_argument('--pool', default='rbd', help="pool holding the gateway group's config object")
+    parser.add_argument('--config-name', default='gateway.conf', help="config object name")
+    parser.add_argument('--socket', default=SOCKET_PATH, help="unix socket to listen on")
+    args = parser.parse_args()
+
+    logger = logging.getLogger('igw-agent')
+    logger.setLevel(logging.DEBUG)
+    handler = RotatingFileHandler(LOG_FILE,
+                                  maxBytes=5242880,
+                                  backupCount=7)
+    log_fmt = logging.Formatter('%(asctime)s %(name)s %(levelname)-8s : %(message)s')
+    handler.setFormatter(log_fmt)
+    logger.addHandler(handler)
+
+    try:
+        agent = GatewayAgent(logger, socket_path=args.socket, pool=args.pool, cfg_name=args.config_name)
+    except RuntimeError as err:
+        logger.critical("(main) unable to start the agent - {}".format(err))
+        sys.exit(1)
+
+    try:
+        agent.serve()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+
+    main()
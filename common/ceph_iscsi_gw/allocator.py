@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+# LIO accepts mapped LUN ids in the range 0..65535
+MAX_LUN_IDS = 65536
+
+WORD_BITS = 64
+WORD_FULL = (1 << WORD_BITS) - 1
+
+
+class LunIdAllocator(object):
+    """
+    Bitmap allocator for LUN ids. The bitmap is held as a list of 64bit words, together
+    with a pointer to the first word that has a free id, so allocating the lowest free
+    id and releasing an id are both constant time operations (amortised)
+    """
+
+    def __init__(self, in_use=None, max_ids=MAX_LUN_IDS):
+        """
+        Instantiate the allocator
+        :param in_use: iterable of LUN ids that are already allocated
+        :param max_ids: size of the LUN id range (ids run from 0 to max_ids - 1)
+        :return: allocator object
+        """
+
+        self.max_ids = max_ids
+        self.words = [0] * ((max_ids + WORD_BITS - 1) // WORD_BITS)
+        self.first_free = 0             # index of the lowest word that may have a free id
+        self.count = 0
+
+        for lun_id in (in_use or []):
+            self.reserve(lun_id)
+
+    def _check(self, lun_id):
+        if not 0 <= lun_id < self.max_ids:
+            raise ValueError("LUN id {} is outside the range 0..{}".format(lun_id, self.max_ids - 1))
+
+    def in_use(self, lun_id):
+        """
+        Check whether a LUN id is allocated
+        :param lun_id: LUN id (int)
+        :return: Boolean
+        """
+
+        self._check(lun_id)
+        return bool(self.words[lun_id // WORD_BITS] & (1 << (lun_id % WORD_BITS)))
+
+    def reserve(self, lun_id):
+        """
+        Mark a specific LUN id as allocated (e.g. an id already mapped in LIO)
+        :param lun_id: LUN id (int)
+        """
+
+        if not self.in_use(lun_id):
+            self.words[lun_id // WORD_BITS] |= 1 << (lun_id % WORD_BITS)
+            self.count += 1
+
+    def release(self, lun_id):
+        """
+        Return a LUN id to the free pool
+        :param lun_id: LUN id (int)
+        """
+
+        if self.in_use(lun_id):
+            ptr = lun_id // WORD_BITS
+            self.words[ptr] &= ~(1 << (lun_id % WORD_BITS))
+            self.count -= 1
+            if ptr < self.first_free:
+                self.first_free = ptr
+
+    def allocate(self):
+        """
+        Allocate the lowest free LUN id
+        :return: LUN id (int), or None if every id in the range is in use
+        """
+
+        num_words = len(self.words)
+        while self.first_free < num_words and self.words[self.first_free] == WORD_FULL:
+            self.first_free += 1
+
+        if self.first_free == num_words:
+            return None
+
+        word = self.words[self.first_free]
+        free_bit = ~word & (word + 1)           # lowest clear bit in the word
+        lun_id = self.first_free * WORD_BITS + free_bit.bit_length() - 1
+        if lun_id >= self.max_ids:
+            return None
+
+        self.words[self.first_free] = word | free_bit
+        self.count += 1
+        return lun_id
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+import os
+import time
+
+from ceph_iscsi_gw.utils import LazyModule, run_parallel
+
+rtslib_utils = LazyModule('rtslib_fb.utils')
+
+ALUA_STATES = {"active": '0',
+               "active/unoptimized": '1',
+               "standby": '2'}
+
+ALUA_ACCESS_STATE = 'alua/default_tg_pt_gp/alua_access_state'
+ALUA_ACCESS_TYPE = 'alua/default_tg_pt_gp/alua_access_type'
+
+# alua_access_type is reported by configfs by name, but set by number - 'Implicit' (1) means
+# the active path is set by the gateways
+ALUA_IMPLICIT = 'Implicit'
+ALUA_IMPLICIT_SETTING = '1'
+
+
+def get_alua(storage_object):
+    """
+    Read the ALUA settings of a LUN
+    :param storage_object: LIO storage object
+    :return: (access type (str), state name (str)) - state is '' if the value is not recognised
+    """
+
+    access_type = rtslib_utils.fread(os.path.join(storage_object.path, ALUA_ACCESS_TYPE))
+    access_state = rtslib_utils.fread(os.path.join(storage_object.path, ALUA_ACCESS_STATE))
+
+    state_name = ''
+    for name in ALUA_STATES:
+        if ALUA_STATES[name] == access_state:
+            state_name = name
+            break
+
+    return access_type, state_name
+
+
+def alua_differs(current, desired_state):
+    """
+    :param current: (access type, state name) tuple from get_alua
+    :param desired_state: active, active/unoptimized or standby
+    :return: Boolean - True if set_alua would change the LUN
+    """
+
+    access_type, state_name = current
+    return access_type != ALUA_IMPLICIT or state_name != desired_state
+
+
+def set_alua(storage_object, desired_state='standby', current=None):
+    """
+    Set the ALUA state of a LUN (active/standby), switching the access type to implicit
+    if necessary. Only the configfs files that need changing are written
+    :param storage_object: LIO storage object
+    :param desired_state: active, active/unoptimized or standby
+    :param current: (access type, state name) tuple already read from the LUN - avoids
+                    reading the settings again when a snapshot is available
+    :return: Boolean indicating whether a change was made
+    """
+
+    access_type, state_name = current if current else get_alua(storage_object)
+    changed = False
+
+    if access_type != ALUA_IMPLICIT:
+        rtslib_utils.fwrite(os.path.join(storage_object.path, ALUA_ACCESS_TYPE), ALUA_IMPLICIT_SETTING)
+        changed = True
+
+    if state_name != desired_state:
+        rtslib_utils.fwrite(os.path.join(storage_object.path, ALUA_ACCESS_STATE), ALUA_STATES[desired_state])
+        changed = True
+
+    return changed
+
+
+def snapshot_alua(storage_objects):
+    """
+    Read the current ALUA settings of a set of LUNs
+    :param storage_objects: dict of name -> LIO storage object (e.g. LIOSnapshot.storage_objects)
+    :return: dict of name -> (access type, state name)
+    """
+
+    return dict((name, get_alua(storage_objects[name])) for name in storage_objects)
+
+
+def plan_alua(current, desired):
+    """
+    Work out the ALUA transitions needed to reach the desired states. LUNs becoming active
+    come first, so a LUN moving between gateways gains its new active path before the old
+    one is switched to standby
+    :param current: dict of name -> (access type, state name) from snapshot_alua
+    :param desired: dict of name -> desired state name
+    :return: list of (name, desired state) tuples
+    """
+
+    transitions = [(name, desired[name]) for name in sorted(desired)
+                   if name in current and alua_differs(current[name], desired[name])]
+
+    return sorted(transitions, key=lambda transition: transition[1] != 'active')
+
+
+def apply_alua(storage_objects, transitions, current, batch_size=32):
+    """
+    Apply ALUA transitions in batches - the LUNs in a batch are switched concurrently, and
+    each batch completes before the next one starts. Activations and standby transitions are
+    never mixed in a batch, and all the activations are done first
+    :param storage_objects: dict of name -> LIO storage object
+    :param transitions: list of (name, desired state) tuples from plan_alua
+    :param current: dict of name -> (access type, state name) from snapshot_alua
+    :param batch_size: number of LUNs switched at a time
+    :return: (list of batch timings in seconds, dict of failures {name: error})
+    """
+
+    def _switch(transition):
+        name, state = transition
+        return set_alua(storage_objects[name], state, current=current[name])
+
+    batches = []
+    for group in [[t for t in transitions if t[1] == 'active'],
+                  [t for t in transitions if t[1] != 'active']]:
+        batches.extend(group[ptr:ptr + batch_size] for ptr in range(0, len(group), batch_size))
+
+    timings = []
+    failed = {}
+    for batch in batches:
+        start = time.time()
+        for transition, _, err in run_parallel(_switch, batch, workers=batch_size):
+            if err:
+                failed[transition[0]] = err.strip().splitlines()[-1]
+        timings.append(time.time() - start)
+
+    return timings, failed
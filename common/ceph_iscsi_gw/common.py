@@ -1,11 +1,93 @@
 #!/usr/bin/env python
 
-import rados
 import time
 import json
 import os
+import threading
 import traceback
 
+from ceph_iscsi_gw import heartbeat
+from ceph_iscsi_gw.agent import AgentUnavailable, find_agent
+from ceph_iscsi_gw.utils import AsyncCall, LazyModule
+
+rados = LazyModule('rados')
+
+# watchers (e.g. the gateway agent) are told about commits, but a commit should never wait
+# long for a slow watcher
+NOTIFY_TIMEOUT_MS = 1000
+
+# each gateway group has its own config object - the defaults describe a single group
+# using rbd/gateway.conf
+CONFIG_POOL = 'rbd'
+CONFIG_NAME = 'gateway.conf'
+
+# module arguments selecting the gateway group's config object, shared by the igw modules
+CONFIG_ARGS = {
+    "config_pool": {"required": False, "type": "str", "default": CONFIG_POOL},
+    "config_name": {"required": False, "type": "str", "default": CONFIG_NAME}
+}
+
+# local copy of the last config read/committed by this host - lets callers check the config
+# epoch (or query the config) without connecting to the cluster
+CACHE_DIR = '/var/lib/ceph_iscsi_gw'
+
+# the config holds the clients' CHAP credentials, so the local copy is only readable by root
+CACHE_MODE = 0o600
+
+# a read without a length only returns the first 8KB of an object, so the config object is
+# read according to its size, in chunks of up to CONFIG_READ_CHUNK bytes
+CONFIG_READ_CHUNK = 4 * 1024 * 1024
+CONFIG_READ_ATTEMPTS = 5
+
+
+def read_object(ioctx, obj_name, chunk_size=None):
+    """
+    Read the whole of an object. The object is stat'd, then read in chunks into a single
+    buffer - asking for a byte more than expected, so an object that has grown since the
+    stat is still read in full. If the object is rewritten between the chunks (its version
+    changes) the read starts again
+    :param ioctx: rados ioctx for the pool holding the object
+    :param obj_name: object name
+    :param chunk_size: largest single read (defaults to CONFIG_READ_CHUNK)
+    :return: object contents (str)
+    """
+
+    chunk_size = chunk_size or CONFIG_READ_CHUNK
+    check_version = hasattr(ioctx, 'get_last_version')
+
+    for _ in range(CONFIG_READ_ATTEMPTS):
+        size, _ = ioctx.stat(obj_name)
+        chunks = []
+        offset = 0
+        version = None
+        consistent = True
+
+        while True:
+            if offset >= size:
+                # the object is bigger than the stat said - keep going until a short read
+                size = offset + chunk_size
+            length = min(chunk_size, size - offset + 1)
+            chunk = ioctx.read(obj_name, length, offset)
+
+            if check_version:
+                if version is None:
+                    version = ioctx.get_last_version()
+                elif ioctx.get_last_version() != version:
+                    consistent = False
+                    break
+
+            chunks.append(chunk)
+            offset += len(chunk)
+            if len(chunk) < length:
+                break
+
+        if consistent:
+            return b''.join(chunks)
+
+    raise rados.Error("{} changed during each of {} attempts to read it".format(obj_name,
+                                                                                CONFIG_READ_ATTEMPTS))
+
+
 class ConfigTransaction(object):
 
     def __init__(self, cfg_type, element_name, txn_action='add', initial_value=None):
@@ -27,12 +109,27 @@ class CephCluster(object):
                  conf_file='/etc/ceph/ceph.conf',
                  conf_keyring='/etc/ceph/ceph.client.admin.keyring'):
 
-        self.cluster = rados.Rados(conffile=conf_file,
-                                   conf=dict(keyring=conf_keyring))
-        self.cluster.connect()
+        self.conf_file = conf_file
+        self.conf_keyring = conf_keyring
+        self._cluster = None
+        self._connect_lock = threading.Lock()
+
+    @property
+    def cluster(self):
+        # the connection to the cluster is only made when it's first needed - possibly by
+        # a background config read and the caller at the same time
+        with self._connect_lock:
+            if self._cluster is None:
+                cluster = rados.Rados(conffile=self.conf_file,
+                                      conf=dict(keyring=self.conf_keyring))
+                cluster.connect()
+                self._cluster = cluster
+        return self._cluster
 
     def shutdown(self):
-        self.cluster.shutdown()
+        if self._cluster is not None:
+            self._cluster.shutdown()
+            self._cluster = None
 
 
 class Config(object):
@@ -41,16 +138,37 @@ class Config(object):
                     "disks": {},
                     "gateways": {},
                     "clients": {},
+                    "backstore_profiles": {},
+                    "tpg_profiles": {},
+                    "client_profiles": {},
                     "epoch": 0
                     }
 
     lock_time_limit = 30
 
-    def __init__(self, logger, cfg_name='gateway.conf', pool='rbd'):
+    # seconds between attempts to take the config lock, while another host holds it
+    lock_retry_delay = 1
+
+    _platform = None
+
+    def __init__(self, logger, cfg_name=CONFIG_NAME, pool=CONFIG_POOL, use_agent=True, wait=True):
+        """
+        Instantiate the config, reading the config object
+        :param logger: logger object
+        :param cfg_name: config object name
+        :param pool: pool holding the config object
+        :param use_agent: Boolean - use the local gateway agent when it's running
+        :param wait: Boolean - False starts the read in the background, so the caller can
+                     do other work meanwhile. The read is joined by wait(), or the first use
+                     of the config attribute
+        :return: config object
+        """
+
         self.logger = logger
         self.config_name = cfg_name
         self.pool = pool
         self.ceph = None
+        self.agent = None
         self.platform = Config.get_platform()
         self.error = False
         self.reset = False
@@ -58,9 +176,19 @@ class Config(object):
         self.txn_list = []
         self.config_locked = False
 
+        # identifies this object's config lock to a gateway agent, which serves many clients
+        self.lock_holder = '{}.{}.{}'.format(os.getpid(), id(self), time.time())
+
         # self.txn_ptr = 0
 
-        if self.platform == 'rbd':
+        if use_agent:
+            self.agent = self._find_agent()
+
+        if self.agent:
+            # the local gateway agent holds the rados session and current config for us
+            self.get_config = self._get_agent_config
+            self.commit_config = self._commit_agent
+        elif self.platform == 'rbd':
             self.ceph = CephCluster()
             self.get_config = self._get_rbd_config
             self.commit_config = self._commit_rbd
@@ -68,9 +196,80 @@ class Config(object):
             self.error = True
             self.error_msg = "Unsupported platform - rbd only (for now!)"
 
-        self.config = self.get_config()
+        self._config = {}
+        self._reader = None
+        if self.error:
+            pass
+        elif wait:
+            self._config = self.get_config()
+        else:
+            self._reader = AsyncCall(self.get_config)
         self.changed = False
 
+    @property
+    def config(self):
+        if self._reader is not None:
+            self.wait()
+        return self._config
+
+    @config.setter
+    def config(self, cfg_dict):
+        if self._reader is not None:
+            self.wait()
+        self._config = cfg_dict
+
+    def wait(self):
+        """
+        Wait for a config read started in the background (wait=False) to complete
+        :return: this Config object - so the error attributes can be checked
+        """
+
+        reader, self._reader = self._reader, None
+        if reader is not None:
+            self._config = reader.result()
+        return self
+
+    def _find_agent(self):
+        """
+        Look for a gateway agent serving this config object
+        :return: AgentClient object, or None if no suitable agent is running
+        """
+
+        client = find_agent(self.pool, self.config_name)
+        if client:
+            self.logger.debug("(Config._find_agent) using gateway agent at {}".format(client.socket_path))
+        return client
+
+    def _agent_request(self, action, **args):
+        try:
+            return self.agent.request(action, **args)
+        except (AgentUnavailable, RuntimeError) as err:
+            self.error = True
+            self.error_msg = "gateway agent request '{}' failed - {}".format(action, err)
+            self.logger.error("(Config._agent_request) {}".format(self.error_msg))
+            return None
+
+    def _get_agent_config(self):
+        cfg_dict = self._agent_request('get_config')
+        return cfg_dict if cfg_dict else {}
+
+    def _commit_agent(self, post_action):
+        txns = [{"type": txn.type,
+                 "action": txn.action,
+                 "item_name": txn.item_name,
+                 "item_content": txn.item_content} for txn in self.txn_list]
+
+        status = self._agent_request('commit', txns=txns, reset=self.reset, holder=self.lock_holder)
+        if status is None:
+            return
+
+        if status['error']:
+            self.error = True
+            self.error_msg = status['error_msg']
+        else:
+            del self.txn_list[:]
+        self.config_locked = status['config_locked']
+
     def _get_rbd_config(self):
 
         cfg_dict = {}
@@ -85,7 +284,7 @@ class Config(object):
             return {}
 
         try:
-            cfg_data = ioctx.read(self.config_name)
+            cfg_data = read_object(ioctx, self.config_name)
             ioctx.close()
         except rados.ObjectNotFound:
             # config object is not there, create a seed config
@@ -98,7 +297,7 @@ class Config(object):
                 cfg_data = json.dumps(Config.seed_config)
 
         if cfg_data:
-            self.logger.debug("(_get_rbd_config) config object contains '{}'".format(cfg_data))
+            self.logger.debug("(_get_rbd_config) config object is {} bytes".format(len(cfg_data)))
             cfg_dict = json.loads(cfg_data)
         else:
             self.logger.debug("(_get_rbd_config) config object exists, but is empty '{}'".format(cfg_data))
@@ -109,10 +308,60 @@ class Config(object):
             else:
                 cfg_dict = Config.seed_config
 
+        self._write_cache(cfg_dict)
         return cfg_dict
 
+    def _write_cache(self, cfg_dict):
+        """
+        Keep a local copy of the config, replacing any previous copy atomically. The cache
+        is an optimisation, so failing to write it is not an error
+        """
+
+        cache_file = Config.cache_file(self.pool, self.config_name)
+        try:
+            if not os.path.isdir(CACHE_DIR):
+                os.makedirs(CACHE_DIR, 0o700)
+            tmp_file = '{}.{}'.format(cache_file, os.getpid())
+            # a leftover temp file would keep its mode, so start from a new one
+            if os.path.exists(tmp_file):
+                os.unlink(tmp_file)
+            with os.fdopen(os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, CACHE_MODE), 'w') as cache:
+                json.dump(cfg_dict, cache)
+            os.rename(tmp_file, cache_file)
+        except (IOError, OSError) as err:
+            self.logger.debug("(Config._write_cache) unable to cache the config in {} - {}".format(cache_file,
+                                                                                                 err))
+
+    @classmethod
+    def cache_file(cls, pool=CONFIG_POOL, cfg_name=CONFIG_NAME):
+        return os.path.join(CACHE_DIR, '{}.{}.json'.format(pool, cfg_name))
+
+    @classmethod
+    def get_cached(cls, pool=CONFIG_POOL, cfg_name=CONFIG_NAME):
+        """
+        Return the local copy of the config (as last read or committed by this host)
+        :param pool: pool holding the config object
+        :param cfg_name: config object name
+        :return: config dict, or {} if there is no usable local copy
+        """
+
+        try:
+            with open(Config.cache_file(pool, cfg_name)) as cache:
+                return json.load(cache)
+        except (IOError, OSError, ValueError):
+            return {}
+
     def lock(self):
 
+        if self.agent:
+            status = self._agent_request('lock', holder=self.lock_holder)
+            if status is not None:
+                self.config_locked = status['config_locked']
+                if status['error']:
+                    self.error = True
+                    self.error_msg = status['error_msg']
+            return
+
         ioctx = self.ceph.cluster.open_ioctx(self.pool)
 
         secs = 0
@@ -124,8 +373,8 @@ class Config(object):
                 break
             except rados.ObjectBusy:
                 self.logger.debug("(Config.lock) waiting for excl lock on {} object".format(self.config_name))
-                time.sleep(1)
-                secs += 1
+                time.sleep(Config.lock_retry_delay)
+                secs += Config.lock_retry_delay
 
         if secs >= Config.lock_time_limit:
             self.error = True
@@ -136,6 +385,13 @@ class Config(object):
         ioctx.close()
 
     def unlock(self):
+
+        if self.agent:
+            status = self._agent_request('unlock', holder=self.lock_holder)
+            if status is not None:
+                self.config_locked = status['config_locked']
+            return
+
         ioctx = self.ceph.cluster.open_ioctx(self.pool)
 
         try:
@@ -158,7 +414,7 @@ class Config(object):
             return
 
         # if the config object is empty, seed it - if not just leave as is
-        cfg_data = ioctx.read(self.config_name)
+        cfg_data = read_object(ioctx, self.config_name)
         if not cfg_data:
             self.logger.debug("_seed_rbd_config found empty config object")
             seed = json.dumps(Config.seed_config, sort_keys=True, indent=4, separators=(',', ': '))
@@ -172,14 +428,37 @@ class Config(object):
     def _get_glfs_config(self):
         pass
 
+    def heartbeats(self):
+        """
+        Read the latest heartbeat of each gateway
+        :return: dict of hostname -> timestamp
+        """
+
+        if self.agent:
+            beats = self._agent_request('heartbeats')
+            return beats if beats else {}
+
+        ioctx = self.ceph.cluster.open_ioctx(self.pool)
+        try:
+            return heartbeat.read(ioctx, self.config_name)
+        finally:
+            ioctx.close()
+
+    def live_gateways(self):
+        """
+        :return: set of the gateways in the config that are considered to be alive
+        """
+
+        return heartbeat.live_gateways(self.config.get('gateways', {}), self.heartbeats())
+
     def refresh(self):
-        self.logger.debug("config refresh - current config is {}".format(self.config))
+        self.logger.debug("(Config.refresh) rereading the config (epoch {})".format(self.config.get('epoch')))
         self.config = self.get_config()
 
     def add_item(self, cfg_type, element_name, initial_value=None):
         init_state = {} if initial_value is None else initial_value
-        self.config[cfg_type][element_name] = init_state
-        self.logger.debug("(Config.add_item) config updated to {}".format(self.config))
+        self.config.setdefault(cfg_type, {})[element_name] = init_state
+        self.logger.debug("(Config.add_item) added {} {}".format(cfg_type, element_name))
         self.changed = True
 
         txn = ConfigTransaction(cfg_type, element_name, initial_value=init_state)
@@ -189,15 +468,14 @@ class Config(object):
     def del_item(self, cfg_type, element_name):
         self.changed = True
         del self.config[cfg_type][element_name]
-        self.logger.debug("(Config.del_item) config updated to {}".format(self.config))
+        self.logger.debug("(Config.del_item) deleted {} {}".format(cfg_type, element_name))
 
         txn = ConfigTransaction(cfg_type, element_name, 'delete')
         self.txn_list.append(txn)
         # self.txn_ptr = len(self.txn_list) - 1
 
     def update_item(self, cfg_type, element_name, element_value):
-        self.config[cfg_type][element_name] = element_value
-        self.logger.debug("(Config.update_item) config is {}".format(self.config))
+        self.config.setdefault(cfg_type, {})[element_name] = element_value
         self.changed = True
         self.logger.debug("update_item: type={}, item={}, update={}".format(cfg_type, element_name, element_value))
         # self.logger.debug("update_item point ; txn list length is {}, ptr is set to {}".format(len(self.txn_list),
@@ -220,12 +498,13 @@ class Config(object):
 
         # reread the config to account for updates made by other systems
         # then apply this hosts update(s)
-        current_config = json.loads(ioctx.read(self.config_name))
+        current_config = json.loads(read_object(ioctx, self.config_name))
         for txn in self.txn_list:
 
             self.logger.debug("_commit_rbd transaction shows {}".format(txn))
             if txn.action == 'add':         # add's and updates
-                current_config[txn.type][txn.item_name] = txn.item_content
+                # config objects created by earlier versions may not have every section
+                current_config.setdefault(txn.type, {})[txn.item_name] = txn.item_content
             elif txn.action == 'delete':
                 del current_config[txn.type][txn.item_name]
             else:
@@ -238,13 +517,23 @@ class Config(object):
             else:
                 current_config["epoch"] += 1        # Python will switch from plain to long int automagically
 
-            config_str = json.dumps(current_config)
-            self.logger.debug("_commit_rbd updating config to {}".format(config_str))
             config_str_fmtd = json.dumps(current_config, sort_keys=True, indent=4, separators=(',', ': '))
+            self.logger.debug("_commit_rbd updating config to epoch {} ({} bytes)".format(current_config["epoch"],
+                                                                                          len(config_str_fmtd)))
             ioctx.write_full(self.config_name, config_str_fmtd)
             del self.txn_list[:]                # emtpy the list of transactions
+            self._write_cache(current_config)
 
         self.unlock()
+
+        # watchers are told once the lock is released, so a slow watcher never holds up the
+        # other gateways' commits
+        if not self.error and hasattr(ioctx, 'notify'):
+            try:
+                ioctx.notify(self.config_name, timeout_ms=NOTIFY_TIMEOUT_MS)
+            except Exception as err:
+                self.logger.debug("(Config._commit_rbd) notify of config watchers failed - {}".format(err))
+
         ioctx.close()
 
         if post_action == 'close':
@@ -257,6 +546,17 @@ class Config(object):
 
         self.commit_config(post_action)
 
+    def commit_async(self, post_action='close'):
+        """
+        Start a commit in the background (the lock wait included), so the caller can carry
+        on with work that doesn't touch the config. The caller must join the commit (result())
+        before checking the error attributes, or making further changes
+        :param post_action: close or retain the rados session after the commit
+        :return: AsyncCall object
+        """
+
+        return AsyncCall(self.commit, post_action)
+
 
     @classmethod
     def get_platform(cls):
@@ -264,11 +564,15 @@ class Config(object):
         """
         :return: rbd or gluster
         """
-        if (any(os.access(os.path.join(path, 'rbd'), os.X_OK)
-                for path in os.environ["PATH"].split(os.pathsep))):
-            return 'rbd'
 
-        return ''
+        # the PATH scan is only done once per process
+        if Config._platform is None:
+            Config._platform = ''
+            if (any(os.access(os.path.join(path, 'rbd'), os.X_OK)
+                    for path in os.environ["PATH"].split(os.pathsep))):
+                Config._platform = 'rbd'
+
+        return Config._platform
 
 
 def main():
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+
+import glob
+import hashlib
+import json
+import os
+import time
+
+from ceph_iscsi_gw.agent import AgentClient, AgentUnavailable
+from ceph_iscsi_gw.alua import ALUA_ACCESS_STATE, ALUA_ACCESS_TYPE
+from ceph_iscsi_gw.common import CACHE_DIR, CONFIG_POOL, CONFIG_NAME
+
+FINGERPRINT_DIR = os.path.join(CACHE_DIR, 'fingerprints')
+CONFIGFS_TARGET = '/sys/kernel/config/target'
+BOOT_ID = '/proc/sys/kernel/random/boot_id'
+
+# directories whose listings describe the structure of LIO (backstores, targets, tpg luns,
+# acls, mapped luns and portals) and of the krbd mappings
+GENERATION_DIRS = [CONFIGFS_TARGET + '/core/*',
+                   CONFIGFS_TARGET + '/iscsi',
+                   CONFIGFS_TARGET + '/iscsi/*/tpgt_*/lun',
+                   CONFIGFS_TARGET + '/iscsi/*/tpgt_*/np',
+                   CONFIGFS_TARGET + '/iscsi/*/tpgt_*/acls',
+                   CONFIGFS_TARGET + '/iscsi/*/tpgt_*/acls/*',
+                   '/sys/bus/rbd/devices']
+
+# storage objects - a restart of target.service recreates them (with the same names), and
+# resets their ALUA settings
+STORAGE_OBJECTS = CONFIGFS_TARGET + '/core/*/*'
+
+# set this environment variable to force modules to ignore a matching fingerprint
+VERIFY_ENV = 'IGW_VERIFY'
+
+
+def lio_generation():
+    """
+    Cheap marker for the state of LIO - a digest of the boot id, a handful of configfs
+    directory listings, and the creation time and ALUA settings of each storage object.
+    Objects being added or removed (by any tool), a restart of target.service, an ALUA
+    change or a reboot, change the marker. Other attribute changes made outside of the
+    modules are not detected
+    :return: marker (str)
+    """
+
+    digest = hashlib.sha1()
+    try:
+        with open(BOOT_ID) as boot_id:
+            digest.update(boot_id.read().strip().encode('utf-8'))
+    except IOError:
+        pass
+
+    for pattern in GENERATION_DIRS:
+        for path in sorted(glob.glob(pattern)):
+            try:
+                entries = sorted(os.listdir(path))
+            except OSError:
+                continue
+            digest.update('{}:{}\n'.format(path, ','.join(entries)).encode('utf-8'))
+
+    for path in sorted(glob.glob(STORAGE_OBJECTS)):
+        settings = []
+        for setting in [ALUA_ACCESS_TYPE, ALUA_ACCESS_STATE]:
+            try:
+                with open(os.path.join(path, setting)) as setting_file:
+                    settings.append(setting_file.read().strip())
+            except IOError:
+                break
+        if not settings:
+            # not a storage object (e.g. the hba_info file)
+            continue
+        try:
+            created = os.stat(path).st_ctime
+        except OSError:
+            continue
+        digest.update('{}:{}:{}\n'.format(path, created, ','.join(settings)).encode('utf-8'))
+
+    return digest.hexdigest()
+
+
+def verify_requested(verify=False):
+    """
+    Determine whether a full verification has been requested, either by a module
+    parameter or the IGW_VERIFY environment variable
+    :param verify: value of the module's verify parameter
+    :return: Boolean
+    """
+
+    return verify or os.environ.get(VERIFY_ENV, '').lower() in ['1', 'true', 'yes']
+
+
+class RunFingerprint(object):
+    """
+    Record of the desired state last applied successfully by a module on this host. When the
+    desired input, the config epoch and the LIO generation marker all match the record, the
+    run can finish without touching ceph or configfs. The current epoch comes from the gateway
+    agent, which follows every gateway's commits - without a running agent the epoch can't be
+    known cheaply, so the run is never skipped
+    """
+
+    def __init__(self, module_name, key, params, ignore=('verify',),
+                 pool=CONFIG_POOL, cfg_name=CONFIG_NAME):
+        """
+        Instantiate the fingerprint
+        :param module_name: name of the module (str)
+        :param key: item the module run applies to e.g. the image name (str)
+        :param params: dict of the module's parameters (the desired input)
+        :param ignore: parameter names that don't describe desired state
+        :param pool: pool holding the config object
+        :param cfg_name: config object name
+        :return: fingerprint object
+        """
+
+        self.pool = pool
+        self.cfg_name = cfg_name
+
+        desired = dict((name, params[name]) for name in params if name not in ignore)
+        self.fingerprint = hashlib.sha1(json.dumps(desired, sort_keys=True).encode('utf-8')).hexdigest()
+
+        # gateway groups are independent, so the record is kept per config object
+        record_name = hashlib.sha1('{}:{}:{}/{}'.format(module_name, key, pool,
+                                                         cfg_name).encode('utf-8')).hexdigest()
+        self.record_file = os.path.join(FINGERPRINT_DIR, '{}-{}.json'.format(module_name, record_name))
+
+    def _epoch(self):
+        """
+        :return: the current config epoch, as seen by the gateway agent - None if no agent
+                 is serving the config object. The local config cache isn't used, since it
+                 only changes when this host reads or commits the config
+        """
+
+        try:
+            agent_info = AgentClient().request('ping')
+        except (AgentUnavailable, RuntimeError):
+            return None
+
+        # an agent serving another gateway group knows nothing of this config object
+        if agent_info['pool'] != self.pool or agent_info['config_name'] != self.cfg_name:
+            return None
+
+        return agent_info['epoch']
+
+    def matches(self):
+        """
+        Check the desired state against the record of the last successful run
+        :return: Boolean - True if the run can be skipped
+        """
+
+        try:
+            with open(self.record_file) as record_file:
+                record = json.load(record_file)
+        except (IOError, OSError, ValueError):
+            return False
+
+        return (record.get('fingerprint') == self.fingerprint and
+                record.get('epoch') is not None and
+                record.get('epoch') == self._epoch() and
+                record.get('lio') == lio_generation())
+
+    def save(self):
+        """
+        Record a successful run - called once the desired state has been applied
+        """
+
+        record = {"fingerprint": self.fingerprint,
+                  "epoch": self._epoch(),
+                  "lio": lio_generation(),
+                  "saved": time.time()}
+
+        try:
+            if not os.path.isdir(FINGERPRINT_DIR):
+                os.makedirs(FINGERPRINT_DIR)
+            tmp_file = '{}.{}'.format(self.record_file, os.getpid())
+            with open(tmp_file, 'w') as record_file:
+                json.dump(record, record_file)
+            os.rename(tmp_file, self.record_file)
+        except (IOError, OSError):
+            # the record is an optimisation only - the next run will just verify everything
+            pass
+
+    def clear(self):
+        """
+        Remove the record, so the next run performs a full verification
+        """
+
+        try:
+            os.remove(self.record_file)
+        except OSError:
+            pass
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+import time
+
+from ceph_iscsi_gw.placement import gateway_nodes
+from ceph_iscsi_gw.utils import LazyModule
+
+rados = LazyModule('rados')
+
+# seconds between heartbeats, and the number that can be missed before a gateway is treated
+# as down - so a failed gateway is passed over within HEARTBEAT_INTERVAL * HEARTBEAT_MISSES
+HEARTBEAT_INTERVAL = 5
+HEARTBEAT_MISSES = 2
+
+XATTR_PREFIX = 'heartbeat.'
+
+
+def heartbeat_object(cfg_name='gateway.conf'):
+    """
+    The heartbeats are held as xattrs on a companion of the config object, so a heartbeat
+    doesn't change the config object itself (or wake up its watchers)
+    :param cfg_name: config object name
+    :return: heartbeat object name (str)
+    """
+
+    return '{}.heartbeat'.format(cfg_name)
+
+
+def publish(ioctx, host, cfg_name='gateway.conf', now=None):
+    """
+    Record a heartbeat for a gateway - a single xattr write
+    :param ioctx: rados ioctx for the config pool
+    :param host: gateway hostname
+    :param cfg_name: config object name
+    :param now: timestamp to record (defaults to the current time)
+    """
+
+    stamp = '{:.3f}'.format(now if now is not None else time.time())
+    ioctx.set_xattr(heartbeat_object(cfg_name), XATTR_PREFIX + host, stamp)
+
+
+def read(ioctx, cfg_name='gateway.conf'):
+    """
+    Read the latest heartbeat of every gateway
+    :param ioctx: rados ioctx for the config pool
+    :param cfg_name: config object name
+    :return: dict of hostname -> timestamp (float)
+    """
+
+    beats = {}
+    try:
+        for name, value in ioctx.get_xattrs(heartbeat_object(cfg_name)):
+            if name.startswith(XATTR_PREFIX):
+                try:
+                    beats[name[len(XATTR_PREFIX):]] = float(value)
+                except ValueError:
+                    continue
+    except rados.ObjectNotFound:
+        # no gateway has published a heartbeat yet
+        pass
+
+    return beats
+
+
+def live_gateways(gateways, heartbeats, now=None,
+                  max_age=HEARTBEAT_INTERVAL * HEARTBEAT_MISSES):
+    """
+    Determine which gateways are alive. A gateway that has never published a heartbeat (no
+    agent running) is assumed to be alive, as before heartbeats existed; a gateway whose last
+    heartbeat is older than max_age is not
+    :param gateways: gateway dict from the config object
+    :param heartbeats: dict of hostname -> timestamp (from read)
+    :param now: current time (defaults to time.time())
+    :param max_age: seconds since the last heartbeat before a gateway is considered down
+    :return: set of live gateway hostnames
+    """
+
+    now = now if now is not None else time.time()
+
+    # NB. timestamps come from each gateway's clock, so the gateways need to be time synced
+    return set(name for name in gateway_nodes(gateways)
+               if name not in heartbeats or now - heartbeats[name] <= max_age)
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+import glob
+import os
+import subprocess
+
+from ceph_iscsi_gw.utils import LazyModule
+
+rbd = LazyModule('rbd')
+
+RBD_SYSFS = '/sys/bus/rbd/devices'
+RBDMAP = '/etc/ceph/rbdmap'
+KEYRING = '/etc/ceph/ceph.client.admin.keyring'
+
+
+def mapped_devices():
+    """
+    Return the rbd images mapped through krbd on this host. The information is read
+    from sysfs, avoiding the cost of running 'rbd showmapped'
+    :return: dict of (pool, image) -> device path e.g. ('rbd', 'ansible1') -> '/dev/rbd0'
+    """
+
+    devices = {}
+    for dev_dir in glob.glob(os.path.join(RBD_SYSFS, '*')):
+        try:
+            with open(os.path.join(dev_dir, 'pool')) as pool_file:
+                pool = pool_file.read().strip()
+            with open(os.path.join(dev_dir, 'name')) as name_file:
+                image = name_file.read().strip()
+            with open(os.path.join(dev_dir, 'current_snap')) as snap_file:
+                snap = snap_file.read().strip()
+        except IOError:
+            # device went away while we were looking at it
+            continue
+
+        if snap not in ['', '-']:
+            # snapshot mappings are not exported by the gateways
+            continue
+
+        devices[(pool, image)] = '/dev/rbd{}'.format(os.path.basename(dev_dir))
+
+    return devices
+
+
+def image_id(ioctx, image, device):
+    """
+    Return the id of a mapped rbd image - from sysfs, or from librbd when the kernel doesn't
+    expose it (or the image is format 1, which has no id). Every gateway must arrive at the
+    same value, so librbd's block_name_prefix is reduced to the id for a format 2 image
+    :param ioctx: rados ioctx of the image's pool
+    :param image: rbd image name (str)
+    :param device: device path e.g. /dev/rbd0
+    :return: image id (str) e.g. '10074b0dc51' or, for a format 1 image, 'rb.0.1014.74b0dc51'
+    """
+
+    try:
+        with open(os.path.join(RBD_SYSFS, device.replace('/dev/rbd', ''), 'image_id')) as id_file:
+            sysfs_id = id_file.read().strip()
+        if sysfs_id:
+            return sysfs_id
+    except IOError:
+        pass
+
+    with rbd.Image(ioctx, image, read_only=True) as rbd_image:
+        prefix = rbd_image.stat()['block_name_prefix']
+
+    return prefix[len('rbd_data.'):] if prefix.startswith('rbd_data.') else prefix
+
+
+def map_image(pool, image):
+    """
+    Map an rbd image to this host
+    :param pool: pool name (str)
+    :param image: rbd image name (str)
+    :return: device path (str) e.g. /dev/rbd0
+    """
+
+    return subprocess.check_output(['rbd', 'map', '{}/{}'.format(pool, image)]).strip()
+
+
+def unmap_device(device):
+    """
+    Unmap an rbd image from this host
+    :param device: device path (or pool/image spec) to unmap
+    """
+
+    subprocess.check_output(['rbd', 'unmap', device])
+
+
+def rbdmap_entries(rbdmap=RBDMAP):
+    """
+    Return the images listed in the rbdmap file (used to map images at boot time)
+    :param rbdmap: path to the rbdmap file
+    :return: set of 'pool/image' strings
+    """
+
+    entries = set()
+    if os.path.exists(rbdmap):
+        with open(rbdmap) as rbdmap_file:
+            for line in rbdmap_file:
+                fields = line.split()
+                if fields and not fields[0].startswith('#'):
+                    entries.add(fields[0])
+
+    return entries
+
+
+def add_rbdmap_entries(image_specs, rbdmap=RBDMAP):
+    """
+    Append entries to the rbdmap file in a single write
+    :param image_specs: list of 'pool/image' strings to add
+    :param rbdmap: path to the rbdmap file
+    """
+
+    if not image_specs:
+        return
+
+    with open(rbdmap, 'a') as rbdmap_file:
+        rbdmap_file.write(''.join(["{}\t\tid=admin,keyring={},options=noshare\n".format(spec, KEYRING)
+                                   for spec in image_specs]))
+
+
+def remove_rbdmap_entries(image_names, rbdmap=RBDMAP):
+    """
+    Remove entries from the rbdmap file, rewriting the file once
+    :param image_names: list of image names or 'pool/image' strings to remove
+    :param rbdmap: path to the rbdmap file
+    :return: number of entries removed
+    """
+
+    if not image_names or not os.path.exists(rbdmap):
+        return 0
+
+    names = set(image_names)
+    with open(rbdmap) as rbdmap_file:
+        lines = rbdmap_file.readlines()
+
+    keep = []
+    for line in lines:
+        fields = line.split()
+        if fields and (fields[0] in names or fields[0].split('/')[-1] in names):
+            continue
+        keep.append(line)
+
+    removed = len(lines) - len(keep)
+    if removed:
+        tmp_file = rbdmap + '.tmp'
+        with open(tmp_file, 'w') as rbdmap_file:
+            rbdmap_file.writelines(keep)
+        os.rename(tmp_file, rbdmap)
+
+    return removed
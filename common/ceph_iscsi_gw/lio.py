@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+import uuid
+
+from ceph_iscsi_gw.utils import LazyModule
+
+root = LazyModule('rtslib_fb.root')
+
+# namespace of the wwns derived from rbd images - NB. changing it changes the wwn given to
+# every new LUN
+WWN_NAMESPACE = uuid.UUID('6ea00a5c-50df-4a9e-af87-7c611ec38f4f')
+
+
+class LIOSnapshot(object):
+    """
+    Indexed view of the local LIO configuration, built from a single walk of configfs
+    """
+
+    def __init__(self, iqn=None):
+        """
+        Walk LIO and index the objects of interest to the gateway
+        :param iqn: iqn of the gateway's target - if not given the first iscsi target is used
+        :return: snapshot object
+        """
+
+        self.root = root.RTSRoot()
+
+        # storage object name (i.e. rbd image name) -> storage object
+        self.storage_objects = dict((so.name, so) for so in self.root.storage_objects)
+
+        self.target = None
+        self.tpg = None
+        for target in self.root.targets:
+            if target.fabric_module.name != 'iscsi':
+                continue
+            if iqn is None or target.wwn == iqn:
+                self.target = target
+                break
+
+        # NB. The solution supports only a single tpg definition
+        if self.target:
+            self.tpg = next(self.target.tpgs, None)
+
+        # image name -> tpg LUN object
+        self.tpg_luns = {}
+        # client iqn -> NodeACL, and client iqn -> {image name -> MappedLUN}
+        self.acls = {}
+        self.mapped_luns = {}
+
+        if self.tpg:
+            for lun in self.tpg.luns:
+                self.tpg_luns[lun.storage_object.name] = lun
+
+            for acl in self.tpg.node_acls:
+                self.acls[acl.node_wwn] = acl
+                self.mapped_luns[acl.node_wwn] = dict((m_lun.tpg_lun.storage_object.name, m_lun)
+                                                      for m_lun in acl.mapped_luns)
+
+
+def lun_id(storage_object):
+    """
+    LUN id to use for a storage object in the tpg - the iblock index number is used
+    e.g. /sys/kernel/config/target/core/iblock_1/ansible4
+                                               ^
+    :param storage_object: LIO storage object
+    :return: LUN id (int)
+    """
+
+    return int(storage_object.path.split('/')[-2].split('_')[1])
+
+
+def derive_wwn(pool, image, image_id):
+    """
+    The wwn (unit serial) for an rbd image's LUN, derived from the image itself - so every
+    gateway defines the LUN with the same wwn, without waiting for one of them to publish it.
+    A recreated image has a new id, and so a new wwn
+    :param pool: pool name (str)
+    :param image: rbd image name (str)
+    :param image_id: rbd image id (or the block_name_prefix of a format 1 image)
+    :return: wwn (str) in the uuid form rtslib generates
+    """
+
+    return str(uuid.uuid5(WWN_NAMESPACE, '{}/{}@{}'.format(pool, image, image_id)))
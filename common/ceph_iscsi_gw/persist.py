@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+
+import hashlib
+import json
+import os
+
+from ceph_iscsi_gw.utils import LazyModule
+
+root = LazyModule('rtslib_fb.root')
+
+# the file target.service (targetcli restoreconfig) restores LIO from at boot - the same
+# format is written, so either can restore it
+SAVE_FILE = '/etc/target/saveconfig.json'
+
+# the saved config holds the CHAP credentials, so it's only readable by root
+SAVE_MODE = 0o600
+
+
+def serialise(state):
+    """
+    Render LIO state as saved in the file - the same layout as rtslib's save_to_file, so
+    the content (and its hash) is stable for the same state
+    :param state: dict from RTSRoot.dump()
+    :return: str
+    """
+
+    return json.dumps(state, sort_keys=True, indent=2) + '\n'
+
+
+def file_digest(path):
+    """
+    :param path: file to hash
+    :return: sha256 hex digest of the file, or None if there is no file
+    """
+
+    try:
+        with open(path, 'rb') as saved:
+            return hashlib.sha256(saved.read()).hexdigest()
+    except (IOError, OSError):
+        return None
+
+
+def _atomic_write(path, content, mode=SAVE_MODE):
+    """
+    Replace a file so a reader (or a crash) sees either the old or the new content, never
+    a partial write
+    :param content: bytes to write
+    """
+
+    save_dir = os.path.dirname(path)
+    if save_dir and not os.path.isdir(save_dir):
+        os.makedirs(save_dir)
+
+    tmp_file = '{}.{}.tmp'.format(path, os.getpid())
+    fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    try:
+        written = 0
+        while written < len(content):
+            written += os.write(fd, content[written:])
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.rename(tmp_file, path)
+
+    # make the rename itself durable
+    dir_fd = os.open(save_dir or '.', os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def save_lio(path=SAVE_FILE, lio_root=None):
+    """
+    Persist the running LIO configuration. The file is only rewritten when the content
+    differs from what's already saved (compared by sha256)
+    :param path: file to save to
+    :param lio_root: RTSRoot to dump - a new one is used by default
+    :return: Boolean - True if the file was written
+    """
+
+    # bytes, as hashed and written (python 3 takes neither as str)
+    content = serialise((lio_root or root.RTSRoot()).dump()).encode('utf-8')
+    if hashlib.sha256(content).hexdigest() == file_digest(path):
+        return False
+
+    _atomic_write(path, content)
+    return True
+
+
+def load_lio(path=SAVE_FILE):
+    """
+    :param path: saved LIO configuration
+    :return: dict (RTSRoot.dump() layout)
+    """
+
+    with open(path) as saved:
+        return json.load(saved)
+
+
+def select(state, storage_objects=None, targets=None):
+    """
+    Filter a saved LIO configuration down to some of its storage objects and/or targets.
+    tpg LUNs (and the client mappings to them) whose storage object isn't selected are
+    dropped, so the result can be restored on its own
+    :param state: dict (RTSRoot.dump() layout)
+    :param storage_objects: list of storage object names to keep (None keeps them all)
+    :param targets: list of target wwns (iqns) to keep (None keeps them all)
+    :return: filtered copy of state
+    """
+
+    selected = json.loads(json.dumps(state))
+
+    if storage_objects is not None:
+        selected['storage_objects'] = [so for so in selected.get('storage_objects', [])
+                                       if so['name'] in storage_objects]
+    if targets is not None:
+        selected['targets'] = [target for target in selected.get('targets', [])
+                               if target['wwn'] in targets]
+
+    so_paths = set('/backstores/{}/{}'.format(so['plugin'], so['name'])
+                   for so in selected.get('storage_objects', []))
+
+    for target in selected.get('targets', []):
+        for tpg in target.get('tpgs', []):
+            tpg['luns'] = [lun for lun in tpg.get('luns', []) if lun['storage_object'] in so_paths]
+            lun_ids = set(lun['index'] for lun in tpg['luns'])
+            for acl in tpg.get('node_acls', []):
+                acl['mapped_luns'] = [m_lun for m_lun in acl.get('mapped_luns', [])
+                                      if m_lun['tpg_lun'] in lun_ids]
+
+    return selected
+
+
+def restore_lio(path=SAVE_FILE, storage_objects=None, targets=None, lio_root=None):
+    """
+    Restore a saved LIO configuration, or just part of it, alongside whatever is already
+    defined. Objects that already exist in LIO are reported as errors and left as they are
+    :param path: saved LIO configuration
+    :param storage_objects: list of storage object names to restore (None for all)
+    :param targets: list of target wwns to restore (None for all)
+    :param lio_root: RTSRoot to restore into - a new one is used by default
+    :return: list of errors (str)
+    """
+
+    state = select(load_lio(path), storage_objects=storage_objects, targets=targets)
+    return (lio_root or root.RTSRoot()).restore(state, clear_existing=False, abort_on_error=False)
@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+
+# upper bound on the passes rebalance_owners makes swapping LUNs to spread each client's
+# LUNs - every pass that swaps reduces the clients' concentration, so this is rarely reached
+SPREAD_PASSES = 10
+
+
+class PlacementError(Exception):
+    """ No gateway has room for an active path (every candidate is at its max_active_luns) """
+    pass
+
+
+def gateway_nodes(gateways):
+    """
+    Gateways contains simple attributes (e.g. the iqn) and dicts that define each gateways
+    settings, so extract only the gateway node definitions
+    :param gateways: gateway dict from the RADOS configuration object
+    :return: dict of gateway hostname -> gateway settings (dict)
+    """
+
+    return dict((key, gateways[key]) for key in gateways if isinstance(gateways[key], dict))
+
+
+def _live_nodes(gateways, live):
+    """
+    Restrict the gateway nodes to the live ones - if liveness isn't known (live is None), or
+    no gateway is live, every gateway is returned
+    :param gateways: gateway dict from the RADOS configuration object
+    :param live: set of live gateway hostnames, or None
+    :return: dict of gateway hostname -> gateway settings (dict)
+    """
+
+    nodes = gateway_nodes(gateways)
+    if live is None:
+        return nodes
+
+    return dict((name, nodes[name]) for name in nodes if name in live) or nodes
+
+
+def gateway_cap(gateway):
+    """
+    :param gateway: gateway settings (dict)
+    :return: the gateway's limit on active LUNs (int), or None if it has no limit
+    """
+
+    return gateway.get('max_active_luns') or None
+
+
+def _full(nodes, counts):
+    """
+    :param nodes: dict of gateway hostname -> gateway settings
+    :param counts: dict of gateway hostname -> active LUNs
+    :return: description of the gateways' use of their limits e.g. 'gw1 4/4, gw2 8/8'
+    """
+
+    return ', '.join("{} {}/{}".format(name, counts[name], gateway_cap(nodes[name]) or 'unlimited')
+                     for name in sorted(nodes))
+
+
+def client_siblings(clients):
+    """
+    Map each image to the other images used by the same clients - LUNs that share a client
+    are best served by different gateways, so the client isn't limited to one gateway's
+    bandwidth
+    :param clients: clients dict from the RADOS configuration object (iqn -> {'image_list': ...})
+    :return: dict of image name -> list of sibling image names (an image shared by two of the
+             client's siblings is listed twice, since it concentrates both clients)
+    """
+
+    siblings = {}
+    for client in (clients or {}).values():
+        images = client.get('image_list', [])
+        for image in images:
+            siblings.setdefault(image, []).extend(other for other in images if other != image)
+
+    return siblings
+
+
+def desired_clients(clients, client_connections):
+    """
+    Combine the clients in the config with the desired client definitions, which take
+    precedence - on a first deployment the LUNs are placed before any client is defined
+    :param clients: clients dict from the RADOS configuration object
+    :param client_connections: list of client definitions (client, image_list, status) as
+                               given to igw_client
+    :return: clients dict (iqn -> {'image_list': ...})
+    """
+
+    combined = dict(clients or {})
+    for client in client_connections or []:
+        if client.get('status', 'present') == 'absent':
+            combined.pop(client['client'], None)
+        else:
+            combined[client['client']] = {"image_list": client.get('image_list', [])}
+
+    return combined
+
+
+def _overlap(image, gateway, owners, siblings):
+    """
+    :return: number of the image's siblings whose active path is on the gateway
+    """
+
+    return len([other for other in siblings.get(image, []) if owners.get(other) == gateway])
+
+
+def set_owner(gateways, live=None, image=None, disks=None, clients=None):
+    """
+    Determine the gateway that should provide the active path for a new LUN. The gateway
+    holding the fewest of the LUNs its clients already use is chosen, with ties going to the
+    gateway with the lowest number of active LUNs. Gateways at their max_active_luns are
+    passed over
+    :param gateways: gateway dict returned from the RADOS configuration object
+    :param live: set of live gateway hostnames (see heartbeat.live_gateways) - gateways
+                 that are down are not given new LUNs
+    :param image: name of the LUN being placed
+    :param disks: disks dict from the RADOS configuration object (the current owners)
+    :param clients: clients dict from the RADOS configuration object (the image_list of
+                    each client)
+    :return: specific gateway hostname (str) that should provide the active path for the next LUN
+    :raises PlacementError: every gateway is at its limit
+    """
+
+    nodes = _live_nodes(gateways, live)
+
+    # drained gateways (under maintenance) don't take on new active paths, unless there's
+    # nothing else available
+    candidates = dict((name, nodes[name]) for name in nodes if not nodes[name].get('drained')) or nodes
+    counts = dict((name, candidates[name]['active_luns']) for name in candidates)
+
+    open_nodes = [name for name in sorted(candidates)
+                  if gateway_cap(candidates[name]) is None or counts[name] < gateway_cap(candidates[name])]
+    if not open_nodes:
+        raise PlacementError("Unable to place {} - every gateway is at its max_active_luns "
+                             "({})".format(image or 'the LUN', _full(candidates, counts)))
+
+    owners = dict((name, (disks or {})[name].get('owner')) for name in disks or {})
+    siblings = client_siblings(clients)
+
+    # sorted, so ties are broken the same way on every run
+    return min(open_nodes, key=lambda name: (_overlap(image, name, owners, siblings), counts[name]))
+
+
+def drain_owners(config, drained_host, live=None):
+    """
+    Plan the move of the active paths owned by a gateway to its peers. Each LUN goes to the
+    peer holding the fewest of its clients' other LUNs, then the fewest active LUNs, so the
+    clients and the peers stay balanced. Peers at their max_active_luns take no more
+    :param config: configuration dict from the rados pool
+    :param drained_host: hostname of the gateway being drained
+    :param live: set of live gateway hostnames - only live peers take over LUNs
+    :return: dict of image name -> new owner hostname (empty if there are no peers)
+    :raises PlacementError: the peers don't have room for all the LUNs
+    """
+
+    nodes = gateway_nodes(config['gateways'])
+    peers = dict((name, gw['active_luns']) for name, gw in nodes.items()
+                 if name != drained_host and not gw.get('drained') and (live is None or name in live))
+    if not peers:
+        return {}
+
+    owners = dict((image, config['disks'][image].get('owner')) for image in config['disks'])
+    siblings = client_siblings(config.get('clients'))
+
+    moves = {}
+    for image in sorted(config['disks']):
+        if owners[image] != drained_host:
+            continue
+
+        room = [name for name in sorted(peers)
+                if gateway_cap(nodes[name]) is None or peers[name] < gateway_cap(nodes[name])]
+        if not room:
+            raise PlacementError("Unable to drain {} - the peers are at their max_active_luns "
+                                 "({})".format(drained_host,
+                                               _full(dict((name, nodes[name]) for name in peers), peers)))
+
+        # sorted, so ties are broken the same way on every run
+        new_owner = min(room, key=lambda name: (_overlap(image, name, owners, siblings), peers[name]))
+        moves[image] = new_owner
+        owners[image] = new_owner
+        peers[new_owner] += 1
+
+    return moves
+
+
+def _quotas(nodes, caps, total, owned):
+    """
+    Share the LUNs between the gateways - evenly, except that a gateway never exceeds its
+    cap (the LUNs it can't take are shared by the others)
+    :return: dict of gateway hostname -> LUNs it should own
+    """
+
+    quota = {}
+    pending = list(nodes)
+    remaining = total
+    while pending:
+        base = remaining // len(pending)
+        full = [name for name in pending if caps[name] is not None and caps[name] <= base]
+        if not full:
+            break
+        for name in full:
+            quota[name] = caps[name]
+            remaining -= caps[name]
+            pending.remove(name)
+
+    if not pending:
+        return quota
+
+    # every other gateway ends up with base or base + 1 LUNs - the gateways holding the most
+    # LUNs get the + 1 slots, so fewer LUNs move
+    base, extra = divmod(remaining, len(pending))
+    order = sorted(pending, key=lambda name: (-len(owned[name]), name))
+    quota.update((name, base + (1 if ptr < extra else 0)) for ptr, name in enumerate(order))
+
+    return quota
+
+
+def _spread(owned, owners, siblings):
+    """
+    Swap pairs of LUNs between gateways while that reduces the number of LUNs sharing a
+    client on the same gateway. A swap leaves every gateway's LUN count as it was
+    :param owned: dict of gateway hostname -> list of image names (updated)
+    :param owners: dict of image name -> gateway hostname (updated)
+    """
+
+    # the number of each image's siblings on each gateway, kept up to date as LUNs swap
+    crowding = dict((image, dict((name, 0) for name in owned)) for image in owners)
+    for image in owners:
+        for other in siblings.get(image, []):
+            if other in owners:
+                crowding[image][owners[other]] += 1
+
+    def _move(image, old, new):
+        owners[image] = new
+        owned[old].remove(image)
+        owned[new].append(image)
+        for other in siblings.get(image, []):
+            if other in crowding:
+                crowding[other][old] -= 1
+                crowding[other][new] += 1
+
+    for _ in range(SPREAD_PASSES):
+        swapped = False
+        for image in sorted(owners):
+            here = owners[image]
+            if not crowding[image][here]:
+                continue
+
+            best = None
+            for name in sorted(owned):
+                if name == here:
+                    continue
+                for other in owned[name]:
+                    shared = siblings[image].count(other)
+                    # change in the number of sibling pairs sharing a gateway
+                    gain = (crowding[image][name] - crowding[image][here] +
+                            crowding[other][here] - crowding[other][name] - 2 * shared)
+                    if gain < 0 and (best is None or gain < best[0]):
+                        best = (gain, name, other)
+
+            if best:
+                _, name, other = best
+                _move(image, here, name)
+                _move(other, name, here)
+                swapped = True
+
+        if not swapped:
+            break
+
+
+def rebalance_owners(config, live=None):
+    """
+    Spread the active paths evenly across the live gateways that aren't drained, moving as
+    few LUNs as possible. LUNs owned by a gateway that is down, drained or no longer defined
+    are always moved. A gateway is never given more than its max_active_luns, and LUNs
+    sharing a client are spread across the gateways
+    :param config: configuration dict from the rados pool
+    :param live: set of live gateway hostnames (see heartbeat.live_gateways)
+    :return: dict of image name -> new owner hostname (only the disks that move)
+    :raises PlacementError: the gateways' limits leave no room for all the LUNs
+    """
+
+    gateways = dict((name, gw) for name, gw in _live_nodes(config['gateways'], live).items()
+                    if not gw.get('drained'))
+    nodes = sorted(gateways)
+    if not nodes:
+        return {}
+
+    caps = dict((name, gateway_cap(gateways[name])) for name in nodes)
+    total = len(config['disks'])
+    if None not in caps.values() and sum(caps.values()) < total:
+        raise PlacementError("Unable to place {} LUNs - the max_active_luns of the gateways ({}) only "
+                             "allow {}".format(total, ', '.join("{} {}".format(name, caps[name]) for name in nodes),
+                                               sum(caps.values())))
+
+    siblings = client_siblings(config.get('clients'))
+
+    owners = {}
+    owned = dict((name, []) for name in nodes)
+    homeless = []
+    for image in sorted(config['disks']):
+        owner = config['disks'][image].get('owner')
+        if owner in owned:
+            owned[owner].append(image)
+            owners[image] = owner
+        else:
+            homeless.append(image)
+
+    quota = _quotas(nodes, caps, total, owned)
+
+    # a gateway over its quota sheds the LUNs that share the most clients with its others
+    for name in sorted(nodes, key=lambda name: (-len(owned[name]), name)):
+        while len(owned[name]) > quota[name]:
+            image = max(reversed(owned[name]), key=lambda image: _overlap(image, name, owners, siblings))
+            owned[name].remove(image)
+            del owners[image]
+            homeless.append(image)
+
+    for image in homeless:
+        room = [name for name in nodes if len(owned[name]) < quota[name]]
+        new_owner = min(room, key=lambda name: (_overlap(image, name, owners, siblings),
+                                                len(owned[name]) - quota[name]))
+        owned[new_owner].append(image)
+        owners[image] = new_owner
+
+    if siblings:
+        _spread(owned, owners, siblings)
+
+    return dict((image, owners[image]) for image in sorted(owners)
+                if owners[image] != config['disks'][image].get('owner'))
+
+
+def get_update_host(config, live=None):
+    """
+    decide which gateway host should be responsible for any config object updates
+    :param config: configuration dict from the rados pool
+    :param live: set of live gateway hostnames (see heartbeat.live_gateways) - when given,
+                 a gateway that has stopped sending heartbeats is passed over
+    :return: a suitable gateway host that is online
+    """
+
+    ptr = 0
+    # sorted, so every gateway arrives at the same answer
+    potential_hosts = sorted(_live_nodes(config["gateways"], live).keys())
+
+    return potential_hosts[ptr]
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import os
+import pstats
+import sys
+
+from ceph_iscsi_gw.profiling import PROFILE_DIR
+
+SORT_KEYS = ['tottime', 'cumtime', 'calls']
+
+
+def find_profiles(dirs, suffix, modules=None, hosts=None):
+    """
+    Find the profiles written by profiling.run_main - each host's profiles are in a directory
+    named after the host, so profiles fetched from several gateways can share a parent
+    :param dirs: list of directories to search (recursively)
+    :param suffix: '.prof' or '.mem.json'
+    :param modules: list of module names to include (None for all)
+    :param hosts: list of hostnames to include (None for all)
+    :return: sorted list of (host, module, path)
+    """
+
+    found = []
+    for top in dirs:
+        for dir_path, _, file_names in os.walk(top):
+            host = os.path.basename(dir_path)
+            if hosts and host not in hosts:
+                continue
+            for file_name in file_names:
+                if not file_name.endswith(suffix):
+                    continue
+                # <module>-<timestamp>-<pid><suffix>
+                module = file_name[:-len(suffix)].rsplit('-', 2)[0]
+                if modules and module not in modules:
+                    continue
+                found.append((host, module, os.path.join(dir_path, file_name)))
+
+    return sorted(found)
+
+
+def merge_profiles(paths):
+    """
+    :param paths: list of cProfile output files
+    :return: (dict of function description -> {tottime, cumtime, calls} summed over the runs,
+              list of the files that couldn't be read e.g. written by another python version)
+    """
+
+    functions = {}
+    unreadable = []
+    stats = None
+    for path in paths:
+        try:
+            if stats is None:
+                stats = pstats.Stats(path)
+            else:
+                stats.add(path)
+        except (IOError, OSError, ValueError, EOFError, TypeError):
+            unreadable.append(path)
+
+    if stats is None:
+        return functions, unreadable
+
+    for (file_name, line, func_name), (_, calls, tottime, cumtime, _) in stats.stats.items():
+        if file_name == '~':
+            # built-in functions have no file
+            name = func_name
+        else:
+            name = "{}:{}({})".format(file_name, line, func_name)
+        functions[name] = {"tottime": tottime, "cumtime": cumtime, "calls": calls}
+
+    return functions, unreadable
+
+
+def rank(functions, runs, sort_key='tottime', limit=30, baseline=None, baseline_runs=0):
+    """
+    Rank the functions by time (or calls) per run
+    :param functions: dict from merge_profiles
+    :param runs: number of runs merged
+    :param sort_key: tottime, cumtime or calls
+    :param limit: rows to return
+    :param baseline: dict from merge_profiles for earlier runs - when given, the rows are ranked
+                     by the increase over the baseline instead
+    :param baseline_runs: number of baseline runs merged
+    :return: list of dicts (function, tottime, cumtime, calls per run, and delta with a baseline)
+    """
+
+    rows = []
+    for name in functions:
+        row = dict((key, functions[name][key] / float(runs)) for key in SORT_KEYS)
+        row['function'] = name
+        if baseline is not None:
+            before = baseline.get(name, {}).get(sort_key, 0) / float(baseline_runs or 1)
+            row['delta'] = row[sort_key] - before
+        rows.append(row)
+
+    rows.sort(key=lambda row: (-row['delta' if baseline is not None else sort_key], row['function']))
+    return rows[:limit]
+
+
+def merge_memory(paths):
+    """
+    :param paths: list of tracemalloc reports (.mem.json)
+    :return: (peak kb of the largest run, dict of location -> largest size_kb seen)
+    """
+
+    peak = 0
+    locations = {}
+    for path in paths:
+        try:
+            with open(path) as mem_file:
+                report = json.load(mem_file)
+        except (IOError, OSError, ValueError):
+            continue
+        peak = max(peak, report.get('peak_kb', 0))
+        for entry in report.get('top', []):
+            locations[entry['location']] = max(locations.get(entry['location'], 0), entry['size_kb'])
+
+    return peak, locations
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="merge igw module profiles (IGW_PROFILE runs) from "
+                                                 "any number of runs and gateways into a hot spot report")
+    parser.add_argument('dirs', nargs='*', default=[PROFILE_DIR],
+                        help="directories holding the profiles (default {})".format(PROFILE_DIR))
+    parser.add_argument('--module', action='append', help="only include this module (repeatable)")
+    parser.add_argument('--host', action='append', help="only include this gateway (repeatable)")
+    parser.add_argument('--sort', choices=SORT_KEYS, default='tottime', help="ranking, per run")
+    parser.add_argument('--limit', type=int, default=30, help="functions to report")
+    parser.add_argument('--baseline', action='append',
+                        help="directory of earlier profiles - functions are ranked by their increase "
+                             "over these runs (repeatable)")
+    parser.add_argument('--json', action='store_true', help="print the report as json")
+    args = parser.parse_args()
+
+    profiles = find_profiles(args.dirs, '.prof', modules=args.module, hosts=args.host)
+    if not profiles:
+        sys.stderr.write("No profiles found in {}\n".format(', '.join(args.dirs)))
+        sys.exit(1)
+
+    baseline = None
+    baseline_runs = 0
+    unreadable = []
+    if args.baseline:
+        baseline_profiles = find_profiles(args.baseline, '.prof', modules=args.module, hosts=args.host)
+        baseline, skipped = merge_profiles([path for _, _, path in baseline_profiles])
+        baseline_runs = len(baseline_profiles) - len(skipped)
+        unreadable.extend(skipped)
+
+    functions, skipped = merge_profiles([path for _, _, path in profiles])
+    unreadable.extend(skipped)
+    profiles = [profile for profile in profiles if profile[2] not in skipped]
+    if not profiles:
+        sys.stderr.write("None of the profiles could be read\n")
+        sys.exit(1)
+
+    for path in unreadable:
+        sys.stderr.write("skipped {} - unreadable by this python\n".format(path))
+
+    rows = rank(functions, len(profiles), sort_key=args.sort, limit=args.limit, baseline=baseline,
+                baseline_runs=baseline_runs)
+
+    peak, locations = merge_memory([path for _, _, path in
+                                    find_profiles(args.dirs, '.mem.json', modules=args.module, hosts=args.host)])
+    memory = sorted(locations.items(), key=lambda item: (-item[1], item[0]))[:args.limit]
+
+    summary = {"runs": len(profiles),
+               "hosts": sorted(set(host for host, _, _ in profiles)),
+               "modules": sorted(set(module for _, module, _ in profiles)),
+               "baseline_runs": baseline_runs,
+               "functions": rows,
+               "memory_peak_kb": peak,
+               "memory": [{"location": location, "size_kb": size_kb} for location, size_kb in memory]}
+
+    if args.json:
+        print(json.dumps(summary, indent=2, sort_keys=True))
+        return
+
+    print("{} runs of {} on {}".format(summary['runs'], ', '.join(summary['modules']), ', '.join(summary['hosts'])))
+    if baseline is not None:
+        print("ranked by the increase in {} per run over {} baseline runs".format(args.sort, baseline_runs))
+    print("{:>4} {:>10} {:>10} {:>10} {:>10}  {}".format('rank', 'tottime', 'cumtime', 'calls',
+                                                          'delta' if baseline is not None else '', 'function'))
+    for ptr, row in enumerate(rows):
+        print("{:>4} {:>10.4f} {:>10.4f} {:>10.1f} {:>10}  {}".format(ptr + 1, row['tottime'], row['cumtime'],
+                                                                      row['calls'],
+                                                                      '{:+.4f}'.format(row['delta'])
+                                                                      if 'delta' in row else '',
+                                                                      row['function']))
+
+    if memory:
+        print("\nlargest allocation sites (peak of any run {} KB)".format(peak))
+        for location, size_kb in memory:
+            print("  {:>10.1f} KB  {}".format(size_kb, location))
+
+
+if __name__ == '__main__':
+
+    main()
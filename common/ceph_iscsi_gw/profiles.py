@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+
+from ceph_iscsi_gw.utils import LazyModule
+
+rtslib_utils = LazyModule('rtslib_fb.utils')
+
+# Backstore (storage object) attributes that a profile may set. The list is ordered, since
+# block_size is the unit of optimal_sectors. NB. optimal_sectors must not exceed
+# hw_max_sectors, which is read-only (taken from the rbd device)
+BACKSTORE_ATTRIBUTES = ['block_size',
+                        'optimal_sectors',
+                        'queue_depth',
+                        'emulate_tpu',
+                        'emulate_tpws',
+                        'emulate_write_cache']
+
+# Built-in backstore profiles. Profiles held in the config object take precedence over
+# these, so a site can redefine any of them
+BACKSTORE_PROFILES = {
+    "default": {},
+    "sequential": {"optimal_sectors": 8192,
+                   "queue_depth": 128,
+                   "emulate_tpu": 1,
+                   "emulate_tpws": 1,
+                   "emulate_write_cache": 0},
+    "random": {"block_size": 512,
+               "optimal_sectors": 128,
+               "queue_depth": 256,
+               "emulate_tpu": 1,
+               "emulate_tpws": 1,
+               "emulate_write_cache": 0}
+}
+
+# iSCSI login parameters of the tpg, offered to initiators at login. Ordered, since
+# FirstBurstLength must not exceed MaxBurstLength. Yes/No parameters take the strings
+# 'Yes' or 'No'
+TPG_PARAMETERS = ['MaxRecvDataSegmentLength',
+                  'MaxXmitDataSegmentLength',
+                  'MaxBurstLength',
+                  'FirstBurstLength',
+                  'ImmediateData',
+                  'InitialR2T',
+                  'MaxOutstandingR2T']
+
+# tpg attributes - default_cmdsn_depth is the queue depth of clients without their own
+TPG_ATTRIBUTES = ['default_cmdsn_depth',
+                  'login_timeout',
+                  'netif_timeout']
+
+# Built-in tpg profiles (parameters and attributes together). As with the backstore
+# profiles, a profile of the same name in the config object takes precedence
+TPG_PROFILES = {
+    "default": {},
+    "deep_queue": {"MaxRecvDataSegmentLength": 262144,
+                   "MaxXmitDataSegmentLength": 262144,
+                   "MaxBurstLength": 1048576,
+                   "FirstBurstLength": 262144,
+                   "ImmediateData": "Yes",
+                   "InitialR2T": "No",
+                   "default_cmdsn_depth": 128}
+}
+
+# Per client (node ACL) settings. cmdsn_depth is the client's queue depth, the others are
+# ACL attributes
+CLIENT_SETTINGS = ['cmdsn_depth',
+                   'dataout_timeout',
+                   'nopin_timeout',
+                   'nopin_response_timeout']
+
+# Built-in client profiles
+CLIENT_PROFILES = {
+    "default": {},
+    "deep_queue": {"cmdsn_depth": 128}
+}
+
+
+def invalid_attributes(attributes, supported=BACKSTORE_ATTRIBUTES):
+    """
+    Check the attribute names of a profile
+    :param attributes: dict of attribute name -> value
+    :param supported: list of attribute names that may be used
+    :return: list of attribute names that are not supported ... should be empty!
+    """
+
+    return [attr for attr in attributes if attr not in supported]
+
+
+def resolve_profile(name, cfg_profiles, builtin_profiles=BACKSTORE_PROFILES):
+    """
+    Find the attributes for a named profile - the config object's definition is used
+    first, falling back to the built-in profiles
+    :param name: profile name (str)
+    :param cfg_profiles: profile dict from the rados configuration object
+    :param builtin_profiles: dict of built-in profiles to fall back to
+    :return: dict of attributes, or None if the profile is not defined
+    """
+
+    if name in cfg_profiles:
+        return cfg_profiles[name]
+
+    return builtin_profiles.get(name)
+
+
+def apply_attributes(rts_object, attributes, order=BACKSTORE_ATTRIBUTES):
+    """
+    Apply a set of configfs attributes to an rtslib object, only writing the attributes
+    whose current value differs from the requested value
+    :param rts_object: rtslib object supporting get_attribute/set_attribute (e.g. a storage object)
+    :param attributes: dict of attribute name -> value
+    :param order: list defining the sequence the attributes should be applied in
+    :return: (list of attribute names changed, dict of attribute name -> error for failures)
+    """
+
+    # NB. a failure is usually an attribute that's read-only or unsupported for this
+    # backstore type (e.g. block_size once exported)
+    return _apply(rts_object.get_attribute, rts_object.set_attribute, attributes, order)
+
+
+def apply_parameters(rts_object, parameters, order=TPG_PARAMETERS):
+    """
+    Apply a set of iSCSI parameters to an rtslib object, only writing the parameters whose
+    current value differs from the requested value
+    :param rts_object: rtslib object supporting get_parameter/set_parameter (e.g. a tpg)
+    :param parameters: dict of parameter name -> value
+    :param order: list defining the sequence the parameters should be applied in
+    :return: (list of parameter names changed, dict of parameter name -> error for failures)
+    """
+
+    return _apply(rts_object.get_parameter, rts_object.set_parameter, parameters, order)
+
+
+def apply_tpg_profile(tpg, settings):
+    """
+    Apply a tpg profile - its login parameters and tpg attributes
+    :param tpg: rtslib TPG object
+    :param settings: dict of parameter/attribute name -> value
+    :return: (list of names changed, dict of name -> error for failures)
+    """
+
+    parameters = dict((name, settings[name]) for name in settings if name in TPG_PARAMETERS)
+    attributes = dict((name, settings[name]) for name in settings if name not in TPG_PARAMETERS)
+
+    changed, failed = apply_parameters(tpg, parameters)
+    attr_changed, attr_failed = apply_attributes(tpg, attributes, order=TPG_ATTRIBUTES)
+    failed.update(attr_failed)
+
+    return changed + attr_changed, failed
+
+
+def _get_client_setting(acl, name):
+    if name == 'cmdsn_depth':
+        return str(acl.tcq_depth)
+    return acl.get_attribute(name)
+
+
+def _set_client_setting(acl, name, value):
+    if name == 'cmdsn_depth':
+        acl.tcq_depth = value
+    else:
+        acl.set_attribute(name, value)
+
+
+def pending_client_settings(acl, settings):
+    """
+    :param acl: rtslib NodeACL object
+    :param settings: dict of client setting name -> value
+    :return: dict of the settings that differ from the ACL's current values
+    """
+
+    pending = {}
+    for name in settings:
+        try:
+            if _get_client_setting(acl, name) != str(settings[name]):
+                pending[name] = settings[name]
+        except rtslib_utils.RTSLibError:
+            pending[name] = settings[name]
+
+    return pending
+
+
+def apply_client_profile(acl, settings):
+    """
+    Apply a client profile to a client's node ACL. NB. when cmdsn_depth changes, LIO drops
+    the client's active session, and the client logs in again with the new depth
+    :param acl: rtslib NodeACL object
+    :param settings: dict of client setting name -> value
+    :return: (list of names changed, dict of name -> error for failures)
+    """
+
+    return _apply(lambda name: _get_client_setting(acl, name),
+                  lambda name, value: _set_client_setting(acl, name, value),
+                  settings, CLIENT_SETTINGS)
+
+
+def _apply(getter, setter, values, order):
+
+    changed = []
+    failed = {}
+
+    for name in sorted(values, key=lambda name: order.index(name) if name in order else len(order)):
+        value = str(values[name])
+        try:
+            if getter(name) != value:
+                setter(name, value)
+                changed.append(name)
+        except rtslib_utils.RTSLibError as err:
+            failed[name] = str(err)
+
+    return changed, failed
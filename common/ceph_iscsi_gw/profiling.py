@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+import json
+import os
+import socket
+import time
+
+from ceph_iscsi_gw.common import CACHE_DIR
+
+# setting IGW_PROFILE runs the igw modules under cProfile - '1' writes the profiles to
+# PROFILE_DIR, any other value names the directory to use. IGW_PROFILE_MEMORY also records
+# the largest allocations, when tracemalloc is available (python 3.4+)
+PROFILE_ENV = 'IGW_PROFILE'
+MEMORY_ENV = 'IGW_PROFILE_MEMORY'
+
+PROFILE_DIR = os.path.join(CACHE_DIR, 'profiles')
+
+# traceback depth kept for each allocation, and the number of allocation sites saved per run
+MEMORY_FRAMES = 4
+MEMORY_TOP = 50
+
+
+def profile_dir(setting):
+    """
+    :param setting: value of IGW_PROFILE
+    :return: this host's profile directory - profiles of different gateways stay apart when
+             they're gathered in one place
+    """
+
+    base_dir = PROFILE_DIR if setting in ['1', 'yes', 'true'] else setting
+    return os.path.join(base_dir, socket.gethostname().split('.')[0])
+
+
+def _memory_report(snapshot):
+    """
+    :param snapshot: tracemalloc Snapshot
+    :return: list of dicts (location, size_kb, count) for the largest allocation sites
+    """
+
+    report = []
+    for stat in snapshot.statistics('traceback')[:MEMORY_TOP]:
+        frame = stat.traceback[0]
+        report.append({"location": "{}:{}".format(frame.filename, frame.lineno),
+                       "size_kb": round(stat.size / 1024.0, 1),
+                       "count": stat.count})
+    return report
+
+
+def run_main(main, name):
+    """
+    Run a module's main(), profiled when IGW_PROFILE is set. The profile is written even when
+    main() exits (as the ansible modules do through exit_json/fail_json), and a failure to
+    write it never affects the module
+    :param main: function to run
+    :param name: name of the module, used in the profile file names
+    :return: the return value of main()
+    """
+
+    setting = os.environ.get(PROFILE_ENV, '')
+    if setting in ['', '0', 'no', 'false']:
+        return main()
+
+    # only loaded when profiling, so the modules' start up cost is unchanged
+    import cProfile
+
+    tracemalloc = None
+    if os.environ.get(MEMORY_ENV, '') not in ['', '0', 'no', 'false']:
+        try:
+            import tracemalloc
+            tracemalloc.start(MEMORY_FRAMES)
+        except ImportError:
+            tracemalloc = None
+
+    prefix = "{}-{}-{}".format(name.replace('.py', ''), time.strftime('%Y%m%d%H%M%S'), os.getpid())
+    profiler = cProfile.Profile()
+    start = time.time()
+    try:
+        return profiler.runcall(main)
+    finally:
+        elapsed = time.time() - start
+        try:
+            out_dir = profile_dir(setting)
+            if not os.path.isdir(out_dir):
+                os.makedirs(out_dir)
+            profiler.dump_stats(os.path.join(out_dir, prefix + '.prof'))
+            if tracemalloc is not None:
+                current, peak = tracemalloc.get_traced_memory()
+                with open(os.path.join(out_dir, prefix + '.mem.json'), 'w') as mem_file:
+                    json.dump({"module": name,
+                               "elapsed": round(elapsed, 3),
+                               "peak_kb": round(peak / 1024.0, 1),
+                               "top": _memory_report(tracemalloc.take_snapshot())}, mem_file, indent=2)
+                tracemalloc.stop()
+        except (IOError, OSError):
+            pass
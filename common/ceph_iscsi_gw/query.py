@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+
+import argparse
+import errno
+import json
+import logging
+import os
+import sys
+import time
+
+from ceph_iscsi_gw.common import Config, CONFIG_NAME, CONFIG_POOL
+from ceph_iscsi_gw.heartbeat import HEARTBEAT_INTERVAL
+from ceph_iscsi_gw.placement import gateway_cap, gateway_nodes
+
+# default limit on the age of the local copy (seconds) - the copy is only as current as this
+# host's last read of the config, so an older copy is passed over for a read through the agent
+# (or from the cluster)
+MAX_AGE = 3 * HEARTBEAT_INTERVAL
+
+
+class ConfigIndex(object):
+    """
+    Lookups over the gateway config, indexed in a single pass through it. Each query is a
+    generator of rows (dicts), so output can start before a large config is walked
+    """
+
+    def __init__(self, config):
+        """
+        :param config: config dict (as held in the config object)
+        :return: index object
+        """
+
+        self.disks = config.get('disks', {})
+        self.clients = config.get('clients', {})
+        self.gateways = gateway_nodes(config.get('gateways', {}))
+        self.epoch = config.get('epoch')
+
+        # image name -> sorted list of the client iqns mapping it
+        self.image_clients = dict((image, []) for image in self.disks)
+        for iqn in sorted(self.clients):
+            for image in self.clients[iqn].get('image_list', []):
+                self.image_clients.setdefault(image, []).append(iqn)
+
+        # gateway hostname -> sorted list of the images it provides the active path for
+        self.owned = dict((name, []) for name in self.gateways)
+        for image in sorted(self.disks):
+            self.owned.setdefault(self.disks[image].get('owner', ''), []).append(image)
+
+    def clients_of(self, image):
+        for iqn in self.image_clients.get(image, []):
+            yield {"image": image, "client": iqn}
+
+    def images_of(self, iqn):
+        for image in self.clients.get(iqn, {}).get('image_list', []):
+            yield {"client": iqn, "image": image}
+
+    def disks_of(self, gateway):
+        for image in self.owned.get(gateway, []):
+            disk = self.disks[image]
+            yield {"gateway": gateway, "image": image, "pool": disk.get('pool', 'rbd'), "wwn": disk.get('wwn', '')}
+
+    def active_luns(self):
+        # the recorded count is shown alongside the count of disks owned, so any drift is visible
+        for name in sorted(self.gateways):
+            gateway = self.gateways[name]
+            yield {"gateway": name,
+                   "active_luns": gateway.get('active_luns', 0),
+                   "owned": len(self.owned[name]),
+                   "max_active_luns": gateway_cap(gateway) or 0,
+                   "drained": bool(gateway.get('drained'))}
+
+    def unmapped(self):
+        for image in sorted(self.disks):
+            if not self.image_clients[image]:
+                yield {"image": image, "pool": self.disks[image].get('pool', 'rbd'),
+                       "owner": self.disks[image].get('owner', '')}
+
+
+# query name -> (ConfigIndex method, argument name or None, index attribute the argument must be in)
+QUERIES = {
+    "clients": ('clients_of', 'image', 'image_clients'),
+    "images": ('images_of', 'client', 'clients'),
+    "disks": ('disks_of', 'gateway', 'owned'),
+    "active-luns": ('active_luns', None, None),
+    "unmapped": ('unmapped', None, None)
+}
+
+QUERY_HELP = {
+    "clients": "clients that see an image",
+    "images": "images mapped to a client",
+    "disks": "disks a gateway provides the active path for",
+    "active-luns": "active LUN counts per gateway",
+    "unmapped": "images not mapped to any client"
+}
+
+# order of the fields in text output
+FIELDS = ['gateway', 'client', 'image', 'pool', 'owner', 'wwn', 'active_luns', 'owned', 'max_active_luns', 'drained']
+
+
+def load_config(logger, pool=CONFIG_POOL, cfg_name=CONFIG_NAME, max_age=None, fresh=False):
+    """
+    Load the config - from the local copy when there is one (kept current by the gateway agent,
+    otherwise as last read or committed by this host), or from the cluster
+    :param logger: logger object
+    :param pool: pool holding the config object
+    :param cfg_name: config object name
+    :param max_age: seconds - an older local copy isn't used (None for any age)
+    :param fresh: Boolean - always read the config from the cluster (or the agent)
+    :return: (config dict, source description (str), error message (str))
+    """
+
+    if not fresh:
+        try:
+            age = time.time() - os.path.getmtime(Config.cache_file(pool, cfg_name))
+        except OSError:
+            age = None
+        if age is not None and (max_age is None or age <= max_age):
+            cfg_dict = Config.get_cached(pool, cfg_name)
+            if cfg_dict:
+                return cfg_dict, "local copy {} ({:.0f}s old)".format(Config.cache_file(pool, cfg_name), age), ''
+
+    config = Config(logger, cfg_name=cfg_name, pool=pool)
+    if config.ceph is not None:
+        config.ceph.shutdown()
+    if config.error:
+        return {}, '', config.error_msg
+
+    return config.config, "agent" if config.agent else "cluster", ''
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="query the iSCSI gateway configuration")
+    parser.add_argument('--pool', default=CONFIG_POOL, help="pool holding the gateway group's config object")
+    parser.add_argument('--config-name', default=CONFIG_NAME, help="config object name")
+    parser.add_argument('--max-age', type=float, default=MAX_AGE,
+                        help="seconds - read the config from the cluster if the local copy is older "
+                             "(default {})".format(MAX_AGE))
+    parser.add_argument('--fresh', action='store_true', help="read the config from the cluster, not the local copy")
+    parser.add_argument('--json', action='store_true', help="print each row as a json object (one per line)")
+    parser.add_argument('--verbose', action='store_true', help="report where the config came from (on stderr)")
+
+    queries = parser.add_subparsers(dest='query')
+    for name in sorted(QUERIES):
+        query = queries.add_parser(name, help=QUERY_HELP[name])
+        if QUERIES[name][1]:
+            query.add_argument(QUERIES[name][1])
+    args = parser.parse_args()
+
+    logger = logging.getLogger('igw-query')
+    logger.addHandler(logging.NullHandler())
+
+    cfg_dict, source, error_msg = load_config(logger, pool=args.pool, cfg_name=args.config_name,
+                                              max_age=args.max_age, fresh=args.fresh)
+    if error_msg:
+        sys.stderr.write("Unable to read the config {}/{} - {}\n".format(args.pool, args.config_name, error_msg))
+        sys.exit(1)
+
+    index = ConfigIndex(cfg_dict)
+    # answers from the local copy may be out of date, so where they came from is always reported
+    if args.verbose or source.startswith('local copy'):
+        sys.stderr.write("config epoch {} from the {}\n".format(index.epoch, source))
+
+    method, arg_name, lookup = QUERIES[args.query]
+    query_args = []
+    if arg_name:
+        value = getattr(args, arg_name)
+        if value not in getattr(index, lookup):
+            sys.stderr.write("{} '{}' is not defined in the config\n".format(arg_name, value))
+            sys.exit(1)
+        query_args.append(value)
+
+    try:
+        for row in getattr(index, method)(*query_args):
+            if args.json:
+                sys.stdout.write(json.dumps(row, sort_keys=True) + '\n')
+            else:
+                sys.stdout.write(' '.join(str(row[field]) for field in FIELDS if field in row) + '\n')
+        sys.stdout.flush()
+    except IOError as err:
+        # the reader went away (e.g. piped to head)
+        if err.errno != errno.EPIPE:
+            raise
+
+
+if __name__ == '__main__':
+
+    main()
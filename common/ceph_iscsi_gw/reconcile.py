@@ -0,0 +1,637 @@
+#!/usr/bin/env python
+
+import time
+
+from ceph_iscsi_gw import alua, krbd
+from ceph_iscsi_gw.allocator import LunIdAllocator
+from ceph_iscsi_gw.lio import LIOSnapshot, derive_wwn, lun_id
+from ceph_iscsi_gw.placement import PlacementError, desired_clients, set_owner, get_update_host
+from ceph_iscsi_gw.profiles import (CLIENT_PROFILES, apply_client_profile, pending_client_settings,
+                                    resolve_profile)
+from ceph_iscsi_gw.utils import AsyncCall, LazyModule, convert_2_bytes, valid_size, run_parallel, wait_for
+
+rbd = LazyModule('rbd')
+rtslib = LazyModule('rtslib_fb')
+rtslib_target = LazyModule('rtslib_fb.target')
+rtslib_utils = LazyModule('rtslib_fb.utils')
+
+# phases of a plan, in the order they must be applied. Steps within the create, resize and
+# map phases are independent of each other, so they are run concurrently
+PHASES = ['create', 'resize', 'map', 'lio_add', 'tune', 'tpg_map', 'acl', 'alua', 'config']
+PARALLEL_PHASES = ['create', 'resize', 'map']
+
+# features needed for an rbd image to be exported correctly via LIO to iSCSI clients
+RBD_FEATURE_LIST = ['RBD_FEATURE_LAYERING']
+
+TIME_OUT_SECS = 30
+LOOP_DELAY = 2
+
+
+class Step(object):
+    """
+    A single change needed to bring the gateway in line with the desired state
+    """
+
+    def __init__(self, phase, action, item, **detail):
+        self.phase = phase
+        self.action = action
+        self.item = item
+        self.detail = detail
+
+    def as_dict(self):
+        step = {"phase": self.phase,
+                "action": self.action,
+                "item": self.item}
+        step.update(self.detail)
+        return step
+
+    def __repr__(self):
+        return str(self.as_dict())
+
+
+class Snapshot(object):
+    """
+    Point in time view of everything the gateway configuration depends on - the rados
+    config object, the rbd images, krbd mappings and LIO. Each source is read once
+    """
+
+    def __init__(self, config, gateway_iqn, disks, this_host, lio=None):
+        """
+        Gather the current state
+        :param config: Config object (its read of the config object may still be in progress)
+        :param gateway_iqn: iqn of the gateway target
+        :param disks: list of desired disk definitions
+        :param this_host: short hostname of this gateway
+        :param lio: LIOSnapshot to use, instead of walking LIO again
+        :return: snapshot object
+        """
+
+        self.error = False
+        self.error_msg = ''
+
+        cluster = config.ceph.cluster
+
+        # LIO, the krbd mappings and the pools are read while the config read (which the
+        # caller may have started in the background) completes
+        lio_walk = AsyncCall(LIOSnapshot, gateway_iqn) if lio is None else None
+        listing = AsyncCall(list_images, cluster, set(disk['pool'] for disk in disks))
+        self.mapped = krbd.mapped_devices()
+        self.rbdmap = krbd.rbdmap_entries()
+
+        if config.wait().error:
+            self.error = True
+            self.error_msg = config.error_msg
+            return
+
+        self.config = config.config
+        self.live = config.live_gateways()
+        self.lio = lio if lio is not None else lio_walk.result()
+
+        # pool -> set of image names
+        self.images = listing.result()
+        missing = sorted(pool for pool in self.images if self.images[pool] is None)
+        if missing:
+            self.error = True
+            self.error_msg = "Pool '{}' does not exist".format(missing[0])
+            return
+
+        def _image_size(disk):
+            with cluster.open_ioctx(disk['pool']) as ioctx:
+                with rbd.Image(ioctx, disk['image'], read_only=True) as rbd_image:
+                    return rbd_image.size()
+
+        # sizes are only needed for the images this host is responsible for resizing
+        owned = [disk for disk in disks
+                 if disk['host'] == this_host and disk['image'] in self.images[disk['pool']]]
+
+        # (pool, image) -> size in bytes
+        self.sizes = {}
+        for disk, size, err in run_parallel(_image_size, owned):
+            if err:
+                self.error = True
+                self.error_msg = "Unable to read the size of {}/{} : {}".format(disk['pool'],
+                                                                               disk['image'],
+                                                                               err)
+                return
+            self.sizes[(disk['pool'], disk['image'])] = size
+
+
+def list_images(cluster, pools):
+    """
+    :param cluster: connected rados.Rados object
+    :param pools: pool names
+    :return: dict of pool -> set of image names (None for a pool that doesn't exist)
+    """
+
+    images = {}
+    for pool in pools:
+        if not cluster.pool_exists(pool):
+            images[pool] = None
+            continue
+        with cluster.open_ioctx(pool) as ioctx:
+            images[pool] = set(rbd.RBD().list(ioctx))
+
+    return images
+
+
+class Reconciler(object):
+    """
+    Compute and apply the minimal set of changes needed to bring this gateway in line with
+    the desired rbd_devices and client_connections definitions
+    """
+
+    def __init__(self, logger, config, gateway_iqn, disks, clients, this_host, lio=None):
+        """
+        Instantiate the reconciler
+        :param logger: logger object
+        :param config: Config object
+        :param gateway_iqn: iqn of the gateway target
+        :param disks: list of dicts (pool, image, size, host and optionally profile)
+        :param clients: list of dicts (client, image_list, credentials, status and optionally auth)
+        :param this_host: short hostname of this gateway
+        :param lio: current LIOSnapshot, if the caller already holds one
+        :return: reconciler object
+        """
+
+        self.logger = logger
+        self.config = config
+        self.gateway_iqn = gateway_iqn
+        self.disks = disks
+        self.clients = clients
+        self.this_host = this_host
+        self.lio = lio
+
+        self.error = False
+        self.error_msg = ''
+        self.snapshot = None
+        self.plan = []
+        self.timings = {}
+        self.changes = 0
+
+        # per apply state - device paths and config metadata gathered as steps complete
+        self.devices = {}
+        self.disk_meta = {}
+
+    def validate(self):
+        """
+        Check the desired state definitions are usable
+        """
+
+        disk_names = set()
+        for disk in self.disks:
+            missing = [key for key in ['pool', 'image', 'size', 'host'] if key not in disk]
+            if missing:
+                self._fail("rbd_devices entry {} is missing {}".format(disk, missing))
+                return
+            if not valid_size(disk['size']):
+                self._fail("image '{}' has an invalid size '{}' - must be a number suffixed "
+                           "by M, G or T".format(disk['image'], disk['size']))
+                return
+            if disk['image'] in disk_names:
+                # the image name is used as the LUN name in LIO, so it must be unique
+                self._fail("image '{}' is defined more than once".format(disk['image']))
+                return
+            disk_names.add(disk['image'])
+
+        for client in self.clients:
+            if 'client' not in client:
+                self._fail("client_connections entry {} has no 'client' key".format(client))
+                return
+            if client.get('status', 'present') not in ['present', 'absent']:
+                self._fail("client {} has an invalid status '{}'".format(client['client'],
+                                                                         client['status']))
+                return
+
+    def build_plan(self):
+        """
+        Snapshot the current state, and compute the ordered list of steps needed
+        :return: list of Step objects
+        """
+
+        start = time.time()
+        self.validate()
+        if self.error:
+            return []
+
+        self.snapshot = Snapshot(self.config, self.gateway_iqn, self.disks, self.this_host, lio=self.lio)
+        self.timings['snapshot'] = time.time() - start
+        if self.snapshot.error:
+            self._fail(self.snapshot.error_msg)
+            return []
+
+        if self.snapshot.lio.tpg is None:
+            self._fail("gateway target {} is not defined to LIO - run igw_gateway "
+                       "first".format(self.gateway_iqn))
+            return []
+
+        steps = []
+        for disk in self.disks:
+            steps.extend(self._plan_disk(disk))
+        if self.error:
+            return []
+
+        is_update_host = get_update_host(self.snapshot.config, live=self.snapshot.live) == self.this_host
+        for client in self.clients:
+            steps.extend(self._plan_client(client, is_update_host))
+            if self.error:
+                return []
+
+        # NB. disks this host owns are added to LIO (and registered) first, since the other
+        # gateways wait for their owner before setting the alua state
+        steps.sort(key=lambda step: (PHASES.index(step.phase), not step.detail.get('owner_host', True)))
+        self.plan = steps
+        self.timings['plan'] = time.time() - start
+
+        return self.plan
+
+    def _plan_disk(self, disk):
+
+        snap = self.snapshot
+        pool = disk['pool']
+        image = disk['image']
+        owner_host = disk['host'] == self.this_host
+        steps = []
+
+        if image not in snap.images[pool]:
+            # only the 'owning' host creates the image, other hosts wait for it to appear
+            if owner_host:
+                steps.append(Step('create', 'create', image, pool=pool, size=disk['size']))
+        elif owner_host and convert_2_bytes(disk['size']) > snap.sizes[(pool, image)]:
+            steps.append(Step('resize', 'resize', image, pool=pool, size=disk['size']))
+
+        if (pool, image) not in snap.mapped:
+            steps.append(Step('map', 'map', image, pool=pool))
+
+        if '{}/{}'.format(pool, image) not in snap.rbdmap:
+            steps.append(Step('map', 'rbdmap', image, pool=pool))
+
+        disk_cfg = snap.config['disks'].get(image, {})
+        stg_object = snap.lio.storage_objects.get(image)
+        if stg_object is None:
+            steps.append(Step('lio_add', 'add', image, pool=pool, owner_host=owner_host,
+                              wwn=disk_cfg.get('wwn', '')))
+        elif owner_host and not disk_cfg.get('wwn'):
+            # in LIO, but the config object has lost track of it
+            steps.append(Step('config', 'register', image, wwn=stg_object.wwn))
+
+        if disk.get('profile'):
+            attributes = resolve_profile(disk['profile'], snap.config.get('backstore_profiles', {}))
+            if attributes is None:
+                self._fail("tuning profile '{}' requested for image '{}' is not "
+                           "defined".format(disk['profile'], image))
+                return []
+            if stg_object is not None:
+                attributes = dict((attr, attributes[attr]) for attr in attributes
+                                  if stg_object.get_attribute(attr) != str(attributes[attr]))
+            if attributes:
+                steps.append(Step('tune', 'tune', image, profile=disk['profile'], attributes=attributes))
+
+        if image not in snap.lio.tpg_luns:
+            steps.append(Step('tpg_map', 'map', image))
+
+        owner = disk_cfg.get('owner', '')
+        if not owner:
+            # owner is decided when the disk is registered, so the state is resolved at apply time
+            steps.append(Step('alua', 'set', image, state=''))
+        else:
+            desired = 'active' if owner == self.this_host else 'standby'
+            if stg_object is None or alua.alua_differs(alua.get_alua(stg_object), desired):
+                steps.append(Step('alua', 'set', image, state=desired))
+
+        return steps
+
+    def _plan_client(self, client, is_update_host):
+
+        snap = self.snapshot
+        iqn = client['client']
+        acl = snap.lio.acls.get(iqn)
+        steps = []
+
+        if client.get('status', 'present') == 'absent':
+            if acl is not None:
+                steps.append(Step('acl', 'delete', iqn))
+            if is_update_host and iqn in snap.config['clients']:
+                steps.append(Step('config', 'client_delete', iqn))
+            return steps
+
+        image_list = client.get('image_list', [])
+        credentials = client.get('credentials', '')
+        desired_images = set(disk['image'] for disk in self.disks)
+
+        bad_images = [image for image in image_list
+                      if image not in snap.lio.tpg_luns and image not in desired_images]
+        if bad_images:
+            self._fail("non-existent images {} requested for {}".format(bad_images, iqn))
+            return []
+
+        if acl is None:
+            steps.append(Step('acl', 'create', iqn))
+
+        current = snap.lio.mapped_luns.get(iqn, {})
+        for image in image_list:
+            if image not in current:
+                steps.append(Step('acl', 'map_lun', iqn, image=image))
+        for image in current:
+            if image not in image_list:
+                steps.append(Step('acl', 'unmap_lun', iqn, image=image))
+
+        if credentials and client.get('auth', 'chap') == 'chap':
+            user, password = credentials.split('/', 1)
+            if acl is None or acl.chap_userid != user or acl.chap_password != password:
+                steps.append(Step('acl', 'auth', iqn))
+
+        if client.get('profile'):
+            settings = resolve_profile(client['profile'], snap.config.get('client_profiles', {}),
+                                       CLIENT_PROFILES)
+            if settings is None:
+                self._fail("client profile '{}' requested for {} is not defined".format(client['profile'], iqn))
+                return []
+            if acl is not None:
+                settings = pending_client_settings(acl, settings)
+            if settings:
+                steps.append(Step('acl', 'tune', iqn, profile=client['profile'], settings=settings))
+
+        metadata = {"image_list": image_list, "credentials": credentials}
+        if client.get('profile'):
+            metadata['profile'] = client['profile']
+        if is_update_host and snap.config['clients'].get(iqn) != metadata:
+            steps.append(Step('config', 'client', iqn))
+
+        return steps
+
+    def apply(self):
+        """
+        Apply the plan, phase by phase. Config object changes are committed once at the end
+        :return: number of steps applied
+        """
+
+        if self.error:
+            return 0
+
+        self.disk_meta = dict(self.snapshot.config['disks'])
+        self.devices = dict(((pool, image), device)
+                            for (pool, image), device in self.snapshot.mapped.items())
+        disks = dict((disk['image'], disk) for disk in self.disks)
+
+        for phase in PHASES:
+            steps = [step for step in self.plan if step.phase == phase]
+            if not steps:
+                continue
+
+            start = time.time()
+            handler = getattr(self, '_apply_{}'.format(phase))
+            if phase in PARALLEL_PHASES:
+                handler(steps, disks)
+            else:
+                for step in steps:
+                    handler(step, disks)
+                    if self.error:
+                        break
+
+            self.timings['apply_{}'.format(phase)] = time.time() - start
+            if self.error:
+                break
+            self.changes += len(steps)
+
+            if phase == 'lio_add' and self.config.changed:
+                # the disks registered by this host are published straight away, since the
+                # other gateways wait for their owner before setting the alua state
+                self.config.commit('retain')
+                if self.config.error:
+                    self._fail("Unable to commit changes to the config object - "
+                               "{}".format(self.config.error_msg))
+                    break
+
+        if self.config.changed:
+            self.config.commit('retain')
+            if self.config.error:
+                self._fail("Unable to commit changes to the config object - "
+                           "{}".format(self.config.error_msg))
+
+        return self.changes
+
+    def _apply_create(self, steps, disks):
+
+        cluster = self.config.ceph.cluster
+
+        def _create(step):
+            with cluster.open_ioctx(step.detail['pool']) as ioctx:
+                rbd.RBD().create(ioctx, step.item, convert_2_bytes(step.detail['size']),
+                                 features=sum(getattr(rbd, feature) for feature in RBD_FEATURE_LIST),
+                                 old_format=False)
+            self.logger.info("(Reconciler._apply_create) created {}/{}".format(step.detail['pool'],
+                                                                              step.item))
+
+        self._run_parallel(_create, steps)
+
+    def _apply_resize(self, steps, disks):
+
+        cluster = self.config.ceph.cluster
+
+        def _resize(step):
+            with cluster.open_ioctx(step.detail['pool']) as ioctx:
+                with rbd.Image(ioctx, step.item) as rbd_image:
+                    rbd_image.resize(convert_2_bytes(step.detail['size']))
+            self.logger.info("(Reconciler._apply_resize) resized {}/{} to {}".format(step.detail['pool'],
+                                                                                    step.item,
+                                                                                    step.detail['size']))
+
+        self._run_parallel(_resize, steps)
+
+    def _apply_map(self, steps, disks):
+
+        cluster = self.config.ceph.cluster
+        map_steps = [step for step in steps if step.action == 'map']
+
+        def _map(step):
+            pool = step.detail['pool']
+            if step.item not in self.snapshot.images[pool]:
+                # image is created by the owning host, so wait for it to show up
+                def _exists():
+                    with cluster.open_ioctx(pool) as ioctx:
+                        return step.item in rbd.RBD().list(ioctx)
+                if not wait_for(_exists, TIME_OUT_SECS, LOOP_DELAY):
+                    raise RuntimeError("timed out waiting for {}/{} to be created".format(pool, step.item))
+
+            self.devices[(pool, step.item)] = krbd.map_image(pool, step.item)
+            self.logger.info("(Reconciler._apply_map) mapped {}/{}".format(pool, step.item))
+
+        self._run_parallel(_map, map_steps)
+        if self.error:
+            return
+
+        # rbdmap entries (used to map the images at boot time) are written in one update
+        krbd.add_rbdmap_entries(['{}/{}'.format(step.detail['pool'], step.item)
+                                 for step in steps if step.action == 'rbdmap'])
+
+    def _apply_lio_add(self, step, disks):
+
+        image = step.item
+        disk = disks[image]
+        device = self.devices[(disk['pool'], image)]
+        wwn = step.detail['wwn']
+
+        # a wwn already in the config is kept, otherwise it's derived from the rbd image - every
+        # gateway derives the same wwn, so none of them waits for the owning host to publish it
+        register = not wwn and step.detail['owner_host']
+        if not wwn:
+            try:
+                with self.config.ceph.cluster.open_ioctx(disk['pool']) as ioctx:
+                    wwn = derive_wwn(disk['pool'], image, krbd.image_id(ioctx, image, device))
+            except Exception as err:
+                self._fail("unable to read the id of {}/{} : {}".format(disk['pool'], image, err))
+                return
+
+        try:
+            stg_object = rtslib.BlockStorageObject(name=image, dev=device, wwn=wwn)
+        except rtslib_utils.RTSLibError as err:
+            self._fail("failed to add {} to LIO - error({})".format(image, err))
+            return
+
+        alua.set_alua(stg_object, 'standby')
+        self.snapshot.lio.storage_objects[image] = stg_object
+        self.logger.info("(Reconciler._apply_lio_add) added '{}/{}' to LIO".format(disk['pool'], image))
+
+        if register:
+            # first definition of this disk, so the owning host registers it in the config
+            self._register(image, disk['pool'], wwn, disk.get('profile', ''))
+
+    def _apply_tune(self, step, disks):
+
+        stg_object = self.snapshot.lio.storage_objects[step.item]
+        for attr in step.detail['attributes']:
+            value = str(step.detail['attributes'][attr])
+            try:
+                stg_object.set_attribute(attr, value)
+            except rtslib_utils.RTSLibError as err:
+                self.logger.warning("(Reconciler._apply_tune) {} attribute '{}' could not be set to {} - "
+                                    "{}".format(step.item, attr, value, err))
+
+    def _apply_tpg_map(self, step, disks):
+
+        stg_object = self.snapshot.lio.storage_objects[step.item]
+        try:
+            self.snapshot.lio.tpg_luns[step.item] = rtslib_target.LUN(self.snapshot.lio.tpg,
+                                                        lun=lun_id(stg_object),
+                                                        storage_object=stg_object)
+        except rtslib_utils.RTSLibError as err:
+            self._fail("failed to map {} to the tpg - error({})".format(step.item, err))
+
+    def _apply_acl(self, step, disks):
+
+        lio = self.snapshot.lio
+        iqn = step.item
+
+        try:
+            if step.action == 'create':
+                lio.acls[iqn] = rtslib_target.NodeACL(lio.tpg, iqn)
+                lio.mapped_luns[iqn] = {}
+
+            elif step.action == 'delete':
+                lio.acls[iqn].delete()
+
+            elif step.action == 'map_lun':
+                mapped = lio.mapped_luns[iqn]
+                lun_ids = LunIdAllocator(in_use=[m_lun.mapped_lun for m_lun in mapped.values()])
+                new_id = lun_ids.allocate()
+                if new_id is None:
+                    self._fail("no LUN ids left to map {} to {}".format(step.detail['image'], iqn))
+                    return
+                mapped[step.detail['image']] = lio.acls[iqn].mapped_lun(new_id,
+                                                                       tpg_lun=lio.tpg_luns[step.detail['image']])
+
+            elif step.action == 'unmap_lun':
+                lio.mapped_luns[iqn].pop(step.detail['image']).delete()
+
+            elif step.action == 'auth':
+                user, password = self._client(iqn).get('credentials', '').split('/', 1)
+                lio.acls[iqn].chap_userid = user
+                lio.acls[iqn].chap_password = password
+
+            elif step.action == 'tune':
+                _, failed = apply_client_profile(lio.acls[iqn], step.detail['settings'])
+                for name in failed:
+                    self.logger.warning("(Reconciler._apply_acl) {} '{}' could not be set - "
+                                        "{}".format(iqn, name, failed[name]))
+
+        except rtslib_utils.RTSLibError as err:
+            self._fail("ACL {} for {} failed - error({})".format(step.action, iqn, err))
+            return
+
+        self.logger.info("(Reconciler._apply_acl) {} {} {}".format(step.action, iqn,
+                                                                   step.detail.get('image', '')))
+
+    def _apply_alua(self, step, disks):
+
+        owner = self.disk_meta.get(step.item, {}).get('owner', '')
+        if not owner:
+            # a new disk is registered by its owning host - this is the only step that waits for it
+            owner = wait_for(lambda: self.config.get_config()['disks'].get(step.item, {}).get('owner', ''),
+                             TIME_OUT_SECS, LOOP_DELAY)
+        if not owner:
+            self._fail("unable to set the alua state of {} - no owner defined".format(step.item))
+            return
+
+        desired = 'active' if owner == self.this_host else 'standby'
+        alua.set_alua(self.snapshot.lio.storage_objects[step.item], desired)
+        self.logger.info("(Reconciler._apply_alua) alua state for {} set to {}".format(step.item, desired))
+
+    def _apply_config(self, step, disks):
+
+        if step.action == 'register':
+            self._register(step.item, disks[step.item]['pool'], step.detail['wwn'],
+                           disks[step.item].get('profile', ''))
+        elif step.action == 'client':
+            client = self._client(step.item)
+            metadata = {"image_list": client.get('image_list', []),
+                        "credentials": client.get('credentials', '')}
+            if client.get('profile'):
+                metadata['profile'] = client['profile']
+            self.config.update_item('clients', step.item, metadata)
+        elif step.action == 'client_delete':
+            self.config.del_item('clients', step.item)
+
+    def _register(self, image, pool, wwn, profile):
+        """
+        Record a disk's wwn and owner in the config object, balancing the active paths
+        across the gateways and spreading each client's LUNs
+        """
+
+        clients = desired_clients(self.config.config['clients'], self.clients)
+
+        try:
+            owner = set_owner(self.config.config['gateways'], live=self.snapshot.live, image=image,
+                              disks=self.config.config['disks'], clients=clients)
+        except PlacementError as err:
+            self._fail(str(err))
+            return
+
+        disk_attr = {"wwn": wwn, "owner": owner, "pool": pool}
+        if profile:
+            disk_attr['profile'] = profile
+        self.config.update_item('disks', image, disk_attr)
+        self.disk_meta[image] = disk_attr
+
+        gateway_dict = self.config.config['gateways'][owner]
+        gateway_dict['active_luns'] += 1
+        self.config.update_item('gateways', owner, gateway_dict)
+        self.logger.debug("(Reconciler._register) registered '{}' with wwn '{}', owner {}".format(image,
+                                                                                                wwn,
+                                                                                                owner))
+
+    def _client(self, iqn):
+        return [client for client in self.clients if client['client'] == iqn][0]
+
+    def _run_parallel(self, func, steps):
+
+        for step, _, err in run_parallel(func, steps):
+            if err:
+                self.logger.error("(Reconciler) {} of {} failed : {}".format(step.action, step.item, err))
+                self._fail("{} of {} failed".format(step.action, step.item))
+
+    def _fail(self, msg):
+        self.error = True
+        if not self.error_msg:
+            self.error_msg = msg
+        self.logger.error("(Reconciler) {}".format(msg))
+
@@ -0,0 +1,358 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import logging
+import socket
+import sys
+import time
+
+from logging.handlers import RotatingFileHandler
+
+from ceph_iscsi_gw import alua, krbd
+from ceph_iscsi_gw.allocator import LunIdAllocator
+from ceph_iscsi_gw.common import Config, CONFIG_NAME, CONFIG_POOL
+from ceph_iscsi_gw.lio import LIOSnapshot, lun_id
+from ceph_iscsi_gw.profiles import (CLIENT_PROFILES, TPG_PROFILES, apply_attributes, apply_client_profile,
+                                    apply_tpg_profile, resolve_profile)
+from ceph_iscsi_gw.utils import LazyModule, run_parallel
+
+rtslib = LazyModule('rtslib_fb')
+rtslib_fabric = LazyModule('rtslib_fb.fabric')
+rtslib_target = LazyModule('rtslib_fb.target')
+rtslib_utils = LazyModule('rtslib_fb.utils')
+
+LOG_FILE = '/var/log/igw-restore.log'
+
+# pool of disks registered before the config recorded each disk's pool
+RBD_POOL = 'rbd'
+
+# images mapped concurrently - each map is an 'rbd map' call, waiting on the cluster
+MAP_WORKERS = 16
+
+# phases of a restore, in the order they run
+PHASES = ['config', 'map', 'backstores', 'target', 'luns', 'acls', 'alua', 'enable']
+
+
+class GatewayRestore(object):
+    """
+    Rebuild this gateway's krbd mappings and LIO configuration from the config object
+    alone, e.g. at boot. Anything already in place is kept, so the restore can be rerun
+    """
+
+    def __init__(self, logger, this_host, pool=CONFIG_POOL, cfg_name=CONFIG_NAME, workers=MAP_WORKERS):
+        """
+        Instantiate the restore
+        :param logger: logger object
+        :param this_host: short hostname of this gateway
+        :param pool: pool holding the config object
+        :param cfg_name: config object name
+        :param workers: number of images mapped concurrently
+        :return: restore object
+        """
+
+        self.logger = logger
+        self.this_host = this_host
+        self.pool = pool
+        self.cfg_name = cfg_name
+        self.workers = workers
+
+        self.error = False
+        self.error_msg = ''
+        self.timings = {}
+        # phase -> number of items it restored (or, for config, read)
+        self.counts = {}
+        # image name (or client iqn) -> reason, for the parts that could not be restored
+        self.failed = {}
+
+        self.config = {}
+        self.disks = {}
+        self.devices = {}
+        self.lio = None
+
+    def run(self):
+        """
+        Run each restore phase in turn, timing them
+        :return: Boolean - True if everything was restored
+        """
+
+        for phase in PHASES:
+            start = time.time()
+            getattr(self, '_restore_{}'.format(phase))()
+            self.timings[phase] = time.time() - start
+            self.logger.info("(GatewayRestore.run) {} phase complete ({:.3f}s)".format(phase,
+                                                                                      self.timings[phase]))
+            if self.error:
+                break
+
+        return not self.error and not self.failed
+
+    def _restore_config(self):
+
+        # at boot the agent isn't running yet, so the config is read directly - once
+        config = Config(self.logger, cfg_name=self.cfg_name, pool=self.pool, use_agent=False)
+        if config.ceph:
+            config.ceph.shutdown()
+        if config.error:
+            self._fail("unable to read {}/{} - {}".format(self.pool, self.cfg_name, config.error_msg))
+            return
+
+        self.config = config.config
+        if self.this_host not in self.config['gateways']:
+            self._fail("{} is not a gateway in {}/{}".format(self.this_host, self.pool, self.cfg_name))
+            return
+
+        # every gateway exports every disk - the owner just decides where the active path is
+        self.disks = self.config['disks']
+        self.counts['config'] = len(self.disks)
+
+    def _restore_map(self):
+
+        mapped = krbd.mapped_devices()
+        wanted = sorted((self.disks[image].get('pool', RBD_POOL), image) for image in self.disks)
+
+        for spec in wanted:
+            if spec in mapped:
+                self.devices[spec[1]] = mapped[spec]
+
+        def _map(spec):
+            return krbd.map_image(*spec)
+
+        to_map = [spec for spec in wanted if spec not in mapped]
+        for (pool, image), device, err in run_parallel(_map, to_map, workers=self.workers):
+            if err:
+                self.failed[image] = "map failed : {}".format(err.strip().splitlines()[-1])
+                self.logger.error("(GatewayRestore._restore_map) unable to map {}/{} : {}".format(pool, image, err))
+                continue
+            self.devices[image] = device
+
+        self.counts['map'] = len(to_map) - len([spec for spec in to_map if spec[1] in self.failed])
+
+    def _restore_backstores(self):
+
+        self.lio = LIOSnapshot(self.config['gateways'].get('iqn'))
+        profiles = self.config.get('backstore_profiles', {})
+        created = 0
+
+        # created in name order, so the LIO index (and so the tpg LUN id) of each disk
+        # follows the same order on every gateway
+        for image in sorted(self.devices):
+            disk_attr = self.disks[image]
+            stg_object = self.lio.storage_objects.get(image)
+
+            if stg_object is None:
+                wwn = disk_attr.get('wwn')
+                if not wwn:
+                    self.logger.warning("(GatewayRestore._restore_backstores) {} has no wwn in the "
+                                        "config - LIO will generate one".format(image))
+                try:
+                    stg_object = rtslib.BlockStorageObject(name=image, dev=self.devices[image],
+                                                           wwn=wwn if wwn else None)
+                except rtslib_utils.RTSLibError as err:
+                    self.failed[image] = "backstore failed : {}".format(err)
+                    continue
+                self.lio.storage_objects[image] = stg_object
+                created += 1
+
+            if disk_attr.get('profile'):
+                attributes = resolve_profile(disk_attr['profile'], profiles)
+                if attributes is None:
+                    self.logger.warning("(GatewayRestore._restore_backstores) profile '{}' of {} is not "
+                                        "defined".format(disk_attr['profile'], image))
+                    continue
+                _, failed = apply_attributes(stg_object, attributes)
+                for attr in failed:
+                    self.logger.warning("(GatewayRestore._restore_backstores) {} attribute '{}' could not "
+                                        "be set - {}".format(image, attr, failed[attr]))
+
+        self.counts['backstores'] = created
+
+    def _restore_target(self):
+
+        iqn = self.config['gateways'].get('iqn')
+        if not iqn:
+            self._fail("no gateway iqn defined in {}/{}".format(self.pool, self.cfg_name))
+            return
+
+        gateway = self.config['gateways'][self.this_host]
+        portal_ips = gateway.get('portal_ip_addresses') or [gateway.get('portal_ip_address', '')]
+
+        try:
+            if self.lio.target is None:
+                self.lio.target = rtslib_target.Target(rtslib_fabric.ISCSIFabricModule(), wwn=iqn)
+            if self.lio.tpg is None:
+                # the tpg is enabled once the LUNs, ACLs and ALUA states are in place
+                self.lio.tpg = rtslib_target.TPG(self.lio.target, tag=1)
+
+            current = set(portal.ip_address for portal in self.lio.tpg.network_portals)
+            for ip_address in portal_ips:
+                if ip_address and ip_address not in current:
+                    rtslib_target.NetworkPortal(self.lio.tpg, ip_address)
+        except rtslib_utils.RTSLibError as err:
+            self._fail("unable to define the target {} - {}".format(iqn, err))
+            return
+
+        if gateway.get('tpg_profile'):
+            settings = resolve_profile(gateway['tpg_profile'], self.config.get('tpg_profiles', {}), TPG_PROFILES)
+            if settings is None:
+                self.logger.warning("(GatewayRestore._restore_target) tpg profile '{}' is not "
+                                    "defined".format(gateway['tpg_profile']))
+                return
+            _, failed = apply_tpg_profile(self.lio.tpg, settings)
+            for name in failed:
+                self.logger.warning("(GatewayRestore._restore_target) tpg '{}' could not be set - "
+                                    "{}".format(name, failed[name]))
+
+    def _restore_luns(self):
+
+        added = 0
+        for image in sorted(self.lio.storage_objects):
+            if image not in self.disks or image in self.lio.tpg_luns:
+                continue
+            stg_object = self.lio.storage_objects[image]
+            try:
+                self.lio.tpg_luns[image] = rtslib_target.LUN(self.lio.tpg, lun=lun_id(stg_object),
+                                                             storage_object=stg_object)
+                added += 1
+            except rtslib_utils.RTSLibError as err:
+                self.failed[image] = "tpg LUN failed : {}".format(err)
+
+        self.counts['luns'] = added
+
+    def _restore_acls(self):
+
+        created = 0
+        for iqn in sorted(self.config['clients']):
+            client = self.config['clients'][iqn]
+            try:
+                acl = self.lio.acls.get(iqn)
+                if acl is None:
+                    acl = rtslib_target.NodeACL(self.lio.tpg, iqn)
+                    self.lio.acls[iqn] = acl
+                    self.lio.mapped_luns[iqn] = {}
+                    created += 1
+
+                credentials = client.get('credentials', '')
+                if credentials:
+                    user, password = credentials.split('/', 1)
+                    if acl.chap_userid != user or acl.chap_password != password:
+                        acl.chap_userid = user
+                        acl.chap_password = password
+
+                if client.get('profile'):
+                    settings = resolve_profile(client['profile'], self.config.get('client_profiles', {}),
+                                               CLIENT_PROFILES)
+                    if settings is None:
+                        self.logger.warning("(GatewayRestore._restore_acls) profile '{}' of {} is not "
+                                            "defined".format(client['profile'], iqn))
+                    else:
+                        _, failed = apply_client_profile(acl, settings)
+                        for name in failed:
+                            self.logger.warning("(GatewayRestore._restore_acls) {} '{}' could not be set - "
+                                                "{}".format(iqn, name, failed[name]))
+
+                # LUN ids are allocated in image_list order, as they were when the client was
+                # defined, so the client sees the same LUN numbers after the restore
+                mapped = self.lio.mapped_luns[iqn]
+                lun_ids = LunIdAllocator(in_use=[m_lun.mapped_lun for m_lun in mapped.values()])
+                for image in client.get('image_list', []):
+                    if image in mapped:
+                        continue
+                    if image not in self.lio.tpg_luns:
+                        self.failed.setdefault(image, "not available to map to {}".format(iqn))
+                        continue
+                    mapped[image] = acl.mapped_lun(lun_ids.allocate(), tpg_lun=self.lio.tpg_luns[image])
+
+            except rtslib_utils.RTSLibError as err:
+                self.failed[iqn] = "ACL failed : {}".format(err)
+
+        self.counts['acls'] = created
+
+    def _restore_alua(self):
+
+        luns = dict((image, self.lio.storage_objects[image]) for image in self.lio.tpg_luns
+                    if image in self.disks)
+
+        # a disk without an owner stays on standby until one is assigned
+        desired = dict((image, 'active' if self.disks[image].get('owner') == self.this_host else 'standby')
+                       for image in luns)
+
+        current = alua.snapshot_alua(luns)
+        transitions = alua.plan_alua(current, desired)
+        _, failed = alua.apply_alua(luns, transitions, current)
+        for image in failed:
+            self.failed[image] = "alua failed : {}".format(failed[image])
+
+        self.counts['alua'] = len(transitions) - len(failed)
+
+    def _restore_enable(self):
+
+        if not self.lio.tpg.enable:
+            self.lio.tpg.enable = True
+
+    def summary(self):
+        return {"host": self.this_host,
+                "restored": not self.error and not self.failed,
+                "error": self.error_msg,
+                "failed": self.failed,
+                "counts": self.counts,
+                "timings": dict((phase, round(secs, 3)) for phase, secs in self.timings.items())}
+
+    def _fail(self, msg):
+        self.error = True
+        self.error_msg = msg
+        self.logger.error("(GatewayRestore) {}".format(msg))
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="restore the iSCSI gateway's rbd mappings and LIO "
+                                                 "configuration from the config object")
+    parser.add_argument('--pool', default=CONFIG_POOL, help="pool holding the gateway group's config object")
+    parser.add_argument('--config-name', default=CONFIG_NAME, help="config object name")
+    parser.add_argument('--workers', type=int, default=MAP_WORKERS, help="images mapped concurrently")
+    parser.add_argument('--json', action='store_true', help="print the summary as json")
+    args = parser.parse_args()
+
+    logger = logging.getLogger('igw-restore')
+    logger.setLevel(logging.DEBUG)
+    handler = RotatingFileHandler(LOG_FILE,
+                                  maxBytes=5242880,
+                                  backupCount=7)
+    log_fmt = logging.Formatter('%(asctime)s %(name)s %(levelname)-8s : %(message)s')
+    handler.setFormatter(log_fmt)
+    logger.addHandler(handler)
+
+    this_host = socket.gethostname().split('.')[0]
+    logger.info("START - restore of {} from {}/{}".format(this_host, args.pool, args.config_name))
+    start = time.time()
+
+    restore = GatewayRestore(logger, this_host, pool=args.pool, cfg_name=args.config_name,
+                             workers=args.workers)
+    restored = restore.run()
+    summary = restore.summary()
+    summary['timings']['total'] = round(time.time() - start, 3)
+
+    logger.info("END   - restore of {} {} ({:.3f}s)".format(this_host, 'complete' if restored else 'FAILED',
+                                                            summary['timings']['total']))
+
+    if args.json:
+        print(json.dumps(summary, indent=2, sort_keys=True))
+    else:
+        print("restore of {} {}".format(this_host, 'complete' if restored else 'FAILED'))
+        if summary['error']:
+            print("  error : {}".format(summary['error']))
+        for name in sorted(summary['failed']):
+            print("  {} : {}".format(name, summary['failed'][name]))
+        for phase in PHASES:
+            if phase in summary['timings']:
+                print("  {:<11} {:8.3f}s  {}".format(phase, summary['timings'][phase],
+                                                     summary['counts'].get(phase, '')))
+        print("  {:<11} {:8.3f}s".format('total', summary['timings']['total']))
+
+    sys.exit(0 if restored else 1)
+
+
+if __name__ == '__main__':
+
+    main()
@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+
+import glob
+import os
+
+from ceph_iscsi_gw.utils import LazyModule
+
+netaddr = LazyModule('netaddr')
+netifaces = LazyModule('netifaces')
+
+# sysctls applied by a profile are also written here, so they survive a reboot
+SYSCTL_FILE = '/etc/sysctl.d/90-igw-tune.conf'
+
+CPU_ONLINE = '/sys/devices/system/cpu/online'
+
+# keys a host profile may use
+#   mtu          - MTU of each portal interface
+#   sysctl       - dict of sysctl name -> value
+#   irq_affinity - 'spread' pins each portal NIC irq to its own cpu (round robin)
+#   rps          - cpus steering received packets of the portal interfaces; 'all' or a hex cpu mask
+#   block        - queue settings of each mapped rbd device
+PROFILE_KEYS = ['mtu', 'sysctl', 'irq_affinity', 'rps', 'block']
+
+# rbd device queue settings. scheduler may list several schedulers (comma separated) - the
+# first one the device offers is used (e.g. 'noop' for a single queue device, 'none' for blk-mq)
+BLOCK_SETTINGS = ['nr_requests', 'read_ahead_kb', 'scheduler']
+
+# Built-in host profiles. NB. mtu is left out, since a larger MTU must also be configured
+# on the switches and the initiators
+HOST_PROFILES = {
+    "default": {},
+    "throughput": {"sysctl": {"net.core.rmem_max": 16777216,
+                              "net.core.wmem_max": 16777216,
+                              "net.ipv4.tcp_rmem": "4096 87380 16777216",
+                              "net.ipv4.tcp_wmem": "4096 65536 16777216",
+                              "net.core.netdev_max_backlog": 30000},
+                   "irq_affinity": "spread",
+                   "rps": "all",
+                   "block": {"nr_requests": 256,
+                             "read_ahead_kb": 4096,
+                             "scheduler": "noop,none"}}
+}
+
+
+def invalid_settings(profile):
+    """
+    Check the content of a host profile
+    :param profile: dict (see PROFILE_KEYS)
+    :return: list of problems (str) ... should be empty!
+    """
+
+    problems = ["unknown key '{}'".format(key) for key in profile if key not in PROFILE_KEYS]
+
+    if 'irq_affinity' in profile and profile['irq_affinity'] != 'spread':
+        problems.append("irq_affinity must be 'spread'")
+
+    if 'rps' in profile and profile['rps'] != 'all':
+        try:
+            int(str(profile['rps']), 16)
+        except ValueError:
+            problems.append("rps must be 'all' or a hex cpu mask")
+
+    problems.extend("unknown block setting '{}'".format(name)
+                    for name in profile.get('block', {}) if name not in BLOCK_SETTINGS)
+
+    return problems
+
+
+def parse_cpu_list(cpu_list):
+    """
+    :param cpu_list: kernel cpu list e.g. '0-3,6'
+    :return: sorted list of cpu numbers
+    """
+
+    cpus = set()
+    for part in cpu_list.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-')
+            cpus.update(range(int(first), int(last) + 1))
+        else:
+            cpus.add(int(part))
+
+    return sorted(cpus)
+
+
+def online_cpus():
+    with open(CPU_ONLINE) as cpu_file:
+        return parse_cpu_list(cpu_file.read())
+
+
+def portal_interfaces(iscsi_networks):
+    """
+    Find the interfaces carrying the portal IPs
+    :param iscsi_networks: list of network subnets (CIDR) or interface names
+    :return: dict of network -> interface name ('' if this host has no interface on it)
+    """
+
+    interfaces = {}
+    for network in iscsi_networks:
+        interfaces[network] = ''
+        if '/' not in network:
+            if network in netifaces.interfaces():
+                interfaces[network] = network
+            continue
+
+        subnet = netaddr.IPNetwork(network)
+        for iface in netifaces.interfaces():
+            addresses = [link['addr'] for link in netifaces.ifaddresses(iface).get(netifaces.AF_INET, [])]
+            if any(netaddr.IPAddress(addr) in subnet for addr in addresses):
+                interfaces[network] = iface
+                break
+
+    return interfaces
+
+
+def _read(path):
+    with open(path) as sys_file:
+        return sys_file.read().strip()
+
+
+def _setting(name, path, desired, current=None, write=None):
+    return {"setting": name,
+            "path": path,
+            "desired": str(desired),
+            "current": current,
+            "write": str(desired) if write is None else write}
+
+
+def _plain(path, name, desired):
+    """
+    Compare a sysfs/procfs value with the desired value (whitespace is normalised, so
+    'a  b' matches 'a b')
+    """
+
+    try:
+        current = ' '.join(_read(path).split())
+    except (IOError, OSError) as err:
+        return _setting(name, path, desired, current="unreadable - {}".format(err))
+
+    if current != ' '.join(str(desired).split()):
+        return _setting(name, path, desired, current=current)
+    return None
+
+
+def _scheduler(path, name, desired):
+
+    try:
+        offered = _read(path).split()
+    except (IOError, OSError) as err:
+        return _setting(name, path, desired, current="unreadable - {}".format(err), write='')
+
+    current = [sched.strip('[]') for sched in offered if sched.startswith('[')]
+    available = [sched.strip('[]') for sched in offered]
+    wanted = [sched for sched in desired.split(',') if sched in available]
+    if not wanted:
+        return _setting(name, path, desired, current="{} (none of {} offered)".format(' '.join(offered), desired),
+                        write='')
+
+    if current != wanted[:1]:
+        return _setting(name, path, wanted[0], current=current[0] if current else '')
+    return None
+
+
+def _cpu_mask(path, name, desired_mask):
+
+    try:
+        current = int(_read(path).replace(',', ''), 16)
+    except (IOError, OSError, ValueError) as err:
+        return _setting(name, path, format(desired_mask, 'x'), current="unreadable - {}".format(err))
+
+    if current != desired_mask:
+        return _setting(name, path, format(desired_mask, 'x'), current=format(current, 'x'))
+    return None
+
+
+def _irq_cpu(path, name, cpu):
+
+    try:
+        current = parse_cpu_list(_read(path))
+    except (IOError, OSError, ValueError) as err:
+        return _setting(name, path, cpu, current="unreadable - {}".format(err))
+
+    if current != [cpu]:
+        return _setting(name, path, cpu, current=','.join(str(num) for num in current))
+    return None
+
+
+def nic_irqs(iface):
+    """
+    :param iface: interface name
+    :return: sorted list of the NIC's (msi) irq numbers - empty for virtual interfaces
+    """
+
+    return sorted(int(os.path.basename(irq))
+                  for irq in glob.glob('/sys/class/net/{}/device/msi_irqs/*'.format(iface)))
+
+
+def plan(profile, interfaces, devices):
+    """
+    Compare the host with a profile
+    :param profile: host profile dict
+    :param interfaces: list of portal interface names
+    :param devices: list of mapped rbd device paths e.g. ['/dev/rbd0']
+    :return: list of dicts (setting, path, current, desired and write) - one for each value
+             that differs from the profile
+    """
+
+    differences = []
+
+    for iface in interfaces:
+        if 'mtu' in profile:
+            differences.append(_plain('/sys/class/net/{}/mtu'.format(iface), "{} mtu".format(iface),
+                                      profile['mtu']))
+
+        if profile.get('irq_affinity') == 'spread':
+            cpus = online_cpus()
+            for num, irq in enumerate(nic_irqs(iface)):
+                differences.append(_irq_cpu('/proc/irq/{}/smp_affinity_list'.format(irq),
+                                            "{} irq {} cpu".format(iface, irq), cpus[num % len(cpus)]))
+
+        if 'rps' in profile:
+            if profile['rps'] == 'all':
+                mask = sum(1 << cpu for cpu in online_cpus())
+            else:
+                mask = int(str(profile['rps']), 16)
+            for rx_queue in sorted(glob.glob('/sys/class/net/{}/queues/rx-*'.format(iface))):
+                differences.append(_cpu_mask(os.path.join(rx_queue, 'rps_cpus'),
+                                             "{} {} rps_cpus".format(iface, os.path.basename(rx_queue)), mask))
+
+    for name in sorted(profile.get('sysctl', {})):
+        differences.append(_plain(os.path.join('/proc/sys', name.replace('.', '/')), "sysctl {}".format(name),
+                                  profile['sysctl'][name]))
+
+    block = profile.get('block', {})
+    for device in sorted(devices):
+        queue_dir = '/sys/block/{}/queue'.format(os.path.basename(device))
+        for name in BLOCK_SETTINGS:
+            if name not in block:
+                continue
+            path = os.path.join(queue_dir, name)
+            setting = "{} {}".format(os.path.basename(device), name)
+            if name == 'scheduler':
+                differences.append(_scheduler(path, setting, block[name]))
+            else:
+                differences.append(_plain(path, setting, block[name]))
+
+    if profile.get('sysctl'):
+        content = sysctl_conf(profile['sysctl'])
+        try:
+            with open(SYSCTL_FILE) as conf:
+                current = conf.read()
+        except (IOError, OSError):
+            current = ''
+        if current != content:
+            differences.append(_setting("sysctl persistence", SYSCTL_FILE, '{} sysctls'.format(len(profile['sysctl'])),
+                                        current='differs' if current else 'missing', write=content))
+
+    return [diff for diff in differences if diff is not None]
+
+
+def sysctl_conf(sysctls):
+    return ''.join("{} = {}\n".format(name, sysctls[name]) for name in sorted(sysctls))
+
+
+def apply(differences):
+    """
+    Write the desired values
+    :param differences: list from plan()
+    :return: (list of setting names changed, dict of setting name -> error for failures)
+    """
+
+    changed = []
+    failed = {}
+
+    for diff in differences:
+        if not diff['write']:
+            failed[diff['setting']] = "cannot be set - {}".format(diff['current'])
+            continue
+        try:
+            with open(diff['path'], 'w') as sys_file:
+                sys_file.write(diff['write'])
+            changed.append(diff['setting'])
+        except (IOError, OSError) as err:
+            failed[diff['setting']] = str(err)
+
+    return changed, failed
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+
+import importlib
+import threading
+import time
+import traceback
+
+SIZE_SUFFIXES = ['M', 'G', 'T']
+
+
+class LazyModule(object):
+    """
+    Stand-in for a module that is only imported when one of its attributes is first used.
+    Keeps the heavy dependencies (rados, rbd, rtslib etc) off the start up path of code
+    that may never need them
+    """
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        if self._module is None:
+            self.__dict__['_module'] = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+
+def convert_2_bytes(disk_size):
+    """
+    Convert a size string to bytes
+    :param disk_size: size (str) of the form nX - where n is an int, and X the unit M, G, T
+    :return: size in bytes (int)
+    """
+    power = [2, 3, 4]
+    unit = disk_size[-1].upper()
+    offset = SIZE_SUFFIXES.index(unit)
+    value = int(disk_size[:-1])     # already validated, so no need for try/except clause
+
+    _bytes = value*(1024**power[offset])
+
+    return _bytes
+
+
+def valid_size(size):
+    """
+    Confirm a size string is usable by convert_2_bytes
+    :param size: size (str) of the form nX - where n is an int, and X the unit M, G, T
+    :return: Boolean
+    """
+    valid = True
+    unit = size[-1]
+
+    if unit.upper() not in SIZE_SUFFIXES:
+        valid = False
+    else:
+        try:
+            value = int(size[:-1])
+        except ValueError:
+            valid = False
+
+    return valid
+
+
+def run_parallel(func, items, workers=8):
+    """
+    Run a function against each item in a list using a pool of threads. Intended for
+    I/O bound work (librados calls, rbd CLI calls etc) where the items are independent
+    :param func: function accepting a single item
+    :param items: list of items to process
+    :param workers: maximum number of concurrent threads
+    :return: list of (item, result, error) tuples in the same order as items - error is
+             the formatted exception (str) when the call failed, otherwise ''
+    """
+
+    def _call(item):
+        try:
+            return item, func(item), ''
+        except Exception:
+            return item, None, traceback.format_exc()
+
+    if not items:
+        return []
+
+    if len(items) == 1 or workers <= 1:
+        return [_call(item) for item in items]
+
+    # plain threads rather than multiprocessing's ThreadPool - shutting a ThreadPool down
+    # costs ~0.1s, which adds up when callers run many small batches
+    results = [None] * len(items)
+    pending = iter(range(len(items)))
+    pending_lock = threading.Lock()
+
+    def _worker():
+        while True:
+            with pending_lock:
+                ptr = next(pending, None)
+            if ptr is None:
+                return
+            results[ptr] = _call(items[ptr])
+
+    threads = [threading.Thread(target=_worker) for _ in range(min(workers, len(items)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return results
+
+
+class AsyncCall(object):
+    """
+    Call a function in a background thread, starting straight away - so independent I/O
+    (a config read, a pool listing, a walk of LIO) can overlap, and be joined when the
+    result is needed
+    """
+
+    def __init__(self, func, *args, **kwargs):
+        """
+        Start the call
+        :param func: function to call
+        :param args: positional arguments for func
+        :param kwargs: keyword arguments for func
+        :return: AsyncCall object
+        """
+
+        self._result = None
+        self._error = None
+        self.traceback = ''
+
+        self._thread = threading.Thread(target=self._run, args=(func, args, kwargs))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, func, args, kwargs):
+        try:
+            self._result = func(*args, **kwargs)
+        except Exception as err:
+            self._error = err
+            self.traceback = traceback.format_exc()
+
+    def done(self):
+        return not self._thread.is_alive()
+
+    def result(self):
+        """
+        Wait for the call to complete
+        :return: the function's return value - any exception it raised is raised here
+        """
+
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+def wait_for(predicate, timeout, delay):
+    """
+    Poll a function until it returns a True value, or the timeout expires
+    :param predicate: function with no arguments
+    :param timeout: seconds to wait in total
+    :param delay: seconds to wait between calls
+    :return: the last value returned by predicate
+    """
+
+    waited = 0
+    result = predicate()
+    while not result and waited < timeout:
+        time.sleep(delay)
+        waited += delay
+        result = predicate()
+
+    return result
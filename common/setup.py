@@ -28,7 +28,15 @@ setup(
     license = "GPLv3",
     packages = [
         "ceph_iscsi_gw"
-        ]
+        ],
+    entry_points = {
+        "console_scripts": [
+            "igw-agent = ceph_iscsi_gw.agent:main",
+            "igw-restore = ceph_iscsi_gw.restore:main",
+            "igw-query = ceph_iscsi_gw.query:main",
+            "igw-profile-report = ceph_iscsi_gw.profile_report:main"
+            ]
+        }
     #scripts = [
     #    'igw_config.py'
     #]
@@ -4,15 +4,42 @@ __author__ = 'pcuzner@redhat.com'
 
 
 import logging
+import os
 from socket import gethostname
 from logging.handlers import RotatingFileHandler
-from ansible.module_utils.basic import *
+from ansible.module_utils.basic import AnsibleModule
 
-import rtslib_fb.root as lio_root
-from rtslib_fb.target import NodeACL, TPG
-from rtslib_fb.utils import RTSLibError
+from ceph_iscsi_gw.common import Config, CONFIG_ARGS
+from ceph_iscsi_gw.fingerprint import RunFingerprint, verify_requested
+from ceph_iscsi_gw.placement import get_update_host
+from ceph_iscsi_gw.allocator import LunIdAllocator
+from ceph_iscsi_gw.profiles import (CLIENT_PROFILES, CLIENT_SETTINGS, invalid_attributes,
+                                    resolve_profile, apply_client_profile)
+from ceph_iscsi_gw.profiling import run_main
+from ceph_iscsi_gw.utils import LazyModule
+
+# rtslib is only loaded when LIO is actually needed (not on a fingerprint match)
+lio_root = LazyModule('rtslib_fb.root')
+rtslib_target = LazyModule('rtslib_fb.target')
+rtslib_utils = LazyModule('rtslib_fb.utils')
+
+
+class LIOState(object):
+    """
+    Snapshot of the LIO objects a client definition depends on. The snapshot is taken once
+    and shared across all the clients processed by a module run
+    """
+
+    def __init__(self):
+
+        r = lio_root.RTSRoot()
+
+        # NB. The solution supports only a single tpg definition, so simply grabbing the
+        # first tpg is fine. If multiple tpgs are required this will need more work
+        self.tpg = next(r.tpgs, None)
+        self.tpg_luns = get_images(self.tpg) if self.tpg else {}
+        self.acls = dict((acl.node_wwn, acl) for acl in r.node_acls)
 
-from ceph_iscsi_gw.common import Config
 
 class Client(object):
     """
@@ -21,13 +48,17 @@ class Client(object):
 
     supported_access_types = ['chap']
 
-    def __init__(self, client_iqn, image_list, auth_type, credentials):
+    def __init__(self, client_iqn, image_list, auth_type, credentials, lio_state=None,
+                 profile='', profile_settings=None):
         """
         Instantiate an instance of an LIO client
         :param client_iqn: iscsi iqn string
         :param image_list: list of rbd images to attach to this client
         :param auth_type: authentication type - null or chap
         :param credentials: chap credentials in the format 'user/password'
+        :param lio_state: LIOState object to (re)use, when multiple clients are processed
+        :param profile: name of the client's tuning profile ('' for none)
+        :param profile_settings: dict of client setting name -> value for the profile
         :return:
         """
 
@@ -35,13 +66,16 @@ class Client(object):
         self.requested_images = image_list
         self.auth_type = auth_type              # auth ... '' or chap
         self.credentials = credentials          # parameters for auth
+        self.profile = profile
+        self.profile_settings = profile_settings if profile_settings else {}
         self.acl = None
         self.error = False
         self.error_msg = ''
         self.client_luns = {}
         self.tpg = None
-        self.tpg_luns = {}
-        self.lun_id_list = range(256)           # available LUN ids 0..255
+        self.lio = lio_state if lio_state else LIOState()
+        self.tpg_luns = self.lio.tpg_luns
+        self.lun_ids = LunIdAllocator()
         self.change_count = 0
 
     def setup_luns(self):
@@ -54,10 +88,9 @@ class Client(object):
         self.client_luns = get_images(self.acl)
         for image_name in self.client_luns:
             lun_id = self.client_luns[image_name]['lun_id']
-            self.lun_id_list.remove(lun_id)
+            self.lun_ids.reserve(lun_id)
             logger.debug("(Client.setup_luns) {} has id of {}".format(image_name, lun_id))
 
-        self.tpg_luns = get_images(self.tpg)
         current_map = dict(self.client_luns)
 
         for image in self.requested_images:
@@ -89,29 +122,30 @@ class Client(object):
         :return:
         """
 
-        r = lio_root.RTSRoot()
-
         # NB. this will check all tpg's for a matching iqn
-        for client in r.node_acls:
-            if client.node_wwn == self.iqn:
-                self.acl = client
-                self.tpg = client.parent_tpg
-                logger.debug("(Client.define_client) - {} already defined".format(self.iqn))
-                return
+        if self.iqn in self.lio.acls:
+            self.acl = self.lio.acls[self.iqn]
+            self.tpg = self.acl.parent_tpg
+            logger.debug("(Client.define_client) - {} already defined".format(self.iqn))
+            return
 
         # at this point the client does not exist, so create it
-        # NB. The solution supports only a single tpg definition, so simply grabbing the
-        # first tpg is fine. If multiple tpgs are required this will need more work
-        self.tpg = r.tpgs.next()
+        self.tpg = self.lio.tpg
+        if self.tpg is None:
+            self.error = True
+            self.error_msg = "no tpg defined to LIO - gateway not configured?"
+            logger.error("(Client.define_client) FAILED to define {} - no tpg".format(self.iqn))
+            return
 
         try:
-            self.acl = NodeACL(self.tpg, self.iqn)
-        except RTSLibError as err:
+            self.acl = rtslib_target.NodeACL(self.tpg, self.iqn)
+        except rtslib_utils.RTSLibError as err:
             logger.error("(Client.define_client) FAILED to define {}".format(self.iqn))
             logger.debug("(Client.define_client) failure msg {}".format(err))
             self.error = True
             self.error_msg = err
         else:
+            self.lio.acls[self.iqn] = self.acl
             self.change_count += 1
             logger.info("(Client.define_client) {} added successfully".format(self.iqn))
 
@@ -132,11 +166,27 @@ class Client(object):
                 self.acl.chap_password = client_password
                 logger.info("(Client.configure_auth) chap password changed for {}".format(self.iqn))
 
-        except RTSLibError as err:
+        except rtslib_utils.RTSLibError as err:
             self.error = True
             self.error_msg = "Unable to (re)configure chap - ".format(err)
             logger.error("Client.configure_auth) failed to set credentials on node")
 
+    def configure_profile(self):
+        """
+        Apply the client's tuning profile to its ACL, only writing the settings that differ
+        """
+
+        changed, failed = apply_client_profile(self.acl, self.profile_settings)
+
+        for name in changed:
+            logger.info("(Client.configure_profile) {} '{}' set to {} "
+                        "(profile '{}')".format(self.iqn, name, self.profile_settings[name], self.profile))
+            self.change_count += 1
+
+        for name in failed:
+            logger.warning("(Client.configure_profile) {} '{}' could not be set to {} - "
+                           "{}".format(self.iqn, name, self.profile_settings[name], failed[name]))
+
     def _add_lun(self, image, lun):
         """
         Add a given image to the client ACL
@@ -148,19 +198,23 @@ class Client(object):
         rc = 0
         # get the tpg lun to map this client to
         tpg_lun = lun['tpg_lun']
-        lun_id = self.lun_id_list[0]        # pick the lowest available lun ID
+        lun_id = self.lun_ids.allocate()        # pick the lowest available lun ID
+        if lun_id is None:
+            logger.error("(Client._add_lun) no LUN ids left to map {} to {}".format(image, self.iqn))
+            return 12
+
         logger.debug("(Client._add_lun) Adding {} to {} at id {}".format(image, self.iqn, lun_id))
         try:
             m_lun = self.acl.mapped_lun(lun_id, tpg_lun=tpg_lun)
             self.client_luns[image] = {"lun_id": lun_id,
                                        "mapped_lun": m_lun,
                                        "tpg_lun": tpg_lun}
-            self.lun_id_list.remove(lun_id)
             logger.info("(Client.add_lun) added image '{}' to {}".format(image, self.iqn))
             self.change_count += 1
 
-        except RTSLibError as err:
+        except rtslib_utils.RTSLibError as err:
             logger.error("Client.add_lun RTSLibError for lun id {} - {}".format(lun_id, err))
+            self.lun_ids.release(lun_id)
             rc = 12
 
         return rc
@@ -175,8 +229,9 @@ class Client(object):
         lun = self.client_luns[image]['mapped_lun']
         try:
             lun.delete()
+            self.lun_ids.release(self.client_luns[image]['lun_id'])
             self.change_count += 1
-        except RTSLibError as err:
+        except rtslib_utils.RTSLibError as err:
             self.error = True
             self.error_msg = err
 
@@ -188,9 +243,10 @@ class Client(object):
 
         try:
             self.acl.delete()
+            del self.lio.acls[self.iqn]
             self.change_count += 1
             logger.info("(Client.delete) deleted NodeACL for {}".format(self.iqn))
-        except RTSLibError as err:
+        except rtslib_utils.RTSLibError as err:
             self.error = True
             self.error_msg = "RTS NodeACL delete failure"
             logger.error("(Client.delete) failed to delete client {} - error: {}".format(self.iqn,
@@ -202,9 +258,7 @@ class Client(object):
         :return: Boolean
         """
 
-        r = lio_root.RTSRoot()
-        client_list = [client.node_wwn for client in r.node_acls]
-        return self.iqn in client_list
+        return self.iqn in self.lio.acls
 
 
 def get_images(rts_object):
@@ -217,7 +271,7 @@ def get_images(rts_object):
 
     luns_mapped = {}
 
-    if isinstance(rts_object, NodeACL):
+    if isinstance(rts_object, rtslib_target.NodeACL):
         # return a dict of images assigned to this client
         for m_lun in rts_object.mapped_luns:
             image_name = m_lun.tpg_lun.storage_object.name
@@ -225,7 +279,7 @@ def get_images(rts_object):
                                        "mapped_lun": m_lun,
                                        "tpg_lun": m_lun.tpg_lun}
 
-    elif isinstance(rts_object, TPG):
+    elif isinstance(rts_object, rtslib_target.TPG):
         # return a dict of *all* images available to this tpg
         for m_lun in rts_object.luns:
             image_name = m_lun.storage_object.name
@@ -235,44 +289,97 @@ def get_images(rts_object):
     return luns_mapped
 
 
-def validate_images(image_list, tpg):
+def validate_images(image_list, tpg_luns):
     """
     Confirm that the images listed are actually allocated to the tpg and can
     therefore be used by a client
     :param image_list: list of rbd image names
-    :param tpg: TPG object
+    :param tpg_luns: dict of images mapped to the TPG (from get_images)
     :return: a list of images that are NOT in the tpg ... should be empty!
     """
     bad_images = []
-    tpg_lun_list = get_images(tpg).keys()
     for image in image_list:
-        if image not in tpg_lun_list:
+        if image not in tpg_luns:
             bad_images.append(image)
 
     return bad_images
 
-def get_update_host(config):
+
+def apply_client(client, desired_state):
     """
-    decide which gateway host should be responsible for any config object updates
-    :param config: configuration dict from the rados pool
-    :return: a suitable gateway host that is online
+    Bring the LIO definition of a client in line with its desired state
+    :param client: Client object
+    :param desired_state: present or absent
+    :return: error message (str) - empty if the client was configured successfully
     """
 
-    ptr = 0
-    potential_hosts = [host_name for host_name in config["gateways"].keys()
-                       if isinstance(config["gateways"][host_name], dict)]
+    if desired_state == 'present':
 
-    # Assume the 1st element from the list is OK for now
-    # TODO check the potential hosts are online/available
+        client.define_client()
+        if client.error:
+            return "Unable to define the client ({}) - {}".format(client.iqn, client.error_msg)
+
+        bad_images = validate_images(client.requested_images, client.tpg_luns)
+        if bad_images:
+            return "non-existent images {} requested for {}".format(bad_images, client.iqn)
 
-    return potential_hosts[ptr]
+        client.setup_luns()
+        if client.error:
+            return "Unable to setup the client lun maps ({}) - {}".format(client.iqn, client.error_msg)
+
+        if client.auth_type in Client.supported_access_types:
+            client.configure_auth()
+            if client.error:
+                return "Unable to configure authentication for {} - {}".format(client.iqn, client.error_msg)
+        else:
+            logger.warning("(apply_client) client '{}' configured without security".format(client.iqn))
+
+        if client.profile:
+            client.configure_profile()
+
+    else:
+        # the desired state for this client is absent, so remove it if necessary
+        if client.exists():
+            client.define_client()          # grab the client and parent tpg objects
+            client.delete()
+            if client.error:
+                return "Unable to delete the client ({}) - {}".format(client.iqn, client.error_msg)
+        else:
+            # desired state is absent, but the client does not exist in LIO - Nothing to do!
+            logger.info("(apply_client) client {} removal request, but the client is not "
+                        "defined...skipping".format(client.iqn))
+
+    return ''
+
+
+def update_config(config, client, desired_state):
+    """
+    Record a client's settings in the config object (commit is left to the caller)
+    :param config: Config object
+    :param client: Client object that has been applied to LIO
+    :param desired_state: present or absent
+    """
+
+    if desired_state == 'present':
+        client_metadata = {"image_list": client.requested_images,
+                           "credentials": client.credentials}
+        if client.profile:
+            client_metadata['profile'] = client.profile
+        if config.config["clients"].get(client.iqn) != client_metadata:
+            config.update_item("clients", client.iqn, client_metadata)
+
+    elif client.iqn in config.config["clients"]:
+        config.del_item("clients", client.iqn)
 
 def main():
 
     fields = {
-        "client_iqn": {"required": True, "type": "str"},
-        "image_list": {"required": True, "type": "list"},
+        "client_iqn": {"required": False, "type": "str"},
+        "image_list": {"required": False, "type": "list"},
+        "clients": {"required": False, "type": "list"},
         "credentials": {"required": False, "type": "str", "default": ''},
+        "profile": {"required": False, "type": "str", "default": ''},
+        "client_profiles": {"required": False, "type": "dict", "default": {}},
         "auth": {
             "required": False,
             "default": '',
@@ -280,106 +387,144 @@ def main():
             "type": "str"
         },
         "state": {
-            "required": True,
+            "required": False,
+            "default": "present",
             "choices": ['present', 'absent'],
             "type": "str"
             },
+        "verify": {"required": False, "type": "bool", "default": False},
         }
 
+    fields.update(CONFIG_ARGS)
+
     module = AnsibleModule(argument_spec=fields,
                            supports_check_mode=False)
 
-    client_iqn = module.params['client_iqn']
-    image_list = module.params['image_list']
-    credentials = module.params['credentials']
-    auth_type = module.params['auth']
-    desired_state = module.params['state']
-
     auth_methods = ['chap']
 
-    if auth_type in auth_methods and not credentials:
-        module.fail_json(msg="Unable to configure - auth method of '{}' requested, without"
-                             " credentials for {}".format(auth_type, client_iqn))
-
-    logger.info("START - Client configuration started : {}".format(client_iqn))
-
-    client = Client(client_iqn, image_list, auth_type, credentials)
-    config = Config(logger)
-
-    # Determine a host that should be used to update the rados config object (1st available gateway node normally)
-    update_host = get_update_host(config.config)
-
-    if desired_state == 'present':                          # NB. This is the default
-
-        client.define_client()
-        if client.error:
-            module.fail_json(msg="Unable to define the client ({}) - {}".format(client_iqn,
-                                                                                client.error_msg))
-
-        if client_iqn not in config.config["clients"].keys() and update_host == gethostname().split('.')[0]:
-            client_metadata = {"image_list": [],
-                               "credentials": ''}
-
-            config.add_item("clients", client_iqn)
-            config.update_item("clients", client_iqn, client_metadata)
-            # persist the config update, and leave the connection to ceph open
-            config.commit("retain")
-
-
-        bad_images = validate_images(image_list, client.tpg)
-        if not bad_images:
-
-            client.setup_luns()
-            if client.error:
-                module.fail_json(msg="Unable to setup the client lun maps ({}) - {}".format(client_iqn,
-                                                                                            client.error_msg))
-
-            if client.auth_type in Client.supported_access_types:
-                client.configure_auth()
-                if client.error:
-                    module.fail_json(msg="Unable to configure authentication for {} - {}".format(client_iqn,
-                                                                                                 client.error_msg))
-            else:
-                logger.warning("(main) client '{}' configured without security".format(client_iqn))
-        else:
-            module.fail_json(msg="(main) non-existent images {} requested for {}".format(bad_images, client_iqn))
-
-        # check the client object's change count, and update the config object is this is the updating host
-        if client.change_count > 0 and update_host == gethostname().split('.')[0]:
-            # update the config object with this clients settings
-            client_metadata = {"image_list": image_list,
-                               "credentials": credentials}
-
-            config.update_item("clients", client_iqn, client_metadata)
-            # persist the config update, and leave the connection to ceph open
-            config.commit()
-
-
+    # build the list of client requests - either a single client from the module
+    # parameters, or the list of clients given in batch mode
+    if module.params['clients'] is not None:
+        if module.params['client_iqn']:
+            module.fail_json(msg="client_iqn and clients are mutually exclusive")
+
+        requests = []
+        for entry in module.params['clients']:
+            if not isinstance(entry, dict) or 'client' not in entry:
+                module.fail_json(msg="Invalid clients entry '{}' - each entry must be a dict with a "
+                                     "'client' key".format(entry))
+            requests.append({"client_iqn": entry['client'],
+                             "image_list": entry.get('image_list', []),
+                             "credentials": entry.get('credentials', module.params['credentials']),
+                             "auth": entry.get('auth', module.params['auth']),
+                             "profile": entry.get('profile', module.params['profile']),
+                             "state": entry.get('status', entry.get('state', module.params['state']))})
     else:
-        # the desired state for this client is absent, so remove it if necessary
-        if client.exists():
-            client.define_client()          # grab the client and parent tpg objects
-            client.delete()
-            if client.error:
-                module.fail_json(msg="Unable to delete the client ({}) - {}".format(client_iqn,
-                                                                                    client.error_msg))
-            else:
-                # remove this client from the config
-                if update_host == gethostname().split('.')[0]:
-                    config.del_item("clients", client_iqn)
-                    config.commit()
-
+        if not module.params['client_iqn'] or module.params['image_list'] is None:
+            module.fail_json(msg="client_iqn and image_list are required, unless clients is used")
+
+        requests = [{"client_iqn": module.params['client_iqn'],
+                     "image_list": module.params['image_list'],
+                     "credentials": module.params['credentials'],
+                     "auth": module.params['auth'],
+                     "profile": module.params['profile'],
+                     "state": module.params['state']}]
+
+    for request in requests:
+        if request['auth'] in auth_methods and not request['credentials']:
+            module.fail_json(msg="Unable to configure - auth method of '{}' requested, without"
+                                 " credentials for {}".format(request['auth'], request['client_iqn']))
+        if request['state'] not in ['present', 'absent']:
+            module.fail_json(msg="Invalid state '{}' requested for {}".format(request['state'],
+                                                                             request['client_iqn']))
+
+    for name in module.params['client_profiles']:
+        bad_settings = invalid_attributes(module.params['client_profiles'][name], supported=CLIENT_SETTINGS)
+        if bad_settings:
+            module.fail_json(msg="client profile '{}' contains unsupported settings {} - valid settings "
+                                 "are {}".format(name, bad_settings, CLIENT_SETTINGS))
+
+    # skip the run if nothing has changed since the last successful run
+    fingerprint = RunFingerprint('igw_client', module.params['client_iqn'] or 'clients', module.params,
+                                 pool=module.params['config_pool'], cfg_name=module.params['config_name'])
+    if not verify_requested(module.params['verify']) and fingerprint.matches():
+        logger.info("SKIP  - Client configuration unchanged since the last run")
+        module.exit_json(changed=False, meta={"msg": "Client definition unchanged - skipped"})
+
+    logger.info("START - Client configuration started : {} client(s)".format(len(requests)))
+
+    # LIO is scanned once, and the result shared by all the clients. The scan runs while the
+    # config is read in the background
+    config = Config(logger, cfg_name=module.params['config_name'], pool=module.params['config_pool'],
+                    wait=False)
+    lio_state = LIOState()
+    if config.wait().error:
+        module.fail_json(msg=config.error_msg)
+
+    # resolve each client's tuning profile - client_profiles given in the playbook define (or
+    # redefine) profiles, otherwise the definition comes from the config object or the built-in profiles
+    cfg_profiles = config.config.get('client_profiles', {})
+    profiles = {}
+    for request in requests:
+        name = request['profile']
+        if not name or name in profiles or request['state'] == 'absent':
+            continue
+        if name in module.params['client_profiles']:
+            profiles[name] = module.params['client_profiles'][name]
         else:
-            # desired state is absent, but the client does not exist in LIO - Nothing to do!
-            logger.info("(main) client {} removal request, but the client is not "
-                        "defined...skipping".format(client_iqn))
+            profiles[name] = resolve_profile(name, cfg_profiles, CLIENT_PROFILES)
+            if profiles[name] is None:
+                module.fail_json(msg="client profile '{}' requested for {} is not "
+                                     "defined".format(name, request['client_iqn']))
 
-    logger.info("END   - Client configuration complete - {} changes made".format(client.change_count))
-
-    changes_made = True if client.change_count > 0 else False
+    # Determine a host that should be used to update the rados config object (1st available gateway node normally)
+    update_host = get_update_host(config.config, live=config.live_gateways())
+    is_update_host = update_host == gethostname().split('.')[0]
+
+    change_counts = {}
+    errors = {}
+    for request in requests:
+        client_iqn = request['client_iqn']
+        client = Client(client_iqn, request['image_list'], request['auth'], request['credentials'],
+                        lio_state=lio_state, profile=request['profile'],
+                        profile_settings=profiles.get(request['profile']))
+
+        error_msg = apply_client(client, request['state'])
+        change_counts[client_iqn] = client.change_count
+
+        if error_msg:
+            logger.error("(main) {}".format(error_msg))
+            errors[client_iqn] = error_msg
+        elif is_update_host:
+            update_config(config, client, request['state'])
+
+        logger.info("(main) {} configured - {} changes made".format(client_iqn, client.change_count))
+
+    if is_update_host:
+        for name in module.params['client_profiles']:
+            if cfg_profiles.get(name) != module.params['client_profiles'][name]:
+                config.update_item('client_profiles', name, module.params['client_profiles'][name])
+
+    # all the client updates are persisted to the config object in a single commit
+    if is_update_host and config.changed:
+        config.commit()
+        if config.error:
+            errors['config'] = config.error_msg
+
+    total_changes = sum(change_counts.values())
+    logger.info("END   - Client configuration complete - {} changes made".format(total_changes))
+
+    if errors:
+        failures = ["{} : {}".format(name, errors[name]) for name in sorted(errors)]
+        module.fail_json(msg="Client configuration failed - {}".format("; ".join(failures)),
+                         errors=errors, clients=change_counts)
+
+    fingerprint.save()
+    changes_made = True if total_changes > 0 else False
 
     module.exit_json(changed=changes_made, meta={"msg": "Client definition completed {} "
-                                                 "changes made".format(client.change_count)})
+                                                 "changes made".format(total_changes),
+                                                 "clients": change_counts})
 
 if __name__ == '__main__':
 
@@ -393,4 +538,4 @@ if __name__ == '__main__':
     handler.setFormatter(log_fmt)
     logger.addHandler(handler)
 
-    main()
+    run_main(main, module_name)
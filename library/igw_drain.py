@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+
+__author__ = 'pcuzner@redhat.com'
+
+import logging
+import os
+import time
+
+from socket import gethostname
+from logging.handlers import RotatingFileHandler
+from ansible.module_utils.basic import AnsibleModule
+
+from ceph_iscsi_gw import alua
+from ceph_iscsi_gw.common import Config, CONFIG_ARGS
+from ceph_iscsi_gw.lio import LIOSnapshot
+from ceph_iscsi_gw.placement import PlacementError, drain_owners
+from ceph_iscsi_gw.profiling import run_main
+from ceph_iscsi_gw.utils import wait_for
+
+# seconds between reads of the config, while the drained gateway waits for its peers
+LOOP_DELAY = 2
+
+
+def prepare(config, drained_host):
+    """
+    Reassign the disks owned by the drained gateway to the least loaded peers, and mark the
+    gateway as drained - all in a single commit
+    :param config: Config object
+    :param drained_host: hostname of the gateway being drained
+    :return: (dict of moves {image: new owner}, error message (str))
+    """
+
+    config.lock()
+    if config.error:
+        return {}, config.error_msg
+    config.refresh()
+
+    gateways = config.config['gateways']
+    if drained_host not in gateways:
+        config.unlock()
+        return {}, "{} is not a gateway in the configuration".format(drained_host)
+
+    try:
+        moves = drain_owners(config.config, drained_host, live=config.live_gateways())
+    except PlacementError as err:
+        config.unlock()
+        return {}, str(err)
+    owned = [image for image in config.config['disks']
+             if config.config['disks'][image].get('owner') == drained_host]
+    if owned and not moves:
+        config.unlock()
+        return {}, "No peer gateways available to take the active paths from {}".format(drained_host)
+
+    started = time.time()
+    for image in sorted(moves):
+        new_owner = moves[image]
+        disk_attr = config.config['disks'][image]
+        disk_attr['owner'] = new_owner
+        # the drain record lets the peers and the drained gateway coordinate the switch
+        disk_attr['drain'] = {"from": drained_host, "started": started}
+        config.update_item('disks', image, disk_attr)
+        gateways[new_owner]['active_luns'] += 1
+
+    for gw_name in set(moves.values()):
+        config.update_item('gateways', gw_name, gateways[gw_name])
+
+    gateway_dict = gateways[drained_host]
+    if moves or not gateway_dict.get('drained'):
+        gateway_dict['active_luns'] = max(0, gateway_dict['active_luns'] - len(moves))
+        gateway_dict['drained'] = started
+        config.update_item('gateways', drained_host, gateway_dict)
+
+    if config.changed:
+        config.commit('retain')
+    else:
+        config.unlock()
+
+    return moves, config.error_msg if config.error else ''
+
+
+def activate(config, this_host):
+    """
+    Peer side of the drain - make every LUN owned by this host active, and record when the
+    LUNs taken over from the drained gateway became active
+    :param config: Config object
+    :param this_host: this gateway's hostname
+    :return: (dict of LUNs activated {image: timings}, error message (str))
+    """
+
+    lio = LIOSnapshot()
+    activated = {}
+    missing = []
+
+    for image in sorted(config.config['disks']):
+        disk_attr = config.config['disks'][image]
+        if disk_attr.get('owner') != this_host:
+            continue
+
+        if image not in lio.storage_objects:
+            missing.append(image)
+            continue
+
+        start = time.time()
+        alua.set_alua(lio.storage_objects[image], 'active')
+
+        drain = disk_attr.get('drain')
+        if drain and 'activated' not in drain:
+            drain['activated'] = time.time()
+            config.update_item('disks', image, disk_attr)
+            activated[image] = {"from": drain['from'],
+                                "activate_secs": round(drain['activated'] - start, 3)}
+            logger.info("(activate) {} is now active on {}".format(image, this_host))
+
+    if config.changed:
+        config.commit('retain')
+        if config.error:
+            return activated, config.error_msg
+
+    if missing:
+        return activated, "Unable to activate {} - not defined to LIO on {}".format(','.join(missing),
+                                                                                  this_host)
+
+    return activated, ''
+
+
+def release(config, this_host, timeout):
+    """
+    Drained gateway side - once a peer has activated a LUN, switch it to standby here. A LUN
+    whose peer doesn't activate it within the timeout stays active on this gateway
+    :param config: Config object
+    :param this_host: this gateway's hostname
+    :param timeout: seconds to wait for the peers
+    :return: (dict of LUNs released {image: failover timings}, error message (str))
+    """
+
+    def _draining(cfg):
+        return dict((image, cfg['disks'][image]['drain']) for image in cfg['disks']
+                    if cfg['disks'][image].get('drain', {}).get('from') == this_host)
+
+    def _peers_ready():
+        cfg = config.get_config()
+        return cfg and all('activated' in drain for drain in _draining(cfg).values())
+
+    wait_for(_peers_ready, timeout, LOOP_DELAY)
+
+    config.refresh()
+    lio = LIOSnapshot()
+    released = {}
+    pending = []
+
+    for image, drain in sorted(_draining(config.config).items()):
+        if 'activated' not in drain:
+            pending.append(image)
+            continue
+
+        disk_attr = config.config['disks'][image]
+        if image in lio.storage_objects:
+            alua.set_alua(lio.storage_objects[image], 'standby')
+        standby = time.time()
+
+        # NB. the activation time was recorded by the peer, so clock skew between the
+        # gateways affects active_after
+        released[image] = {"owner": disk_attr['owner'],
+                           "active_after": round(drain['activated'] - drain['started'], 3),
+                           "failover_secs": round(standby - drain['started'], 3)}
+        logger.info("(release) {} set to standby, active path now on {} "
+                    "({:.3f}s)".format(image, disk_attr['owner'], released[image]['failover_secs']))
+
+        del disk_attr['drain']
+        config.update_item('disks', image, disk_attr)
+
+    if config.changed:
+        config.commit('retain')
+        if config.error:
+            return released, config.error_msg
+
+    if pending:
+        return released, "Timed out waiting for the peers to activate {} - these LUNs remain " \
+                         "active on {}".format(','.join(pending), this_host)
+
+    return released, ''
+
+
+def resume(config, this_host):
+    """
+    Return a drained gateway to service - it's considered for new active paths again. The
+    LUNs moved by the drain stay with their new owners until the gateways are rebalanced
+    :return: error message (str)
+    """
+
+    gateway_dict = config.config['gateways'].get(this_host, {})
+    if gateway_dict.get('drained'):
+        del gateway_dict['drained']
+        config.update_item('gateways', this_host, gateway_dict)
+        config.commit('retain')
+
+    return config.error_msg if config.error else ''
+
+
+def main():
+    # Drain moves a gateway's active paths to its peers ahead of maintenance. The phases run
+    # in order across the gateways, so a LUN always has at least one active path;
+    #   prepare  - (drained host) reassign the owners to the peers, in one commit
+    #   activate - (peers) set the LUNs they now own to active
+    #   release  - (drained host) set the moved LUNs to standby, once the peers are active
+    #   resume   - (drained host) make the gateway available for new active paths again
+    fields = {
+        "host": {"required": True, "type": "str"},
+        "phase": {
+            "required": True,
+            "choices": ['prepare', 'activate', 'release', 'resume'],
+            "type": "str"
+        },
+        "timeout": {"required": False, "type": "int", "default": 120}
+    }
+
+    fields.update(CONFIG_ARGS)
+
+    module = AnsibleModule(argument_spec=fields,
+                           supports_check_mode=False)
+
+    drained_host = module.params['host']
+    phase = module.params['phase']
+    this_host = gethostname().split('.')[0]
+
+    # each phase runs on either the drained gateway or its peers
+    if (phase == 'activate') == (this_host == drained_host):
+        module.exit_json(changed=False,
+                         meta={"msg": "Drain ({}) of {} - nothing to do on {}".format(phase, drained_host,
+                                                                                      this_host)})
+
+    logger.info("START - Drain ({}) of {} started".format(phase, drained_host))
+    start = time.time()
+
+    config = Config(logger, cfg_name=module.params['config_name'], pool=module.params['config_pool'])
+    if config.error:
+        module.fail_json(msg=config.error_msg)
+
+    luns = {}
+    if phase == 'prepare':
+        luns, error_msg = prepare(config, drained_host)
+    elif phase == 'activate':
+        luns, error_msg = activate(config, this_host)
+    elif phase == 'release':
+        luns, error_msg = release(config, this_host, module.params['timeout'])
+    else:
+        error_msg = resume(config, this_host)
+
+    changed = config.changed or len(luns) > 0
+    if config.ceph:
+        config.ceph.shutdown()
+
+    if error_msg:
+        module.fail_json(msg=error_msg, luns=luns)
+
+    elapsed = time.time() - start
+    logger.info("END   - Drain ({}) of {} complete - {} LUNs ({:.3f}s)".format(phase, drained_host,
+                                                                            len(luns), elapsed))
+
+    module.exit_json(changed=changed,
+                     luns=luns,
+                     elapsed=round(elapsed, 3),
+                     meta={"msg": "Drain ({}) of {} complete - {} LUNs".format(phase, drained_host,
+                                                                               len(luns))})
+
+
+if __name__ == '__main__':
+
+    module_name = os.path.basename(__file__).replace('ansible_module_', '')
+    logger = logging.getLogger(os.path.basename(module_name))
+    logger.setLevel(logging.DEBUG)
+    handler = RotatingFileHandler('/var/log/ansible-module-igw_config.log',
+                                  maxBytes=5242880,
+                                  backupCount=7)
+    log_fmt = logging.Formatter('%(asctime)s %(name)s %(levelname)-8s : %(message)s')
+    handler.setFormatter(log_fmt)
+    logger.addHandler(handler)
+
+    run_main(main, module_name)
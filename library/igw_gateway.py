@@ -5,19 +5,25 @@ __author__ = 'pcuzner@redhat.com'
 import os
 import logging
 import socket
-import netaddr
-import netifaces
 import struct
 
 from logging.handlers import RotatingFileHandler
-from ansible.module_utils.basic import *
+from ansible.module_utils.basic import AnsibleModule
 
-from rtslib_fb.target import Target, TPG, NetworkPortal, LUN
-from rtslib_fb.fabric import ISCSIFabricModule
-from rtslib_fb import root
-from rtslib_fb.utils import RTSLibError
+from ceph_iscsi_gw.common import Config, CONFIG_ARGS
+from ceph_iscsi_gw.fingerprint import RunFingerprint, verify_requested
+from ceph_iscsi_gw.profiles import (TPG_ATTRIBUTES, TPG_PARAMETERS, TPG_PROFILES, invalid_attributes,
+                                    resolve_profile, apply_tpg_profile)
+from ceph_iscsi_gw.profiling import run_main
+from ceph_iscsi_gw.utils import LazyModule
 
-from ceph_iscsi_gw.common import Config
+# loaded on first use, so a fingerprint match exits without importing them
+netaddr = LazyModule('netaddr')
+netifaces = LazyModule('netifaces')
+root = LazyModule('rtslib_fb.root')
+rtslib_fabric = LazyModule('rtslib_fb.fabric')
+rtslib_target = LazyModule('rtslib_fb.target')
+rtslib_utils = LazyModule('rtslib_fb.utils')
 
 
 def valid_cidr(subnet):
@@ -49,11 +55,12 @@ class Gateway(object):
     Class representing the state of the local LIO environment
     """
 
-    def __init__(self, iqn, iscsi_network):
+    def __init__(self, iqn, iscsi_networks):
         """
         Instantiate the class
         :param iqn: iscsi iqn name for the gateway
-        :param iscsi_network: network subnet to bind to (i.e. use for the portal IP)
+        :param iscsi_networks: list of network subnets (CIDR) or interface names to bind
+                               to - each one provides a portal IP for the tpg
         :return: gateway object
         """
 
@@ -62,15 +69,23 @@ class Gateway(object):
 
         self.iqn = iqn
 
-        self.ip_address = get_ip_address(iscsi_network)
-        if not self.ip_address:
-            self.error = True
-            self.error_msg = ("Unable to find an IP on this host, that matches"
-                              " the iscsi_network setting {}".format(iscsi_network))
+        self.ip_addresses = []
+        for network in iscsi_networks:
+            ip_address = get_ip_address(network)
+            if not ip_address:
+                self.error = True
+                self.error_msg = ("Unable to find an IP on this host, that matches"
+                                  " the iscsi_network setting {}".format(network))
+                break
+            if ip_address not in self.ip_addresses:
+                self.ip_addresses.append(ip_address)
+
+        # first portal IP is retained as the gateway's primary address
+        self.ip_address = self.ip_addresses[0] if self.ip_addresses else ''
 
         self.type = Config.get_platform()
         self.changes_made = False
-        self.portal = None
+        self.portals = []
         self.target = None
         self.tpg = None
 
@@ -84,20 +99,21 @@ class Gateway(object):
 
     def create_target(self):
         """
-        Add an iSCSI target to LIO with this objects iqn name, and bind to the IP that
-        aligns with the given iscsi_network
+        Add an iSCSI target to LIO with this objects iqn name, and bind a portal to each
+        of the IPs that align with the given iscsi_network(s)
         """
 
         try:
-            iscsi_fabric = ISCSIFabricModule()
-            self.target = Target(iscsi_fabric, wwn=self.iqn)
+            iscsi_fabric = rtslib_fabric.ISCSIFabricModule()
+            self.target = rtslib_target.Target(iscsi_fabric, wwn=self.iqn)
             logger.debug("(Gateway.create_target) Added iscsi target - {}".format(self.iqn))
-            self.tpg = TPG(self.target)
+            self.tpg = rtslib_target.TPG(self.target)
             logger.debug("(Gateway.create_target) Added tpg")
             self.tpg.enable = True
-            self.portal = NetworkPortal(self.tpg, self.ip_address)
-            logger.debug("(Gateway.create_target) Added portal IP '{}' to tpg".format(self.ip_address))
-        except RTSLibError as err:
+            for ip_address in self.ip_addresses:
+                self.portals.append(rtslib_target.NetworkPortal(self.tpg, ip_address))
+                logger.debug("(Gateway.create_target) Added portal IP '{}' to tpg".format(ip_address))
+        except rtslib_utils.RTSLibError as err:
             self.error_msg = err
             self.error = True
             self.delete()
@@ -115,14 +131,62 @@ class Gateway(object):
             lio_root = root.RTSRoot()
             self.target = lio_root.targets.next()
             self.tpg = self.target.tpgs.next()
-            self.portal = self.tpg.network_portals.next()
+            self.portals = list(self.tpg.network_portals)
 
-        except RTSLibError as err:
+        except rtslib_utils.RTSLibError as err:
             self.error_msg = err
             self.error = True
 
         logger.info("(Gateway.load_config) successfully loaded existing target definition")
 
+    def reconcile_portals(self):
+        """
+        Bring the tpg's network portals in line with the requested portal IPs - missing
+        portals are added and portals for IPs no longer requested are removed. Portals that
+        already match are left untouched, so existing sessions on them are not disrupted
+        """
+
+        current = dict((portal.ip_address, portal) for portal in self.portals)
+
+        try:
+            for ip_address in self.ip_addresses:
+                if ip_address not in current:
+                    current[ip_address] = rtslib_target.NetworkPortal(self.tpg, ip_address)
+                    self.changes_made = True
+                    logger.info("(Gateway.reconcile_portals) added portal IP '{}' to tpg".format(ip_address))
+
+            for ip_address in list(current):
+                if ip_address not in self.ip_addresses:
+                    current[ip_address].delete()
+                    del current[ip_address]
+                    self.changes_made = True
+                    logger.info("(Gateway.reconcile_portals) removed portal IP '{}' from tpg".format(ip_address))
+
+        except rtslib_utils.RTSLibError as err:
+            self.error_msg = err
+            self.error = True
+
+        self.portals = current.values()
+
+    def apply_profile(self, profile_name, settings):
+        """
+        Apply a tpg tuning profile. Only the values that differ from the profile are written,
+        so the tpg is updated in place on each run
+        :param profile_name: name of the profile (str) - used for logging
+        :param settings: dict of tpg parameter/attribute name -> value
+        """
+
+        changed, failed = apply_tpg_profile(self.tpg, settings)
+
+        for name in changed:
+            logger.info("(Gateway.apply_profile) tpg '{}' set to {} "
+                        "(profile '{}')".format(name, settings[name], profile_name))
+            self.changes_made = True
+
+        for name in failed:
+            logger.warning("(Gateway.apply_profile) tpg '{}' could not be set to {} - "
+                           "{}".format(name, settings[name], failed[name]))
+
     def map_luns(self):
         """
         LIO will have blockstorage objects already defined by the igw_lun module, so this
@@ -139,9 +203,9 @@ class Gateway(object):
                 lun_id = int(stg_object._path.split('/')[-2].split('_')[1])
 
                 try:
-                    mapped_lun = LUN(self.tpg, lun=lun_id, storage_object=stg_object)
+                    mapped_lun = rtslib_target.LUN(self.tpg, lun=lun_id, storage_object=stg_object)
                     self.changes_made = True
-                except RTSLibError as err:
+                except rtslib_utils.RTSLibError as err:
                     self.error = True
                     self.error_msg = err
                     break
@@ -172,24 +236,32 @@ def ipv4_addresses():
     """
 
     for iface in netifaces.interfaces():
-        for link in netifaces.ifaddresses(iface)[netifaces.AF_INET]:
+        for link in netifaces.ifaddresses(iface).get(netifaces.AF_INET, []):
             yield link['addr']
 
 
 def get_ip_address(iscsi_network):
     """
     Return an IP address assigned to the running host that matches the given
-    subnet address. This IP becomes the portal IP for the target portal group
-    :param iscsi_network: cidr network address
+    subnet address or interface name. This IP becomes a portal IP for the target portal group
+    :param iscsi_network: cidr network address or network interface name (e.g. eth1)
     :return: IP address, or '' if the host does not have an interface on the required subnet
     """
 
     ip = ''
-    subnet = netaddr.IPSet([iscsi_network])
-    target_ip_range = [str(ip) for ip in subnet]   # list where each element is an ip address
+
+    if '/' not in iscsi_network:
+        # interface name given, so use it's first ipv4 address
+        if iscsi_network in netifaces.interfaces():
+            links = netifaces.ifaddresses(iscsi_network).get(netifaces.AF_INET, [])
+            if links:
+                ip = links[0]['addr']
+        return ip
+
+    subnet = netaddr.IPNetwork(iscsi_network)
 
     for local_ip in ipv4_addresses():
-        if local_ip in target_ip_range:
+        if netaddr.IPAddress(local_ip) in subnet:
             ip = local_ip
             break
 
@@ -200,31 +272,61 @@ def main():
     # Configures the gateway on the host. All images defined are added to
     # the default tpg for later allocation to clients
     fields = {"gateway_iqn": {"required": True, "type": "str"},
-              "iscsi_network": {"required": True, "type": "str"},
+              "iscsi_network": {"required": True, "type": "list"},
               "mode": {
                   "required": True,
                   "choices": ['target', 'map']
-                  }
+                  },
+              "tpg_profile": {"required": False, "type": "str"},
+              "tpg_profile_settings": {"required": False, "type": "dict"},
+              "max_active_luns": {"required": False, "type": "int"},
+              "verify": {"required": False, "type": "bool", "default": False}
               }
 
+    fields.update(CONFIG_ARGS)
+
     module = AnsibleModule(argument_spec=fields,
                            supports_check_mode=False)
 
     gateway_iqn = module.params['gateway_iqn']
-    iscsi_network = module.params['iscsi_network']
+    iscsi_networks = [network.strip() for network in module.params['iscsi_network'] if network.strip()]
     mode = module.params['mode']
+    profile_name = module.params['tpg_profile']
+    profile_settings = module.params['tpg_profile_settings']
+    max_active_luns = module.params['max_active_luns']
 
-    if not valid_cidr(iscsi_network):
-        module.fail_json(msg="Invalid 'iscsi_network' provided - must use CIDR notation of a.b.c.d/nn")
+    if max_active_luns is not None and max_active_luns < 0:
+        module.fail_json(msg="max_active_luns must be 0 (no limit) or more")
+
+    if profile_settings and not profile_name:
+        module.fail_json(msg="tpg_profile_settings given without a tpg_profile name")
+
+    for network in iscsi_networks:
+        if '/' in network and not valid_cidr(network):
+            module.fail_json(msg="Invalid 'iscsi_network' entry '{}' provided - must use CIDR notation "
+                                 "of a.b.c.d/nn or an interface name".format(network))
+
+    # skip the run if nothing has changed since the last successful run
+    fingerprint = RunFingerprint('igw_gateway', mode, module.params,
+                                 pool=module.params['config_pool'], cfg_name=module.params['config_name'])
+    if not verify_requested(module.params['verify']) and fingerprint.matches():
+        logger.info("SKIP  - GATEWAY configuration ({}) unchanged since the last run".format(mode))
+        module.exit_json(changed=False, meta={"msg": "Gateway setup unchanged - skipped"})
 
     logger.info("START - GATEWAY configuration started in mode {}".format(mode))
 
-    gateway = Gateway(gateway_iqn, iscsi_network)
+    gateway = Gateway(gateway_iqn, iscsi_networks)
 
     if mode == 'target':
 
+        # the config is read in the background, while the target is loaded (or created)
+        config = Config(logger, cfg_name=module.params['config_name'], pool=module.params['config_pool'],
+                        wait=False)
+
         if gateway.exists():
             gateway.load_config()
+            if not gateway.error:
+                gateway.reconcile_portals()
         else:
             gateway.create_target()
 
@@ -234,8 +336,7 @@ def main():
         else:
             # ensure that the config object has an entry for this gateway
             this_host = socket.gethostname().split('.')[0]
-            config = Config(logger)
-            if config.error:
+            if config.wait().error:
                 module.fail_json(msg=config.error_msg)
             else:
                 gateway_group = config.config["gateways"].keys()
@@ -245,13 +346,58 @@ def main():
                 if "iqn" not in gateway_group:
                     config.add_item("gateways", "iqn", initial_value=gateway.iqn)
 
+                # resolve the tpg profile - settings given in the playbook define (or redefine) the
+                # profile, otherwise the definition comes from the config object or the built-in profiles
+                if profile_name:
+                    cfg_profiles = config.config.get('tpg_profiles', {})
+                    if profile_settings is None:
+                        profile_settings = resolve_profile(profile_name, cfg_profiles, TPG_PROFILES)
+                        if profile_settings is None:
+                            module.fail_json(msg="tpg profile '{}' is not defined".format(profile_name))
+
+                    bad_settings = invalid_attributes(profile_settings, supported=TPG_PARAMETERS + TPG_ATTRIBUTES)
+                    if bad_settings:
+                        module.fail_json(msg="tpg profile '{}' contains unsupported settings {} - valid settings "
+                                             "are {}".format(profile_name, bad_settings,
+                                                             TPG_PARAMETERS + TPG_ATTRIBUTES))
+
+                    gateway.apply_profile(profile_name, profile_settings)
+
+                    # as with the iqn, every gateway records the same definition
+                    if cfg_profiles.get(profile_name) != profile_settings:
+                        config.update_item('tpg_profiles', profile_name, profile_settings)
+
                 if this_host not in gateway_group:
                     gateway_metadata = {"portal_ip_address": gateway.ip_address,
+                                        "portal_ip_addresses": gateway.ip_addresses,
                                         "iqn": gateway.iqn,
                                         "active_luns": 0}
+                    if profile_name:
+                        gateway_metadata['tpg_profile'] = profile_name
+                    if max_active_luns:
+                        gateway_metadata['max_active_luns'] = max_active_luns
 
                     config.add_item("gateways", this_host)
                     config.update_item("gateways", this_host, gateway_metadata)
+                else:
+                    # gateway already known, so just record any change to it's portal list, profile
+                    # or limit on active LUNs (0 removes the limit)
+                    gateway_metadata = config.config["gateways"][this_host]
+                    if (gateway_metadata.get("portal_ip_addresses") != gateway.ip_addresses or
+                            (profile_name and gateway_metadata.get('tpg_profile') != profile_name) or
+                            (max_active_luns is not None and
+                             gateway_metadata.get('max_active_luns', 0) != max_active_luns)):
+                        gateway_metadata["portal_ip_address"] = gateway.ip_address
+                        gateway_metadata["portal_ip_addresses"] = gateway.ip_addresses
+                        if profile_name:
+                            gateway_metadata['tpg_profile'] = profile_name
+                        if max_active_luns:
+                            gateway_metadata['max_active_luns'] = max_active_luns
+                        elif max_active_luns == 0:
+                            gateway_metadata.pop('max_active_luns', None)
+                        config.update_item("gateways", this_host, gateway_metadata)
+
+                if config.changed:
                     config.commit()
 
     elif mode == 'map':
@@ -270,6 +416,7 @@ def main():
             module.fail_json(msg="Attempted to map to a gateway '{}' that hasn't been defined yet..."
                                  "out of order steps?".format(gateway_iqn))
 
+    fingerprint.save()
     logger.info("END - GATEWAY configuration complete")
     module.exit_json(changed=gateway.changes_made, meta={"msg": "Gateway setup complete"})
 
@@ -286,4 +433,4 @@ if __name__ == '__main__':
     handler.setFormatter(log_fmt)
     logger.addHandler(handler)
 
-    main()
+    run_main(main, module_name)
@@ -9,16 +9,26 @@ from logging.handlers import RotatingFileHandler
 from socket import gethostname
 from time import sleep
 import os
-import rados
-import rbd
 
-from ansible.module_utils.basic import *
-from rtslib_fb import BlockStorageObject, root
-from rtslib_fb.utils import RTSLibError, fwrite, fread
+from ansible.module_utils.basic import AnsibleModule
+
+from ceph_iscsi_gw import alua, krbd
+from ceph_iscsi_gw.common import Config, CONFIG_ARGS
+from ceph_iscsi_gw.fingerprint import RunFingerprint, verify_requested
+from ceph_iscsi_gw.lio import derive_wwn
+from ceph_iscsi_gw.placement import PlacementError, desired_clients, set_owner
+from ceph_iscsi_gw.profiling import run_main
+from ceph_iscsi_gw.utils import LazyModule, convert_2_bytes, valid_size, wait_for
+from ceph_iscsi_gw.profiles import (BACKSTORE_ATTRIBUTES, invalid_attributes,
+                                    resolve_profile, apply_attributes)
+
+# the ceph and LIO bindings are loaded on first use, so a fingerprint match exits without them
+rados = LazyModule('rados')
+rbd = LazyModule('rbd')
+rtslib = LazyModule('rtslib_fb')
+root = LazyModule('rtslib_fb.root')
+rtslib_utils = LazyModule('rtslib_fb.utils')
 
-from ceph_iscsi_gw.common import Config
-
-SIZE_SUFFIXES = ['M', 'G', 'T']
 CEPH_CONF = '/etc/ceph/ceph.conf'
 KEYRING = '/etc/ceph/ceph.client.admin.keyring'
 
@@ -35,32 +45,6 @@ TIME_OUT_SECS = 30
 LOOP_DELAY = 2
 
 
-def convert_2_bytes(disk_size):
-    power = [2, 3, 4]
-    unit = disk_size[-1]
-    offset = SIZE_SUFFIXES.index(unit)
-    value = int(disk_size[:-1])     # already validated, so no need for try/except clause
-
-    _bytes = value*(1024**power[offset])
-
-    return _bytes
-
-
-def valid_size(size):
-    valid = True
-    unit = size[-1]
-
-    if unit.upper() not in SIZE_SUFFIXES:
-        valid = False
-    else:
-        try:
-            value = int(size[:-1])
-        except ValueError:
-            valid = False
-
-    return valid
-
-
 def get_rbd_map(module, image, pool):
     changed = False
     # Now look at mapping of the device - which would execute on all target hosts
@@ -148,14 +132,28 @@ def rbd_add_device(module, image, device_path, in_wwn=None):
     logger.info("(add_device) Adding image '{}' with path {} to LIO".format(image, device_path))
     new_lun = None
     try:
-        new_lun = BlockStorageObject(name=image, dev=device_path, wwn=in_wwn)
-        set_alua(new_lun, "standby")
-    except RTSLibError as err:
+        new_lun = rtslib.BlockStorageObject(name=image, dev=device_path, wwn=in_wwn)
+        alua.set_alua(new_lun, "standby")
+    except rtslib_utils.RTSLibError as err:
         module.fail_json(msg="failed to add {} to LIO - error({})".format(image, str(err)))
 
     return new_lun
 
 
+def rbd_image_id(image, pool, device_path):
+    """
+    Identify the rbd image, to derive its wwn from
+    :param image: rbd image name (str)
+    :param pool: pool (str) where the rbd image exists
+    :param device_path: path of the mapped image e.g. /dev/rbdX
+    :return: image id (str)
+    """
+
+    with rados.Rados(conffile=CEPH_CONF) as cluster:
+        with cluster.open_ioctx(pool) as ioctx:
+            return krbd.image_id(ioctx, image, device_path)
+
+
 def rbd_size(image, reqd_size, pool):
     """
     Confirm that the existing rbd image size, matches the requirement passed in the ansible
@@ -244,58 +242,27 @@ def rbdmap_entry(pool, image):
     return entry_needed
 
 
-def set_alua(lun, desired_state='standby'):
+def set_profile(lun, profile_name, attributes):
     """
-    Sets the ALUA state of a LUN (active/standby)
-    :param lun: LIO LUN object
-    :param desired_state: active or standby state
-    :return: None
+    Apply a backstore tuning profile to a LUN. Only attributes that differ from the
+    profile are written, so the LUN is updated in place on each run
+    :param lun: LIO LUN (storage) object
+    :param profile_name: name of the profile (str) - used for logging
+    :param attributes: dict of backstore attribute name -> value
+    :return: list of attribute names that were changed
     """
 
-    alua_state_options = {"active": '0',
-                          "active/unoptimized": '1',
-                          "standby": '2'}
-    configfs_path = lun.path
-    lun_name = lun.name
-    alua_access_state = 'alua/default_tg_pt_gp/alua_access_state'
-    alua_access_type = 'alua/default_tg_pt_gp/alua_access_type'
-    type_fullpath = os.path.join(configfs_path, alua_access_type)
-
-    if fread(type_fullpath) != 'Implicit':
-        logger.info("(set_alua) Switching device alua access type to Implicit - i.e. active path set by gateways")
-        fwrite(type_fullpath, '1')
-    else:
-        logger.debug("(set_alua) lun alua_access_type already set to Implicit - no change needed")
-
-    state_fullpath = os.path.join(configfs_path, alua_access_state)
-    if fread(state_fullpath) != alua_state_options[desired_state]:
-        logger.debug("(set_alua) Updating alua_access_state for {} to {}".format(lun_name,
-                                                                                 desired_state))
-        fwrite(state_fullpath, alua_state_options[desired_state])
-    else:
-        logger.debug("(set_alua) Skipping alua update - already set to desired state '{}'".format(desired_state))
-
-
-def set_owner(gateways):
-    """
-    Determine the gateway in the configuration with the lowest number of active LUNs. This
-    gateway is then selected as the owner for the primary path of the current LUN being
-    processed
-    :param gateways: gateway dict returned from the RADOS configuration object
-    :return: specific gateway hostname (str) that should provide the active path for the next LUN
-    """
+    changed, failed = apply_attributes(lun, attributes)
 
-    # Gateways contains simple attributes and dicts that define each gateways settings, so
-    # first we extract only the gateway node definitions from the gateways dict
-    gw_nodes = {key: gateways[key] for key in gateways if isinstance(gateways[key], dict)}
-    gw_items = gw_nodes.items()
+    for attr in changed:
+        logger.info("(set_profile) {} attribute '{}' set to {} "
+                    "(profile '{}')".format(lun.name, attr, attributes[attr], profile_name))
 
-    # first entry is the lowest number of active_luns
-    gw_items.sort(key=lambda x: (x[1]['active_luns']))
+    for attr in failed:
+        logger.warning("(set_profile) {} attribute '{}' could not be set to {} - "
+                       "{}".format(lun.name, attr, attributes[attr], failed[attr]))
 
-    # 1st tuple is gw with lowest active_luns, so return the 1st
-    # element which is the hostname
-    return gw_items[0][0]
+    return changed
 
 
 def main():
@@ -309,7 +276,11 @@ def main():
         "image": {"required": True, "type": "str"},
         "size": {"required": True, "type": "str"},
         "host": {"required": True, "type": "str"},
+        "profile": {"required": False, "type": "str"},
+        "profile_attributes": {"required": False, "type": "dict"},
         "features": {"required": False, "type": "str"},
+        "verify": {"required": False, "type": "bool", "default": False},
+        "clients": {"required": False, "type": "list"},
         "state": {
             "default": "present",
             "choices": ['present', 'absent'],
@@ -320,6 +291,8 @@ def main():
     updates_made = False
 
     # not supporting check mode currently
+    fields.update(CONFIG_ARGS)
+
     module = AnsibleModule(argument_spec=fields,
                            supports_check_mode=False)
 
@@ -327,6 +300,11 @@ def main():
     image = module.params['image']
     size = module.params['size']
     target_host = module.params['host']
+    profile_name = module.params['profile']
+    profile_attributes = module.params['profile_attributes']
+
+    if profile_attributes and not profile_name:
+        module.fail_json(msg="(main) profile_attributes given for image '{}' without a profile name".format(image))
 
     if not valid_size(size):
         logger.critical("image '{}' has an invalid size specification '{}' in the ansible configuration".format(image,
@@ -334,18 +312,28 @@ def main():
         module.fail_json(msg="(main) Unable to use the size parameter '{}' for image '{}' from the playbook - "
                              "must be a number suffixed by M, G or T".format(size, image))
 
-    config = Config(logger)
-    if config.error:
-        module.fail_json(msg=config.error_msg)
-
-    # Before we start make sure that the target host is actually defined to the config
-    if target_host not in config.config['gateways'].keys():
-        logger.critical("target host is not valid, please check the config entry for this rbd image")
-        module.fail_json(msg="(main) host name given for {} is not a valid gateway name".format(image))
-
-    if config.platform != 'rbd':
+    # the desired client definitions (client_connections) only guide the placement of a new LUN,
+    # since the LUNs are normally added before igw_client defines the clients
+    for entry in module.params['clients'] or []:
+        if not isinstance(entry, dict) or 'client' not in entry:
+            module.fail_json(msg="Invalid clients entry '{}' - each entry must be a dict with a "
+                                 "'client' key".format(entry))
+
+    # skip the run if nothing has changed since the last successful run
+    fingerprint = RunFingerprint('igw_lun', '{}/{}'.format(pool, image), module.params,
+                                 ignore=('verify', 'clients'),
+                                 pool=module.params['config_pool'], cfg_name=module.params['config_name'])
+    if not verify_requested(module.params['verify']) and fingerprint.matches():
+        logger.info("SKIP  - LUN configuration for {}/{} unchanged since the last run".format(pool, image))
+        module.exit_json(changed=False, meta={"msg": "Configuration unchanged - skipped"})
+
+    if Config.get_platform() != 'rbd':
         module.fail_json(msg="Storage platform not supported. Only Ceph is currently supported.")
 
+    # the config is read in the background, while the pool is checked and listed
+    config = Config(logger, cfg_name=module.params['config_name'], pool=module.params['config_pool'],
+                    wait=False)
+
     logger.info("START - LUN configuration started for {} {}/{}".format(config.platform, pool, image))
 
     # ensure the rbd pool is valid
@@ -357,10 +345,37 @@ def main():
     # first look at disks in the specified pool
     disk_list = rbd_list(pool)
     logger.debug("rbd pool contains the following - {}".format(disk_list))
+
+    if config.wait().error:
+        module.fail_json(msg=config.error_msg)
+
+    # Before we start make sure that the target host is actually defined to the config
+    if target_host not in config.config['gateways'].keys():
+        logger.critical("target host is not valid, please check the config entry for this rbd image")
+        module.fail_json(msg="(main) host name given for {} is not a valid gateway name".format(image))
+
     this_host = gethostname().split('.')[0]
     logger.debug("Hostname Check - this host is {}, target host for allocations is {}".format(this_host,
                                                                                               target_host))
 
+    # resolve the tuning profile - attributes given in the playbook define (or redefine) the
+    # profile, otherwise the definition comes from the config object or the built-in profiles
+    if profile_name:
+        cfg_profiles = config.config.get('backstore_profiles', {})
+        if profile_attributes is None:
+            profile_attributes = resolve_profile(profile_name, cfg_profiles)
+            if profile_attributes is None:
+                module.fail_json(msg="(main) tuning profile '{}' requested for image '{}' is not "
+                                     "defined".format(profile_name, image))
+
+        bad_attributes = invalid_attributes(profile_attributes)
+        if bad_attributes:
+            module.fail_json(msg="(main) profile '{}' contains unsupported attributes {} - valid attributes "
+                                 "are {}".format(profile_name, bad_attributes, BACKSTORE_ATTRIBUTES))
+
+        if this_host == target_host and cfg_profiles.get(profile_name) != profile_attributes:
+            config.update_item('backstore_profiles', profile_name, profile_attributes)
+
     # if the image required isn't defined, create it!
     if image not in disk_list:
         # create the requested disk if this is the 'owning' host
@@ -421,90 +436,92 @@ def main():
     # now see if we need to add this rbd image to LIO
     lun = lun_in_lio(image)
     if not lun:
-        # this image has not been defined to LIO, so check the config for the details and
-        # if it's  missing define the wwn/alua_state and update the config
-
-        if this_host == target_host:
-            # first check to see if the device needs adding
+        # this image has not been defined to LIO. A wwn already in the config is kept, otherwise
+        # the wwn is derived from the rbd image - so every gateway adds the LUN straight away,
+        # without waiting for the owning host to publish the wwn
+        # NB. a non-owner that waited for the owner to create the image has no entry for it yet
+        wwn = config.config['disks'].get(image, {}).get('wwn', '')
+        register = not wwn and this_host == target_host
+        if not wwn:
+            wwn = derive_wwn(pool, image, rbd_image_id(image, pool, map_device))
+
+        if register:
+            # the owner is chosen first, so a LUN that no gateway has room for isn't added to LIO
             try:
-                wwn = config.config['disks'][image]['wwn']
-            except KeyError:
-                wwn = ''
+                owner = set_owner(config.config['gateways'], live=config.live_gateways(), image=image,
+                                  disks=config.config['disks'],
+                                  clients=desired_clients(config.config['clients'], module.params['clients']))
+            except PlacementError as err:
+                module.fail_json(msg=str(err))
+            logger.debug("Owner for {} will be {}".format(image, owner))
 
-            if wwn == '':
-                # disk hasn't been defined before
-                lun = rbd_add_device(module, image, map_device)
-                wwn = lun._get_wwn()
-                owner = set_owner(config.config['gateways'])
-                logger.debug("Owner for {} will be {}".format(image, owner))
+        lun = rbd_add_device(module, image, map_device, wwn)
 
-                disk_attr = {"wwn": wwn, "owner": owner}
-                config.update_item('disks', image, disk_attr)
+        if register:
+            disk_attr = {"wwn": wwn, "owner": owner, "pool": pool}
+            if profile_name:
+                disk_attr['profile'] = profile_name
+            config.update_item('disks', image, disk_attr)
 
-                gateway_dict = config.config['gateways'][owner]
-                gateway_dict['active_luns'] += 1
+            gateway_dict = config.config['gateways'][owner]
+            gateway_dict['active_luns'] += 1
 
-                config.update_item('gateways', owner, gateway_dict)
+            config.update_item('gateways', owner, gateway_dict)
 
-                logger.debug("(main) registered '{}' with wwn '{}' with the config object".format(image, wwn))
-                logger.info("(main) added '{}/{}' to LIO".format(pool, image))
+            logger.debug("(main) registered '{}' with wwn '{}' with the config object".format(image, wwn))
 
-            else:
-                # config already has wwn and owner information
-                lun = rbd_add_device(module, image, map_device, wwn)
-                logger.debug("(main) registered '{}' with wwn '{}' from the config object".format(image, wwn))
+        logger.info("(main) added '{}/{}' to LIO using wwn '{}'".format(pool, image, wwn))
+        updates_made = True
+        num_changes += 1
 
+    if profile_name:
+        if set_profile(lun, profile_name, profile_attributes):
             updates_made = True
             num_changes += 1
 
-        else:
-            # lun is not already in LIO, but this is not the owning node that defines the wwn
-            # we need the wwn from the config (placed by the owning node), so we wait!
-            waiting = 0
-            while waiting < TIME_OUT_SECS:
-                config.refresh()
-                if image in config.config['disks']:
-                    if 'wwn' in config.config['disks'][image]:
-                        if config.config['disks'][image]['wwn']:
-                            wwn = config.config['disks'][image]['wwn']
-                            break
-                sleep(LOOP_DELAY)
-                waiting += LOOP_DELAY
-                logger.debug("waiting for config object to show {} with it's wwn".format(image))
+        # record the profile against the disk, so the config reflects the running state
+        disk_attr = config.config['disks'].get(image, {})
+        if this_host == target_host and disk_attr.get('profile') != profile_name:
+            disk_attr['profile'] = profile_name
+            config.update_item('disks', image, disk_attr)
 
-            if waiting >= TIME_OUT_SECS:
-                module.fail_json(msg="(main) waited too long for the wwn information on image {}".format(image))
+    # the owning host for an image is the only host that commits to the config. The commit
+    # (including any wait for the config lock) runs while the alua state is checked
+    commit = None
+    if this_host == target_host and config.changed:
+        logger.debug("(main) Committing change(s) to the config object in pool {}".format(pool))
+        commit = config.commit_async()
 
-            # At this point we have a usable config, so we just need to add the wwn
-            lun = rbd_add_device(module, image, map_device, wwn)
+    logger.debug("Checking ALUA state for this rbd image")
 
-            logger.debug("(main) added {} to LIO using wwn '{}' defined by {}".format(image,
-                                                                                      wwn,
-                                                                                      target_host))
-            logger.info("(main) added {} to LIO for this gateway".format(image))
-            updates_made = True
-            num_changes += 1
+    # lun/image is defined to LIO, so just check the preferred alua state is OK. A new disk's
+    # owner is chosen by the owning host, so this is the only point that may wait for it
+    if not config.config['disks'].get(image, {}).get('owner'):
+        def _registered():
+            config.refresh()
+            return config.config['disks'].get(image, {}).get('owner')
 
-    logger.debug("Checking ALUA state for this rbd image")
+        if not wait_for(_registered, TIME_OUT_SECS, LOOP_DELAY):
+            module.fail_json(msg="(main) waited too long for the owner of image {} to be registered".format(image))
 
-    # lun/image is defined to LIO, so just check the preferred alua state is OK
     if config.config['disks'][image]["owner"] == this_host:
-        # get LUN object for this image
-        logger.info("Setting alua state to active for image {}".format(image))
-        set_alua(lun, 'active')
+        desired_state = 'active'
     else:
-        logger.info("Setting alua state to standby for image {}".format(image))
-        set_alua(lun, 'standby')
+        desired_state = 'standby'
 
-    # the owning host for an image is the only host that commits to the config
-    if this_host == target_host and config.changed:
+    if alua.set_alua(lun, desired_state):
+        logger.info("Set alua state to {} for image {}".format(desired_state, image))
+    else:
+        logger.debug("alua state for image {} already {} - no change needed".format(image, desired_state))
 
-        logger.debug("(main) Committing change(s) to the config object in pool {}".format(pool))
-        config.commit()
+    if commit is not None:
+        commit.result()
         if config.error:
             module.fail_json(msg="Unable to commit changes to config object '{}' in pool '{}'".format(config.config_name,
                                                                                                   config.pool))
 
+    fingerprint.save()
+
     if not updates_made:
         logger.info("END   - No changes needed")
     else:
@@ -525,4 +542,4 @@ if __name__ == '__main__':
     handler.setFormatter(log_fmt)
     logger.addHandler(handler)
 
-    main()
+    run_main(main, module_name)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+__author__ = 'pcuzner@redhat.com'
+
+import logging
+import os
+import time
+
+from logging.handlers import RotatingFileHandler
+from ansible.module_utils.basic import AnsibleModule
+
+from ceph_iscsi_gw import persist
+from ceph_iscsi_gw.profiling import run_main
+
+
+def main():
+    # Saves the running LIO configuration (in place of targetcli saveconfig) - the file is
+    # only rewritten when its content would change. In restore mode, a saved configuration
+    # (or the selected storage objects/targets from it) is added back to LIO
+    fields = {
+        "mode": {
+            "required": False,
+            "default": "save",
+            "choices": ['save', 'restore'],
+            "type": "str"
+        },
+        "path": {"required": False, "type": "str", "default": persist.SAVE_FILE},
+        "storage_objects": {"required": False, "type": "list"},
+        "targets": {"required": False, "type": "list"}
+    }
+
+    module = AnsibleModule(argument_spec=fields,
+                           supports_check_mode=False)
+
+    mode = module.params['mode']
+    path = module.params['path']
+    start = time.time()
+
+    if mode == 'save':
+        saved = persist.save_lio(path)
+        elapsed = time.time() - start
+        if saved:
+            logger.info("(main) LIO configuration saved to {} ({:.3f}s)".format(path, elapsed))
+        else:
+            logger.debug("(main) LIO configuration unchanged - {} not rewritten".format(path))
+
+        module.exit_json(changed=saved,
+                         elapsed=round(elapsed, 3),
+                         meta={"msg": "LIO configuration {}".format('saved' if saved else 'unchanged')})
+
+    if not os.path.exists(path):
+        module.fail_json(msg="No saved LIO configuration at {}".format(path))
+
+    try:
+        errors = persist.restore_lio(path,
+                                     storage_objects=module.params['storage_objects'],
+                                     targets=module.params['targets'])
+    except ValueError as err:
+        module.fail_json(msg="Unable to read the saved LIO configuration in {} - {}".format(path, err))
+
+    elapsed = time.time() - start
+    logger.info("(main) LIO configuration restored from {} with {} errors "
+                "({:.3f}s)".format(path, len(errors), elapsed))
+
+    if errors:
+        module.fail_json(msg="LIO restore from {} reported errors".format(path), errors=errors)
+
+    module.exit_json(changed=True,
+                     elapsed=round(elapsed, 3),
+                     meta={"msg": "LIO configuration restored from {}".format(path)})
+
+
+if __name__ == '__main__':
+
+    module_name = os.path.basename(__file__).replace('ansible_module_', '')
+    logger = logging.getLogger(os.path.basename(module_name))
+    logger.setLevel(logging.DEBUG)
+    handler = RotatingFileHandler('/var/log/ansible-module-igw_config.log',
+                                  maxBytes=5242880,
+                                  backupCount=7)
+    log_fmt = logging.Formatter('%(asctime)s %(name)s %(levelname)-8s : %(message)s')
+    handler.setFormatter(log_fmt)
+    logger.addHandler(handler)
+
+    run_main(main, module_name)
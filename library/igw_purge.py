@@ -2,180 +2,333 @@
 
 __author__ = 'pcuzner@redhat.com'
 
+import datetime
 import logging
+import os
 import socket
-import subprocess
-import fileinput
+import threading
+import time
 
 from logging.handlers import RotatingFileHandler
-from ansible.module_utils.basic import *
+from ansible.module_utils.basic import AnsibleModule
 
-from rtslib_fb import root
-from rtslib_fb.utils import RTSLibError
+from ceph_iscsi_gw import krbd, persist
+from ceph_iscsi_gw.common import Config, CONFIG_ARGS
+from ceph_iscsi_gw.lio import LIOSnapshot
+from ceph_iscsi_gw.placement import get_update_host
+from ceph_iscsi_gw.profiling import run_main
+from ceph_iscsi_gw.utils import LazyModule, run_parallel
 
-from ceph_iscsi_gw.common import Config
+rados = LazyModule('rados')
+rbd = LazyModule('rbd')
+rtslib_utils = LazyModule('rtslib_fb.utils')
 
+CEPH_CONF = '/etc/ceph/ceph.conf'
 
-class LIO(object):
-    def __init__(self):
-        self.lio_root = root.RTSRoot()
-        self.error = False
-        self.error_msg = ''
-        self.changed = False
-
-    def save_config(self):
-        self.lio_root.save_to_file()
-
-    def drop_lun_maps(self, config):
+# pool assumed for disks registered before the config recorded each disk's pool
+RBD_POOL = 'rbd'
 
-        configured_images = config.config['disks'].keys()
+# concurrent image deletes - each one keeps the OSDs busy deleting objects, so this is kept
+# modest by default
+DELETE_WORKERS = 4
 
-        for stg_object in self.lio_root.storage_objects:
-            if stg_object.name in configured_images and 'rbd' in stg_object.udev_path:
+# concurrent krbd unmaps during a gateway teardown
+UNMAP_WORKERS = 16
 
-                # this is an rbd device that's in the config object, so remove it
-                try:
-                    stg_object.delete()
-                    rbd_unmap(stg_object.name)
-
-                    self.changed = True
-                    # update the disk item to remove the wwn information
-                    image_metadata = config.config['disks'][stg_object.name]   # current disk meta data dict
-                    image_metadata['wwn'] = ''
-                    config.update_item("disks", stg_object.name, image_metadata)
-
-                except RTSLibError as err:
-                    self.error = True
-                    self.error_msg = err
-
-                except subprocess.CalledProcessError:
-                    self.error = True
-                    self.error_msg = "Unable to unmap {} from {}".format(stg_object.name,
-                                                                         stg_object.udev_path)
 
+class GatewayTeardown(object):
+    """
+    Removes this gateway's LIO configuration and krbd mappings, working from a single
+    snapshot of LIO
+    """
 
-class Gateway(LIO):
+    def __init__(self, config, this_host, workers=UNMAP_WORKERS):
+        self.config = config
+        self.this_host = this_host
+        self.workers = workers
+        self.error = False
+        self.error_msg = ''
+        self.changed = False
+        self.timings = {}
 
-    def __init__(self, config_object):
-        LIO.__init__(self)
+        gateways = config.config['gateways']
+        self.iqn = gateways.get(this_host, {}).get('iqn', gateways.get('iqn'))
 
-        self.config = config_object
+        start = time.time()
+        self.lio = LIOSnapshot(self.iqn)
+        self.timings['snapshot'] = time.time() - start
 
     def session_count(self):
-        return len(list(self.lio_root.sessions))
-
-    def drop_target(self, this_host):
-        iqn = self.config.config['gateways'][this_host]['iqn']
+        return len(list(self.lio.root.sessions))
+
+    def drop_target(self):
+        """
+        Delete the gateway's target. rtslib removes the tpg, portals, ACLs and LUNs with it,
+        so the backstores have no LUNs left referencing them when they are deleted
+        """
+
+        if self.lio.target is None:
+            return
+
+        start = time.time()
+        try:
+            self.lio.target.delete()
+        except rtslib_utils.RTSLibError as err:
+            self.error = True
+            self.error_msg = "Unable to delete target {} - {}".format(self.iqn, err)
+            return
+
+        self.lio.target = None
+        self.lio.tpg = None
+        self.changed = True
+        self.timings['target'] = time.time() - start
+
+    def drop_backstores(self):
+        """
+        Delete the storage objects of the rbd images in the config, unmap their krbd
+        devices concurrently, then remove them from the rbdmap file in one rewrite
+        """
+
+        configured_images = self.config.config['disks']
+
+        start = time.time()
+        devices = {}
+        for image_name, stg_object in self.lio.storage_objects.items():
+            if image_name not in configured_images or 'rbd' not in stg_object.udev_path:
+                continue
 
-        lio_root = root.RTSRoot()
-        for tgt in lio_root.targets:
-            if tgt.wwn == iqn:
-                tgt.delete()
-                self.changed = True
-                # remove the gateway from the config dict
-                self.config.del_item('gateways', this_host)
+            devices[image_name] = stg_object.udev_path
+            try:
+                stg_object.delete()
+            except rtslib_utils.RTSLibError as err:
+                self.error = True
+                self.error_msg = "Unable to delete the backstore for {} - {}".format(image_name, err)
+                return
 
+            self.changed = True
+            # update the disk item to remove the wwn information
+            image_metadata = configured_images[image_name]
+            image_metadata['wwn'] = ''
+            self.config.update_item("disks", image_name, image_metadata)
 
-def rbd_unmap(image_name):
+        self.timings['backstores'] = time.time() - start
 
-    try:
-        subprocess.check_output("rbd unmap {}".format(image_name), shell=True)
-    except subprocess.CalledProcessError:
-        unmap_ok = False
-    else:
-        unmap_ok = True
+        start = time.time()
+        results = run_parallel(krbd.unmap_device, sorted(devices.values()), workers=self.workers)
+        failed = [device for device, _, err in results if err]
+        unmapped = [image_name for image_name in devices if devices[image_name] not in failed]
+        self.timings['unmap'] = time.time() - start
 
         # unmap'd from runtime, now remove from the rbdmap file referenced at boot
-        for rbdmap_entry in fileinput.input('/etc/ceph/rbdmap', inplace=True):
-            if image_name in rbdmap_entry:
-                continue
-            print rbdmap_entry.strip()
+        krbd.remove_rbdmap_entries(unmapped)
 
-    return unmap_ok
+        if failed:
+            self.error = True
+            self.error_msg = "Unable to unmap {}".format(','.join(failed))
 
+    def save_config(self):
+        # only rewritten when the saved content changes
+        return persist.save_lio(lio_root=self.lio.root)
 
-def delete_group(module, image_list, cfg):
 
-    logger.debug("RBD Images to delete are : {}".format(','.join(image_list)))
-    pending_list = list(image_list)
+def delete_group(image_list, cfg, workers=DELETE_WORKERS, trash=False, trash_delay=0):
+    """
+    Delete (or move to the rbd trash) a group of images in parallel, then remove them from
+    the config object in a single commit. Trashed images are recorded in the config's trash
+    section, so a later trash purge removes only the images moved there by this module
+    :param image_list: list of image names
+    :param cfg: Config object
+    :param workers: maximum number of concurrent deletes
+    :param trash: move the images to the trash instead of deleting them
+    :param trash_delay: seconds a trashed image is protected from a trash purge
+    :return: dict of images that could not be removed {image_name: error}
+    """
 
-    for image_name in image_list:
-        if delete_rbd(module, image_name):
+    action = 'trash' if trash else 'delete'
+    logger.debug("RBD Images to {} are : {}".format(action, ','.join(image_list)))
+
+    progress = {"done": 0}
+    progress_lock = threading.Lock()
+
+    image_pools = dict((image_name, cfg.config['disks'].get(image_name, {}).get('pool', RBD_POOL))
+                       for image_name in image_list)
+
+    with rados.Rados(conffile=CEPH_CONF) as cluster:
+        ioctxs = dict((pool, cluster.open_ioctx(pool)) for pool in set(image_pools.values()))
+
+        def _remove(image_name):
+            try:
+                return delete_rbd(ioctxs[image_pools[image_name]], image_name, trash, trash_delay)
+            finally:
+                with progress_lock:
+                    progress['done'] += 1
+                    logger.info("(delete_group) {} of {} images processed "
+                                "({})".format(progress['done'], len(image_list), image_name))
+
+        try:
+            results = run_parallel(_remove, image_list, workers=workers)
+        finally:
+            for ioctx in ioctxs.values():
+                ioctx.close()
+
+    failed = {}
+    for image_name, image_id, err in results:
+        if err:
+            failed[image_name] = err.strip().splitlines()[-1]
+            logger.error("(delete_group) unable to {} {} : {}".format(action, image_name,
+                                                                     failed[image_name]))
+        else:
             cfg.del_item('disks', image_name)
-            pending_list.remove(image_name)
-            cfg.changed = True
+            if image_id:
+                cfg.update_item('trash', image_id, {"pool": image_pools[image_name],
+                                                    "name": image_name,
+                                                    "trashed": time.time()})
 
     if cfg.changed:
         cfg.commit()
+    elif cfg.config_locked:
+        cfg.unlock()
 
-    return pending_list
+    return failed
 
 
-def delete_rbd(module, image_name):
+def delete_rbd(ioctx, image_name, trash=False, trash_delay=0):
+    """
+    Delete an rbd image through librbd
+    :param ioctx: rados ioctx for the image's pool
+    :param image_name: rbd image name (str)
+    :param trash: move the image to the trash instead - the objects are removed later by a
+                  trash purge, so this returns immediately
+    :param trash_delay: seconds before the trashed image may be purged
+    :return: the image id of a trashed image (the trash entry's key), otherwise None
+    """
 
-    logger.debug("issuing delete for {}".format(image_name))
-    rm_cmd = 'rbd --no-progress rm {}'.format(image_name)
-    rc, rm_out, err = module.run_command(rm_cmd, use_unsafe_shell=True)
-    logger.debug("delete RC = ".format(rc))
+    logger.debug("issuing {} for {}".format('trash move' if trash else 'delete', image_name))
+    rbd_inst = rbd.RBD()
+    try:
+        if trash:
+            with rbd.Image(ioctx, image_name, read_only=True) as image:
+                image_id = image.id()
+            rbd_inst.trash_move(ioctx, image_name, trash_delay)
+            return image_id
+        else:
+            rbd_inst.remove(ioctx, image_name)
+    except rbd.ImageNotFound:
+        logger.warning("(delete_rbd) {} is already gone".format(image_name))
 
-    return True if rc == 0 else False
+    return None
 
 
-def get_update_host(config):
+def purge_trash(pool, cfg, workers=DELETE_WORKERS):
     """
-    decide which gateway host should be responsible for any config object updates
-    :param config: configuration dict from the rados pool
-    :return: a suitable gateway host that is online
+    Remove the images a 'disks' purge moved to the pool's rbd trash (recorded in the config's
+    trash section) whose deferment period has ended. Other trash entries, e.g. images trashed
+    by hand, are left alone. The config records of the purged images are dropped, as are the
+    records of images no longer in the trash (restored or already removed) - the caller
+    commits the config
+    :param pool: pool name
+    :param cfg: Config object
+    :param workers: maximum number of concurrent removes
+    :return: (list of purged image names, dict of failures {image_name: error})
     """
 
-    ptr = 0
-    potential_hosts = [host_name for host_name in config["gateways"].keys()
-                       if isinstance(config["gateways"][host_name], dict)]
+    recorded = dict((image_id, entry) for image_id, entry in cfg.config.get('trash', {}).items()
+                    if entry.get('pool', RBD_POOL) == pool)
+    if not recorded:
+        return [], {}
+
+    with rados.Rados(conffile=CEPH_CONF) as cluster:
+        with cluster.open_ioctx(pool) as ioctx:
+            rbd_inst = rbd.RBD()
+            in_trash = dict((entry['id'], entry) for entry in rbd_inst.trash_list(ioctx))
+
+            for image_id in sorted(recorded):
+                if image_id not in in_trash:
+                    logger.info("(purge_trash) {} ({}) is no longer in the trash - dropping its "
+                                "record".format(recorded[image_id]['name'], image_id))
+                    cfg.del_item('trash', image_id)
+
+            # deferment_end_time is reported in UTC
+            now = datetime.datetime.utcnow()
+            expired = [in_trash[image_id] for image_id in sorted(recorded)
+                       if image_id in in_trash and in_trash[image_id]['deferment_end_time'] <= now]
+
+            def _purge(entry):
+                try:
+                    rbd_inst.trash_remove(ioctx, entry['id'])
+                except rbd.ImageNotFound:
+                    # another gateway got there first
+                    pass
+                logger.info("(purge_trash) purged {} ({})".format(entry['name'], entry['id']))
+
+            results = run_parallel(_purge, expired, workers=workers)
+
+    for entry, _, err in results:
+        if not err:
+            cfg.del_item('trash', entry['id'])
 
-    # Assume the 1st element from the list is OK for now
-    # TODO check the potential hosts are online/available
+    purged = [entry['name'] for entry, _, err in results if not err]
+    failed = dict((entry['name'], err.strip().splitlines()[-1]) for entry, _, err in results if err)
+
+    return purged, failed
 
-    return potential_hosts[ptr]
 
 def main():
 
     fields = {"mode": {"required": True,
                        "type": "str",
-                       "choices": ["gateway", "disks"]
-                       }
+                       "choices": ["gateway", "disks", "trash"]
+                       },
+              "workers": {"required": False, "type": "int", "default": DELETE_WORKERS},
+              "trash": {"required": False, "type": "bool", "default": False},
+              "trash_delay": {"required": False, "type": "int", "default": 0},
+              "pools": {"required": False, "type": "list", "default": [RBD_POOL]}
               }
 
+    fields.update(CONFIG_ARGS)
+
     module = AnsibleModule(argument_spec=fields,
                            supports_check_mode=False)
 
     run_mode = module.params['mode']
+    workers = module.params['workers']
+    trash = module.params['trash']
     changes_made = False
+    meta = {"msg": "Purge of iSCSI settings ({}) complete".format(run_mode)}
+
+    if workers < 1:
+        module.fail_json(msg="workers must be at least 1")
+
+    if (trash or run_mode == 'trash') and not hasattr(rbd.RBD, 'trash_move'):
+        module.fail_json(msg="The installed librbd bindings do not support the rbd trash")
 
     logger.info("START - GATEWAY configuration PURGE started, run mode is {}".format(run_mode))
-    cfg = Config(logger)
-    this_host = socket.gethostname().split('.')[0]
+    cfg = Config(logger, cfg_name=module.params['config_name'], pool=module.params['config_pool'])
+    if cfg.error:
+        module.fail_json(msg=cfg.error_msg)
 
-    update_host = get_update_host(cfg.config)
+    this_host = socket.gethostname().split('.')[0]
 
     #
     # Purge gateway configuration, if the config has gateways
     if run_mode == 'gateway' and len(cfg.config['gateways'].keys()) > 0:
 
-        lio = LIO()
-        gateway = Gateway(cfg)
+        update_host = get_update_host(cfg.config, live=cfg.live_gateways())
 
-        if gateway.session_count() > 0:
+        teardown = GatewayTeardown(cfg, this_host)
+
+        if teardown.session_count() > 0:
             module.fail_json(msg="Unable to purge - gateway still has active sessions")
 
-        gateway.drop_target(this_host)
-        if gateway.error:
-            module.fail_json(msg=gateway.error_msg)
+        teardown.drop_target()
+        if teardown.error:
+            module.fail_json(msg=teardown.error_msg)
 
-        lio.drop_lun_maps(cfg)
-        if lio.error:
-            module.fail_json(msg=lio.error_msg)
+        teardown.drop_backstores()
+        if teardown.error:
+            module.fail_json(msg=teardown.error_msg)
 
-        if gateway.changed or lio.changed:
+        if teardown.changed:
 
             if this_host == update_host:
                 cfg.reset = True
@@ -189,9 +342,13 @@ def main():
 
                 cfg.commit()
 
-            lio.save_config()
+            start = time.time()
+            teardown.save_config()
+            teardown.timings['save'] = time.time() - start
             changes_made = True
 
+        meta['timings'] = dict((phase, round(secs, 3)) for phase, secs in teardown.timings.items())
+
 
     elif run_mode == 'disks' and len(cfg.config['disks'].keys()) > 0:
         #
@@ -199,11 +356,13 @@ def main():
         #
         # if the owner field for a disk is set to this host, this host can safely delete it
         # nb. owner gets set by the rebalance process
-        images_left = []
+        start = time.time()
+        images_left = {}
         # delete_list will contain a list of image names where the owner is this host
         delete_list = [key for key in cfg.config['disks'] if cfg.config['disks'][key]['owner'] == this_host]
         if delete_list:
-            images_left = delete_group(module, delete_list, cfg)
+            images_left = delete_group(delete_list, cfg, workers=workers, trash=trash,
+                                       trash_delay=module.params['trash_delay'])
         else:
             # no disks have an owner that matches this system, so we need to lock the config and
             # attempt to drop all luns - competing locks from each gateway running the 'purge'
@@ -214,7 +373,8 @@ def main():
                 cfg.refresh()
                 delete_list = cfg.config['disks'].keys()
                 if delete_list:
-                    images_left = delete_group(module, delete_list, cfg)
+                    images_left = delete_group(delete_list, cfg, workers=workers, trash=trash,
+                                               trash_delay=module.params['trash_delay'])
                 else:
                     logger.debug("Config lock obtained, but there are no disks remaining")
                     cfg.unlock()
@@ -222,17 +382,45 @@ def main():
                 # couldn't get a lock before the timeout was encountered
                 logger.debug("Couldn't get a lock on the config - '{}'".format(cfg.error_msg))
 
+        removed = [image_name for image_name in delete_list if image_name not in images_left]
+        meta.update({"trashed" if trash else "deleted": removed,
+                     "failed": images_left,
+                     "elapsed": round(time.time() - start, 2)})
+
         # if the delete list still has entries we had problems deleting the images
         if images_left:
-            module.fail_json(msg="Problems deleting the following rbd's : {}".format(','.join(images_left)))
+            module.fail_json(msg="Problems deleting the following rbd's : "
+                                 "{}".format(','.join(sorted(images_left))), meta=meta)
 
         changes_made = cfg.changed
 
         logger.debug("ending lock state variable {}".format(cfg.config_locked))
 
+    elif run_mode == 'trash':
+        #
+        # deferred removal of images previously moved to the trash by a 'disks' purge
+        start = time.time()
+        purged, failed = [], {}
+        for pool in module.params['pools']:
+            pool_purged, pool_failed = purge_trash(pool, cfg, workers=workers)
+            purged.extend(pool_purged)
+            failed.update(pool_failed)
+        if cfg.changed:
+            cfg.commit()
+            if cfg.error:
+                module.fail_json(msg="Unable to update the trash records in the config - {}".format(cfg.error_msg))
+        meta.update({"purged": purged,
+                     "failed": failed,
+                     "elapsed": round(time.time() - start, 2)})
+        if failed:
+            module.fail_json(msg="Problems purging the following rbd's from the trash : "
+                                 "{}".format(','.join(sorted(failed))), meta=meta)
+
+        changes_made = len(purged) > 0
+
     logger.info("END   - GATEWAY configuration PURGE complete")
 
-    module.exit_json(changed=changes_made, meta={"msg": "Purge of iSCSI settings ({}) complete".format(run_mode)})
+    module.exit_json(changed=changes_made, meta=meta)
 
 if __name__ == '__main__':
 
@@ -246,4 +434,4 @@ if __name__ == '__main__':
     handler.setFormatter(log_fmt)
     logger.addHandler(handler)
 
-    main()
+    run_main(main, module_name)
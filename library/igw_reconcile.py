@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+__author__ = 'pcuzner@redhat.com'
+
+import logging
+import os
+import time
+
+from socket import gethostname
+from logging.handlers import RotatingFileHandler
+from ansible.module_utils.basic import AnsibleModule
+
+from ceph_iscsi_gw.agent import AgentUnavailable, RECONCILE_TIMEOUT, find_agent
+from ceph_iscsi_gw.common import Config, CONFIG_ARGS
+from ceph_iscsi_gw.fingerprint import RunFingerprint, verify_requested
+from ceph_iscsi_gw.profiling import run_main
+from ceph_iscsi_gw.reconcile import Reconciler
+
+
+def reconcile_local(request, pool, cfg_name):
+    """
+    Plan (or apply) the gateway configuration in this process
+    :param request: dict of reconcile arguments
+    :param pool: pool holding the gateway group's config object
+    :param cfg_name: config object name
+    :return: dict - error (str), plan (list), changes (int) and timings (dict)
+    """
+
+    # the config is read in the background, while the reconciler walks LIO and lists the pools
+    config = Config(logger, cfg_name=cfg_name, pool=pool, use_agent=False, wait=False)
+
+    reconciler = Reconciler(logger, config,
+                            request['gateway_iqn'],
+                            request['rbd_devices'],
+                            request['client_connections'],
+                            request['this_host'])
+
+    plan = reconciler.build_plan()
+    if not reconciler.error and request['mode'] == 'apply':
+        reconciler.apply()
+
+    # NB. the background read is joined before the session is closed - validation may have
+    # failed before the reconciler needed the config
+    config.wait().ceph.shutdown()
+
+    return {"error": reconciler.error_msg if reconciler.error else '',
+            "plan": [step.as_dict() for step in plan],
+            "changes": reconciler.changes,
+            "timings": reconciler.timings}
+
+
+def main():
+    # Reconciles the whole gateway (disks, tpg luns, clients and alua state) in one pass.
+    # mode 'plan' is read-only, and reports the steps that 'apply' would perform
+    fields = {
+        "gateway_iqn": {"required": True, "type": "str"},
+        "rbd_devices": {"required": False, "type": "list", "default": []},
+        "client_connections": {"required": False, "type": "list", "default": []},
+        "mode": {
+            "required": False,
+            "default": "plan",
+            "choices": ['plan', 'apply'],
+            "type": "str"
+        },
+        "verify": {"required": False, "type": "bool", "default": False},
+    }
+
+    fields.update(CONFIG_ARGS)
+
+    module = AnsibleModule(argument_spec=fields,
+                           supports_check_mode=True)
+
+    mode = 'plan' if module.check_mode else module.params['mode']
+    this_host = gethostname().split('.')[0]
+
+    # the last successful apply recorded the desired state - if nothing has changed since,
+    # the plan would be empty
+    fingerprint = RunFingerprint('igw_reconcile', module.params['gateway_iqn'], module.params,
+                                 ignore=('verify', 'mode'),
+                                 pool=module.params['config_pool'], cfg_name=module.params['config_name'])
+    if not verify_requested(module.params['verify']) and fingerprint.matches():
+        logger.info("SKIP  - Reconcile ({}) - desired state unchanged since the last apply".format(mode))
+        module.exit_json(changed=False, plan=[],
+                         meta={"msg": "Reconcile ({}) skipped - desired state unchanged".format(mode)})
+
+    logger.info("START - Reconcile started in mode {}".format(mode))
+    start = time.time()
+
+    request = {"gateway_iqn": module.params['gateway_iqn'],
+               "rbd_devices": module.params['rbd_devices'],
+               "client_connections": module.params['client_connections'],
+               "mode": mode,
+               "this_host": this_host}
+
+    # use the gateway agent's session and snapshots when it's running for this gateway group
+    agent = find_agent(module.params['config_pool'], module.params['config_name'])
+    try:
+        if agent is None:
+            raise AgentUnavailable("no agent serving {}/{}".format(module.params['config_pool'],
+                                                                    module.params['config_name']))
+        result = agent.request('reconcile', timeout=RECONCILE_TIMEOUT, **request)
+        logger.debug("(main) reconcile performed by the gateway agent")
+    except AgentUnavailable:
+        result = reconcile_local(request, module.params['config_pool'], module.params['config_name'])
+    except RuntimeError as err:
+        module.fail_json(msg="gateway agent reconcile request failed - {}".format(err))
+
+    if result['error']:
+        module.fail_json(msg=result['error'], plan=result['plan'], timings=result['timings'])
+
+    if mode == 'apply':
+        fingerprint.save()
+
+    result['timings']['total'] = time.time() - start
+    logger.info("END   - Reconcile complete - {} steps planned, {} applied "
+                "({:.3f}s)".format(len(result['plan']), result['changes'], result['timings']['total']))
+
+    module.exit_json(changed=result['changes'] > 0,
+                     plan=result['plan'],
+                     timings=result['timings'],
+                     meta={"msg": "Reconcile ({}) complete - {} steps".format(mode, len(result['plan']))})
+
+
+if __name__ == '__main__':
+
+    module_name = os.path.basename(__file__).replace('ansible_module_', '')
+    logger = logging.getLogger(os.path.basename(module_name))
+    logger.setLevel(logging.DEBUG)
+    handler = RotatingFileHandler('/var/log/ansible-module-igw_config.log',
+                                  maxBytes=5242880,
+                                  backupCount=7)
+    log_fmt = logging.Formatter('%(asctime)s %(name)s %(levelname)-8s : %(message)s')
+    handler.setFormatter(log_fmt)
+    logger.addHandler(handler)
+
+    run_main(main, module_name)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+__author__ = 'pcuzner@redhat.com'
+
+import logging
+import os
+
+from logging.handlers import RotatingFileHandler
+from ansible.module_utils.basic import AnsibleModule
+
+from ceph_iscsi_gw import krbd, tuning
+from ceph_iscsi_gw.common import Config, CONFIG_ARGS
+from ceph_iscsi_gw.profiling import run_main
+
+
+def rbd_devices(config):
+    """
+    :param config: Config object
+    :return: list of the device paths of the gateway's disks mapped on this host
+    """
+
+    disks = config.config['disks']
+    return sorted(device for (pool, image), device in krbd.mapped_devices().items()
+                  if image in disks and disks[image].get('pool', 'rbd') == pool)
+
+
+def main():
+    # Tunes the gateway host for the iSCSI data path - the portal interfaces (MTU, irq and
+    # rps cpus), TCP sysctls, and the queues of the mapped rbd devices. In check mode the
+    # differences from the profile are reported, without changing anything
+    fields = {
+        "iscsi_network": {"required": True, "type": "list"},
+        "profile": {"required": False, "type": "str", "default": "default"},
+        "profile_settings": {"required": False, "type": "dict"}
+    }
+
+    fields.update(CONFIG_ARGS)
+
+    module = AnsibleModule(argument_spec=fields,
+                           supports_check_mode=True)
+
+    profile_name = module.params['profile']
+    iscsi_networks = [network.strip() for network in module.params['iscsi_network'] if network.strip()]
+
+    # settings given in the playbook define (or redefine) the profile
+    profile = module.params['profile_settings']
+    if profile is None:
+        profile = tuning.HOST_PROFILES.get(profile_name)
+        if profile is None:
+            module.fail_json(msg="host profile '{}' is not defined - built-in profiles are "
+                                 "{}".format(profile_name, sorted(tuning.HOST_PROFILES)))
+
+    problems = tuning.invalid_settings(profile)
+    if problems:
+        module.fail_json(msg="host profile '{}' is invalid - {}".format(profile_name, '; '.join(problems)))
+
+    interfaces = tuning.portal_interfaces(iscsi_networks)
+    missing = [network for network in interfaces if not interfaces[network]]
+    if missing:
+        module.fail_json(msg="Unable to find an interface on this host for iscsi_network {}".format(missing))
+
+    logger.info("START - host tuning ({}) with profile '{}'".format('check' if module.check_mode else 'apply',
+                                                                    profile_name))
+
+    config = Config(logger, cfg_name=module.params['config_name'], pool=module.params['config_pool'])
+    if config.error:
+        module.fail_json(msg=config.error_msg)
+    devices = rbd_devices(config)
+
+    differences = tuning.plan(profile, sorted(set(interfaces.values())), devices)
+    for diff in differences:
+        logger.info("(main) {} is {}, profile '{}' wants {}".format(diff['setting'], diff['current'],
+                                                                   profile_name, diff['desired']))
+
+    report = [dict((key, diff[key]) for key in ['setting', 'current', 'desired']) for diff in differences]
+
+    if module.check_mode:
+        module.exit_json(changed=bool(differences), differences=report,
+                         meta={"msg": "{} settings differ from profile '{}'".format(len(differences), profile_name)})
+
+    changed, failed = tuning.apply(differences)
+    for setting in failed:
+        logger.warning("(main) {} could not be set - {}".format(setting, failed[setting]))
+
+    logger.info("END   - host tuning complete - {} changed, {} failed".format(len(changed), len(failed)))
+
+    # tuning is best effort (not every nic or device supports every setting), so settings that
+    # couldn't be applied are reported without failing the task. NB. 'failed' is reserved by
+    # ansible for the task result
+    module.exit_json(changed=bool(changed), differences=report, failures=failed,
+                     meta={"msg": "{} settings changed to match profile '{}' on {} interfaces and {} "
+                                  "devices, {} could not be set".format(len(changed), profile_name,
+                                                                        len(set(interfaces.values())),
+                                                                        len(devices), len(failed))})
+
+
+if __name__ == '__main__':
+
+    module_name = os.path.basename(__file__).replace('ansible_module_', '')
+    logger = logging.getLogger(os.path.basename(module_name))
+    logger.setLevel(logging.DEBUG)
+    handler = RotatingFileHandler('/var/log/ansible-module-igw_config.log',
+                                  maxBytes=5242880,
+                                  backupCount=7)
+    log_fmt = logging.Formatter('%(asctime)s %(name)s %(levelname)-8s : %(message)s')
+    handler.setFormatter(log_fmt)
+    logger.addHandler(handler)
+
+    run_main(main, module_name)
@@ -3,11 +3,104 @@
 __author__ = 'pcuzner@redhat.com'
 
 import logging
+import os
+import time
 
+from socket import gethostname
 from logging.handlers import RotatingFileHandler
-from ansible.module_utils.basic import *
-from rtslib_fb.root import root
-from ceph_iscsi_gw import Config
+from ansible.module_utils.basic import AnsibleModule
+
+from ceph_iscsi_gw import alua
+from ceph_iscsi_gw.common import Config, CONFIG_ARGS
+from ceph_iscsi_gw.lio import LIOSnapshot
+from ceph_iscsi_gw.placement import PlacementError, gateway_nodes, rebalance_owners
+from ceph_iscsi_gw.profiling import run_main
+
+# LUNs switched concurrently in each batch of ALUA transitions
+BATCH_SIZE = 32
+
+
+def prepare(config):
+    """
+    Redistribute the disk owners across the live gateways, in a single commit
+    :param config: Config object
+    :return: (dict of moves {image: new owner}, error message (str))
+    """
+
+    config.lock()
+    if config.error:
+        return {}, config.error_msg
+    config.refresh()
+
+    try:
+        moves = rebalance_owners(config.config, live=config.live_gateways())
+    except PlacementError as err:
+        config.unlock()
+        return {}, str(err)
+
+    for image in sorted(moves):
+        disk_attr = config.config['disks'][image]
+        logger.info("(prepare) moving the active path for {} from {} to {}".format(image,
+                                                                                  disk_attr.get('owner'),
+                                                                                  moves[image]))
+        disk_attr['owner'] = moves[image]
+        config.update_item('disks', image, disk_attr)
+
+    # active_luns is recounted from the disks, so any drift in the counts is corrected too
+    gateways = gateway_nodes(config.config['gateways'])
+    for gw_name in sorted(gateways):
+        active_luns = len([image for image in config.config['disks']
+                           if config.config['disks'][image].get('owner') == gw_name])
+        if gateways[gw_name].get('active_luns') != active_luns:
+            gateways[gw_name]['active_luns'] = active_luns
+            config.update_item('gateways', gw_name, gateways[gw_name])
+
+    if config.changed:
+        config.commit('retain')
+    else:
+        config.unlock()
+
+    return moves, config.error_msg if config.error else ''
+
+
+def commit(config, this_host, transitions='all', batch_size=BATCH_SIZE):
+    """
+    Bring the ALUA state of every LUN on this gateway in line with the disk owners. The
+    current state of all the LUNs is read once, and only the LUNs that differ are changed
+    :param config: Config object
+    :param this_host: this gateway's hostname
+    :param transitions: 'active' or 'standby' to apply only those transitions (so the
+                        gateways can activate their new LUNs before any old owner steps
+                        down), or 'all'
+    :param batch_size: LUNs switched at a time
+    :return: dict - transitions applied, failures and timings
+    """
+
+    timings = {}
+
+    start = time.time()
+    lio = LIOSnapshot()
+    luns = dict((image, lio.storage_objects[image]) for image in config.config['disks']
+                if image in lio.storage_objects)
+    current = alua.snapshot_alua(luns)
+    timings['snapshot'] = time.time() - start
+
+    desired = dict((image, 'active' if config.config['disks'][image].get('owner') == this_host
+                    else 'standby') for image in luns)
+    if transitions != 'all':
+        desired = dict((image, state) for image, state in desired.items() if state == transitions)
+
+    plan = alua.plan_alua(current, desired)
+
+    start = time.time()
+    batch_timings, failed = alua.apply_alua(luns, plan, current, batch_size=batch_size)
+    timings['switch'] = time.time() - start
+    timings['batches'] = [round(secs, 3) for secs in batch_timings]
+
+    return {"active": [image for image, state in plan if state == 'active' and image not in failed],
+            "standby": [image for image, state in plan if state == 'standby' and image not in failed],
+            "failed": failed,
+            "timings": timings}
 
 
 def main():
@@ -15,42 +108,77 @@ def main():
     fields = {
         "mode": {
             "required": True,
-            "default": "prepare",
             "choices": ["prepare", "commit"],
             "type": "str"
             },
-        "host": {"required": False, "type": "str"}
+        "host": {"required": False, "type": "str"},
+        "transitions": {
+            "required": False,
+            "default": "all",
+            "choices": ["all", "active", "standby"],
+            "type": "str"
+            },
+        "batch_size": {"required": False, "type": "int", "default": BATCH_SIZE}
         }
+    fields.update(CONFIG_ARGS)
 
-    config = Config()
+    module = AnsibleModule(argument_spec=fields,
+                           supports_check_mode=False)
+
+    mode = module.params['mode']
+    this_host = gethostname().split('.')[0]
+
+    if mode == 'prepare':
+        if not module.params['host']:
+            module.fail_json(msg="Rebalance prepare needs the host parameter, naming the gateway to run it")
+
+        # the owners are only changed by one gateway
+        if module.params['host'] != this_host:
+            module.exit_json(changed=False,
+                             meta={"msg": "Rebalance prepare runs on {} - skipped".format(module.params['host'])})
+
+    if module.params['batch_size'] < 1:
+        module.fail_json(msg="batch_size must be at least 1")
+
+    logger.info("START - Rebalance ({}) started".format(mode))
+    start = time.time()
+
+    config = Config(logger, cfg_name=module.params['config_name'], pool=module.params['config_pool'])
     if config.error:
-        pass
+        module.fail_json(msg=config.error_msg)
+
+    if mode == 'prepare':
+        moves, error_msg = prepare(config)
+        if config.ceph:
+            config.ceph.shutdown()
+        if error_msg:
+            module.fail_json(msg=error_msg)
 
+        logger.info("END   - Rebalance (prepare) complete - {} LUNs moved".format(len(moves)))
+        module.exit_json(changed=len(moves) > 0 or config.changed,
+                         moves=moves,
+                         meta={"msg": "{} LUN(s) assigned to new owners".format(len(moves))})
 
-    # change count = 0
-    # if mode is prepare and host is null
-    #   error - can't run a prepare without a host parameter
+    result = commit(config, this_host, transitions=module.params['transitions'],
+                    batch_size=module.params['batch_size'])
+    if config.ceph:
+        config.ceph.shutdown()
 
-    # if mode is prepare
-    #   if host is this host
-    #       lock the config .... NEED A LOCK / UNLOCK METHOD
-    #       rebalance the disks .. FUNCTION
-    #       writefull from the new config dict
-    #       unlock the config
-    #   else
-    #       set msg = nothing to do, skipping
+    result['timings']['total'] = round(time.time() - start, 3)
+    result['timings']['snapshot'] = round(result['timings']['snapshot'], 3)
+    result['timings']['switch'] = round(result['timings']['switch'], 3)
+    changes = len(result['active']) + len(result['standby'])
 
-    # else if mode is commit
-    #   process the disks
-    #       if the disk has an owner = this host
-    #           set preferred on this LUN
-    #           increment change count
-    #       else skip this disk
-    #   msg = X configuration changes made
+    if result['failed']:
+        module.fail_json(msg="Unable to set the alua state of {}".format(','.join(sorted(result['failed']))),
+                         **result)
 
-    # closing message
+    logger.info("END   - Rebalance (commit) complete - {} ALUA transitions "
+                "({:.3f}s switch)".format(changes, result['timings']['switch']))
 
-    pass
+    module.exit_json(changed=changes > 0,
+                     meta={"msg": "{} ALUA transition(s) made".format(changes)},
+                     **result)
 
 
 if __name__ == "__main__":
@@ -65,4 +193,4 @@ if __name__ == "__main__":
     handler.setFormatter(log_fmt)
     logger.addHandler(handler)
 
-    main()
+    run_main(main, module_name)
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+"""
+Config commit throughput against the number of gateway groups.
+
+Each group has its own config object (config_name group<N>.conf), with a number of writer
+processes (simulated gateways) committing to it concurrently through ceph_iscsi_gw.Config.
+Groups share nothing, so total commits/s should grow with the number of groups, while the
+writers within a group serialise on its lock. After each run the config objects are checked
+for lost updates and for entries leaking between groups.
+
+The 'cluster' is tools/fake_rados.py, with --latency-ms added to every rados operation.
+
+usage: bench_config_groups.py [--groups 1,2,4,8] [--writers 4] [--commits 10] [--latency-ms 1]
+                              [--timeout 600]
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(TOOLS_DIR), 'common'))
+sys.path.insert(0, TOOLS_DIR)
+
+import fake_rados
+
+
+def prepare_config_module(base_dir, latency_ms):
+    """
+    Point ceph_iscsi_gw at the fake cluster, in the current process
+    :return: ceph_iscsi_gw.common module
+    """
+
+    fake_rados.install(base_dir)
+    fake_rados.set_latency(latency_ms)
+
+    from ceph_iscsi_gw import common
+
+    common.CACHE_DIR = os.path.join(base_dir, 'cache')
+    common.Config._platform = 'rbd'
+    return common
+
+
+def writer(base_dir, latency_ms, cfg_name, writer_name, commits, results):
+
+    common = prepare_config_module(base_dir, latency_ms)
+    logger = logging.getLogger(writer_name)
+    logger.addHandler(logging.NullHandler())
+
+    config = common.Config(logger, cfg_name=cfg_name, use_agent=False)
+    errors = 0
+    commit_times = []
+    for seq in range(1, commits + 1):
+        config.update_item('clients', writer_name, {"commits": seq})
+        start = time.time()
+        config.commit('retain')
+        commit_times.append(time.time() - start)
+        if config.error:
+            errors += 1
+            config.error = False
+            config.error_msg = ''
+
+    config.ceph.shutdown()
+    results.put({"writer": writer_name, "errors": errors, "commit_times": commit_times})
+
+
+def collect(procs, results, timeout):
+    """
+    Gather the writers' reports - a writer that dies, or is still running at the timeout,
+    never reports, so it's counted as failed instead of waited on forever
+    :param procs: list of writer processes
+    :param results: queue the writers report to
+    :param timeout: seconds to wait for all the writers
+    :return: (list of reports, number of writers that failed)
+    """
+
+    reports = []
+    deadline = time.time() + timeout
+    while len(reports) < len(procs) and time.time() < deadline:
+        try:
+            reports.append(results.get(timeout=1))
+        except queue.Empty:
+            # an exited writer has already flushed its report, so once they have all exited
+            # there is nothing more to come
+            if all(proc.exitcode is not None for proc in procs):
+                break
+
+    for proc in procs:
+        if proc.is_alive():
+            proc.terminate()
+        proc.join()
+
+    return reports, len(procs) - len(reports)
+
+
+def run(groups, writers, commits, latency_ms, timeout):
+    """
+    Run one round of concurrent commits
+    :return: dict of results
+    """
+
+    base_dir = tempfile.mkdtemp(prefix='igw-bench-')
+    try:
+        fake_rados.install(base_dir)
+        fake_rados.Rados().create_pool('rbd')
+
+        results = multiprocessing.Queue()
+        procs = []
+        for group in range(groups):
+            for writer_num in range(writers):
+                procs.append(multiprocessing.Process(target=writer,
+                                                     args=(base_dir, latency_ms,
+                                                           'group{}.conf'.format(group),
+                                                           'g{}-w{}'.format(group, writer_num),
+                                                           commits, results)))
+
+        start = time.time()
+        for proc in procs:
+            proc.start()
+        reports, failed_writers = collect(procs, results, timeout)
+        elapsed = time.time() - start
+
+        # every writer's last commit must be visible, and only in its own group's config
+        lost = 0
+        leaked = 0
+        ioctx = fake_rados.Rados().open_ioctx('rbd')
+        for group in range(groups):
+            cfg_name = 'group{}.conf'.format(group)
+            size, _ = ioctx.stat(cfg_name)
+            clients = json.loads(ioctx.read(cfg_name, size))['clients']
+            for writer_num in range(writers):
+                if clients.get('g{}-w{}'.format(group, writer_num), {}).get('commits') != commits:
+                    lost += 1
+            leaked += len([name for name in clients if not name.startswith('g{}-'.format(group))])
+
+        commit_times = sorted(t for report in reports for t in report['commit_times'])
+        total = len(commit_times)
+        return {"groups": groups,
+                "writers": groups * writers,
+                "failed_writers": failed_writers,
+                "commits": total,
+                "errors": sum(report['errors'] for report in reports),
+                "elapsed": elapsed,
+                "commits_per_sec": total / elapsed,
+                "p50_ms": commit_times[total // 2] * 1000 if total else 0,
+                "max_ms": commit_times[-1] * 1000 if total else 0,
+                "lost_updates": lost,
+                "leaked_entries": leaked}
+    finally:
+        shutil.rmtree(base_dir, ignore_errors=True)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="config commit throughput by gateway group count")
+    parser.add_argument('--groups', default='1,2,4,8', help="comma separated group counts to run")
+    parser.add_argument('--writers', type=int, default=4, help="writers (gateways) per group")
+    parser.add_argument('--commits', type=int, default=10, help="commits per writer")
+    parser.add_argument('--latency-ms', type=float, default=1.0, help="added latency per rados operation")
+    parser.add_argument('--timeout', type=float, default=600,
+                        help="seconds to wait for each round's writers - unfinished writers are failed")
+    parser.add_argument('--json', action='store_true', help="print the results as json")
+    args = parser.parse_args()
+
+    rows = []
+    for groups in [int(count) for count in args.groups.split(',')]:
+        rows.append(run(groups, args.writers, args.commits, args.latency_ms, args.timeout))
+        if not args.json:
+            row = rows[-1]
+            print("groups {groups:>3}  writers {writers:>3}  commits {commits:>5}  {elapsed:7.2f}s  "
+                  "{commits_per_sec:7.2f} commits/s  p50 {p50_ms:8.1f}ms  max {max_ms:8.1f}ms  "
+                  "errors {errors}  lost {lost_updates}  leaked {leaked_entries}  "
+                  "failed writers {failed_writers}".format(**row))
+
+    if args.json:
+        print(json.dumps(rows, indent=2))
+
+    sys.exit(1 if any(row['lost_updates'] or row['leaked_entries'] or row['failed_writers']
+                      for row in rows) else 0)
+
+
+if __name__ == '__main__':
+
+    main()
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+"""
+Check that large config objects are read and committed intact.
+
+A read of an object without a length returns only its first 8KB, so Config reads the
+config object by size, in chunks (ceph_iscsi_gw.common.read_object). For each size, a
+config of about that many bytes is committed through Config, then read back by a fresh
+Config and compared - and a further commit must keep every entry and bump the epoch. The
+reads use a small chunk size (--chunk-kb), so the larger configs span several chunks.
+
+Finally a reader races a writer that keeps replacing the object with configs of different
+sizes; every read must return one complete config, never a mix of two.
+
+The 'cluster' is tools/fake_rados.py, which truncates reads as librados does.
+
+usage: check_config_size.py [--sizes-kb 4,64,1024,4096,16384] [--chunk-kb 256]
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(TOOLS_DIR), 'common'))
+sys.path.insert(0, TOOLS_DIR)
+
+import fake_rados
+from bench_config_groups import prepare_config_module
+
+ENTRY_PAD = 'x' * 200
+
+
+def build_disks(size):
+    """
+    :param size: approximate size of the config object (bytes)
+    :return: dict of disk entries
+    """
+
+    count = max(1, size // (len(ENTRY_PAD) + 100))
+    return dict(('rbd.disk{:07d}'.format(num), {"owner": "gw{}".format(num % 4),
+                                                 "pad": ENTRY_PAD})
+                for num in range(count))
+
+
+def check_size(common, logger, size):
+    """
+    Commit a config of the given size, read it back and commit to it again
+    :return: dict of results
+    """
+
+    cfg_name = 'size{}.conf'.format(size)
+    disks = build_disks(size)
+
+    config = common.Config(logger, cfg_name=cfg_name, use_agent=False)
+    for image in disks:
+        config.add_item('disks', image, disks[image])
+    config.commit('close')
+    problems = [config.error_msg] if config.error else []
+
+    start = time.time()
+    config = common.Config(logger, cfg_name=cfg_name, use_agent=False)
+    read_secs = time.time() - start
+    if config.config.get('disks') != disks:
+        problems.append("config read back does not match the config committed")
+
+    epoch = config.config.get('epoch')
+    config.add_item('clients', 'iqn.1994-05.com.redhat:client', {"image_list": sorted(disks)[:2]})
+    config.commit('retain')
+    config.refresh()
+    if config.config.get('disks') != disks or 'iqn.1994-05.com.redhat:client' not in config.config['clients']:
+        problems.append("config entries lost by a commit")
+    if config.config.get('epoch') != epoch + 1:
+        problems.append("epoch {} after commit, expected {}".format(config.config.get('epoch'), epoch + 1))
+    config.ceph.shutdown()
+
+    ioctx = fake_rados.Rados().open_ioctx('rbd')
+    obj_size, _ = ioctx.stat(cfg_name)
+    return {"size": obj_size, "disks": len(disks), "read_secs": read_secs, "problems": problems}
+
+
+def rewrite(base_dir, payloads, started, stop):
+
+    fake_rados.install(base_dir)
+    ioctx = fake_rados.Rados().open_ioctx('rbd')
+    num = 0
+    while not stop.is_set():
+        ioctx.write_full('race.conf', payloads[num % len(payloads)])
+        started.set()
+        num += 1
+
+
+def check_race(common, base_dir, reads):
+    """
+    Read an object while another process keeps replacing it
+    :return: list of problems
+    """
+
+    payloads = [json.dumps({"disks": build_disks(size), "epoch": size}).encode('utf-8')
+                for size in (10 * 1024, 300 * 1024, 1024 * 1024)]
+    ioctx = fake_rados.Rados().open_ioctx('rbd')
+    ioctx.write_full('race.conf', payloads[0])
+
+    started = multiprocessing.Event()
+    stop = multiprocessing.Event()
+    proc = multiprocessing.Process(target=rewrite, args=(base_dir, payloads, started, stop))
+    proc.start()
+    started.wait(10)
+
+    problems = []
+    try:
+        for _ in range(reads):
+            try:
+                data = common.read_object(ioctx, 'race.conf')
+            except fake_rados.Error:
+                # the object kept changing - a clean failure, not a torn read
+                continue
+            if data not in payloads:
+                problems.append("torn read of {} bytes".format(len(data)))
+    finally:
+        stop.set()
+        proc.join()
+
+    return problems
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="large config object read/commit check")
+    parser.add_argument('--sizes-kb', default='4,64,1024,4096,16384',
+                        help="comma separated config sizes to check (KB)")
+    parser.add_argument('--chunk-kb', type=int, default=256, help="read chunk size (KB)")
+    parser.add_argument('--race-reads', type=int, default=2000,
+                        help="reads made while the object is being rewritten")
+    args = parser.parse_args()
+
+    base_dir = tempfile.mkdtemp(prefix='igw-size-')
+    failed = False
+    try:
+        common = prepare_config_module(base_dir, 0)
+        fake_rados.Rados().create_pool('rbd')
+        common.CONFIG_READ_CHUNK = args.chunk_kb * 1024
+
+        logger = logging.getLogger('check_config_size')
+        logger.addHandler(logging.NullHandler())
+
+        for size_kb in [int(size) for size in args.sizes_kb.split(',')]:
+            result = check_size(common, logger, size_kb * 1024)
+            print("config {size:>10} bytes  {disks:>6} disks  read {read_secs:6.3f}s  "
+                  "{status}".format(status='; '.join(result['problems']) or 'ok', **result))
+            failed = failed or bool(result['problems'])
+
+        problems = check_race(common, base_dir, args.race_reads)
+        print("read while rewritten ({} reads)  {}".format(args.race_reads, '; '.join(problems) or 'ok'))
+        failed = failed or bool(problems)
+    finally:
+        shutil.rmtree(base_dir, ignore_errors=True)
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+
+    main()
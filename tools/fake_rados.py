@@ -0,0 +1,451 @@
+#!/usr/bin/env python
+"""
+File backed stand-in for the python-rados bindings, for the benchmark and test harnesses in
+tools/ - NOT for use on a gateway.
+
+Objects are files under FAKE_RADOS_DIR/<pool>/, so separate processes (simulated gateways)
+share the same 'cluster'. The parts of the API used by ceph_iscsi_gw are covered, with the
+semantics that matter to it;
+  - read() returns at most 'length' bytes (8192 by default, as librados does)
+  - write_full() replaces an object atomically
+  - every write bumps the object's version; get_last_version() returns the version seen by
+    the ioctx's last read or write, and a WriteOpCtx with assert_version() fails with
+    OutOfRange if the object has been written since
+  - lock_exclusive() is held per Rados instance (client) and cookie, and raises ObjectBusy
+    while another client holds it. A lock without a duration outlives its holder - as it
+    does in RADOS - until break_lock() is called
+  - xattrs are kept in a sidecar file, and set_xattr creates the object if needed
+  - notify() bumps a counter in a sidecar file, and watch() calls its callback (in a thread
+    of the watching process) when the counter changes
+
+A harness installs the module in place of rados with install(), and can slow every
+operation down with set_latency() to model the network round trip to the OSDs. For fault
+injection, drop_notifies() makes this process's notify() calls report success without
+reaching the watchers (e.g. a watch that has silently lapsed).
+"""
+
+import errno
+import fcntl
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+
+FAKE_RADOS_DIR = os.environ.get('FAKE_RADOS_DIR', '/tmp/fake_rados')
+
+# seconds added to every operation (see set_latency)
+LATENCY = float(os.environ.get('FAKE_RADOS_LATENCY_MS', '0')) / 1000
+
+_client_ids = itertools.count(1)
+_client_lock = threading.Lock()
+
+
+class Error(Exception):
+    pass
+
+
+class ObjectNotFound(Error):
+    pass
+
+
+class ObjectExists(Error):
+    pass
+
+
+class ObjectBusy(Error):
+    pass
+
+
+class TimedOut(Error):
+    pass
+
+
+class OutOfRange(Error):
+    pass
+
+
+def install(base_dir=None):
+    """
+    Make 'import rados' (including the lazy imports in ceph_iscsi_gw) resolve to this module
+    :param base_dir: directory holding the fake cluster's pools
+    """
+
+    global FAKE_RADOS_DIR
+    if base_dir:
+        FAKE_RADOS_DIR = base_dir
+        os.environ['FAKE_RADOS_DIR'] = base_dir
+    sys.modules['rados'] = sys.modules[__name__]
+
+
+def set_latency(ms):
+    global LATENCY
+    LATENCY = ms / 1000.0
+
+
+# notify() calls made by this process are lost (see drop_notifies)
+DROP_NOTIFY = False
+
+# seconds between checks of a watched object's notify counter
+WATCH_CHECK_INTERVAL = 0.005
+
+
+def drop_notifies(drop=True):
+    global DROP_NOTIFY
+    DROP_NOTIFY = drop
+
+
+def _to_bytes(data):
+    # librados takes str (python 2) or bytes - the objects are stored as bytes
+    return data if isinstance(data, bytes) else data.encode('utf-8')
+
+
+def _delay():
+    if LATENCY:
+        time.sleep(LATENCY)
+
+
+class Rados(object):
+
+    def __init__(self, conffile=None, conf=None, **kwargs):
+        with _client_lock:
+            self.client_id = 'client.{}.{}'.format(os.getpid(), next(_client_ids))
+        self.connected = False
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+
+    def connect(self, timeout=0):
+        _delay()
+        self.connected = True
+
+    def shutdown(self):
+        self.connected = False
+
+    def pool_exists(self, pool):
+        return os.path.isdir(os.path.join(FAKE_RADOS_DIR, pool))
+
+    def create_pool(self, pool):
+        path = os.path.join(FAKE_RADOS_DIR, pool)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def open_ioctx(self, pool):
+        _delay()
+        if not self.pool_exists(pool):
+            raise ObjectNotFound("pool {} does not exist".format(pool))
+        return Ioctx(self, pool)
+
+
+class WriteOpCtx(object):
+    """
+    Compound write operation - the subset used for versioned (compare and swap) writes
+    """
+
+    def __init__(self):
+        self.version = None
+        self.data = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def assert_version(self, version):
+        self.version = version
+
+    def write_full(self, data):
+        self.data = data
+
+
+class Watch(object):
+    """
+    Watch on an object - the callback is called as librados does;
+    callback(notify_id, notifier_id, watch_id, data)
+    """
+
+    _watch_ids = itertools.count(1)
+
+    def __init__(self, ioctx, key, callback):
+        self.ioctx = ioctx
+        self.key = key
+        self.callback = callback
+        self.watch_id = next(Watch._watch_ids)
+        self.running = True
+
+        self._thread = threading.Thread(target=self._watch)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _watch(self):
+        seen = self.ioctx._notify_count(self.key)
+        while self.running:
+            time.sleep(WATCH_CHECK_INTERVAL)
+            count = self.ioctx._notify_count(self.key)
+            if count != seen:
+                seen = count
+                self.callback(count, 0, self.watch_id, '')
+
+    def close(self):
+        self.running = False
+
+
+class Ioctx(object):
+
+    def __init__(self, cluster, pool):
+        self.cluster = cluster
+        self.pool = pool
+        self.pool_dir = os.path.join(FAKE_RADOS_DIR, pool)
+        self.last_version = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        pass
+
+    def _path(self, key, suffix=''):
+        return os.path.join(self.pool_dir, key.replace('/', '%2F') + suffix)
+
+    def _guard(self, key):
+        # serialises read-modify-write of an object's lock and xattr files across processes
+        guard = open(self._path(key, '.guard'), 'a')
+        fcntl.flock(guard, fcntl.LOCK_EX)
+        return guard
+
+    def _atomic_write(self, path, data):
+        tmp_file = '{}.{}.{}'.format(path, os.getpid(), threading.current_thread().ident)
+        with open(tmp_file, 'wb') as obj:
+            obj.write(data)
+        os.rename(tmp_file, path)
+
+    def _version(self, key):
+        try:
+            with open(self._path(key, '.version')) as version_file:
+                return int(version_file.read())
+        except (IOError, ValueError):
+            return 0
+
+    def _write_object(self, key, data):
+        # caller holds the guard
+        self._atomic_write(self._path(key), _to_bytes(data))
+        self.last_version = self._version(key) + 1
+        self._atomic_write(self._path(key, '.version'), str(self.last_version).encode('utf-8'))
+
+    def _create(self, key):
+        if not os.path.exists(self._path(key)):
+            self._write_object(key, b'')
+
+    # data
+
+    def read(self, key, length=8192, offset=0):
+        _delay()
+        guard = self._guard(key)
+        try:
+            with open(self._path(key), 'rb') as obj:
+                obj.seek(offset)
+                data = obj.read(length)
+            self.last_version = self._version(key)
+            return data
+        except IOError as err:
+            if err.errno == errno.ENOENT:
+                raise ObjectNotFound("object {} not found".format(key))
+            raise
+        finally:
+            guard.close()
+
+    def get_last_version(self):
+        return self.last_version
+
+    def write_full(self, key, data):
+        _delay()
+        guard = self._guard(key)
+        try:
+            self._write_object(key, data)
+        finally:
+            guard.close()
+
+    def write(self, key, data, offset=0):
+        _delay()
+        guard = self._guard(key)
+        try:
+            path = self._path(key)
+            current = open(path, 'rb').read() if os.path.exists(path) else b''
+            current = current.ljust(offset, b'\0')
+            data = _to_bytes(data)
+            self._write_object(key, current[:offset] + data + current[offset + len(data):])
+        finally:
+            guard.close()
+
+    def operate_write_op(self, write_op, key, flags=0):
+        _delay()
+        guard = self._guard(key)
+        try:
+            if write_op.version is not None and self._version(key) != write_op.version:
+                raise OutOfRange("{} is at version {}, not {}".format(key, self._version(key),
+                                                                     write_op.version))
+            if write_op.data is not None:
+                self._write_object(key, write_op.data)
+        finally:
+            guard.close()
+
+    def stat(self, key):
+        _delay()
+        try:
+            info = os.stat(self._path(key))
+        except OSError:
+            raise ObjectNotFound("object {} not found".format(key))
+        return info.st_size, time.localtime(info.st_mtime)
+
+    def remove_object(self, key):
+        _delay()
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            raise ObjectNotFound("object {} not found".format(key))
+        for suffix in ('.version', '.xattr'):
+            if os.path.exists(self._path(key, suffix)):
+                os.remove(self._path(key, suffix))
+        return True
+
+    def _notify_count(self, key):
+        try:
+            with open(self._path(key, '.notify')) as notify_file:
+                return int(notify_file.read())
+        except (IOError, ValueError):
+            return 0
+
+    def notify(self, key, msg='', timeout_ms=5000):
+        _delay()
+        if DROP_NOTIFY:
+            return True
+        guard = self._guard(key)
+        try:
+            self._atomic_write(self._path(key, '.notify'), str(self._notify_count(key) + 1).encode('utf-8'))
+        finally:
+            guard.close()
+        return True
+
+    def watch(self, key, callback, error_callback=None, timeout=None):
+        return Watch(self, key, callback)
+
+    # xattrs
+
+    def _xattrs(self, key):
+        try:
+            with open(self._path(key, '.xattr')) as xattr_file:
+                return json.load(xattr_file)
+        except (IOError, ValueError):
+            return {}
+
+    def set_xattr(self, key, xattr_name, xattr_value):
+        _delay()
+        guard = self._guard(key)
+        try:
+            self._create(key)
+            xattrs = self._xattrs(key)
+            xattrs[xattr_name] = xattr_value
+            self._atomic_write(self._path(key, '.xattr'), json.dumps(xattrs).encode('utf-8'))
+        finally:
+            guard.close()
+        return True
+
+    def get_xattr(self, key, xattr_name):
+        _delay()
+        if not os.path.exists(self._path(key)):
+            raise ObjectNotFound("object {} not found".format(key))
+        xattrs = self._xattrs(key)
+        if xattr_name not in xattrs:
+            raise ObjectNotFound("xattr {} not found on {}".format(xattr_name, key))
+        return xattrs[xattr_name]
+
+    def get_xattrs(self, key):
+        _delay()
+        if not os.path.exists(self._path(key)):
+            raise ObjectNotFound("object {} not found".format(key))
+        return iter(sorted(self._xattrs(key).items()))
+
+    def rm_xattr(self, key, xattr_name):
+        _delay()
+        guard = self._guard(key)
+        try:
+            xattrs = self._xattrs(key)
+            xattrs.pop(xattr_name, None)
+            self._atomic_write(self._path(key, '.xattr'), json.dumps(xattrs).encode('utf-8'))
+        finally:
+            guard.close()
+        return True
+
+    # advisory locks
+
+    def _lock_file(self, key, name):
+        return self._path(key, '.lock.{}'.format(name))
+
+    def _holder(self, key, name):
+        try:
+            with open(self._lock_file(key, name)) as lock_file:
+                holder = json.load(lock_file)
+        except (IOError, ValueError):
+            return None
+
+        if holder.get('expires') and holder['expires'] < time.time():
+            return None
+        return holder
+
+    def lock_exclusive(self, key, name, cookie, desc="", duration=None, flags=0):
+        _delay()
+        guard = self._guard(key)
+        try:
+            holder = self._holder(key, name)
+            if holder and (holder['client'], holder['cookie']) != (self.cluster.client_id, cookie):
+                raise ObjectBusy("{} is locked by {}".format(key, holder['client']))
+            if holder:
+                raise ObjectExists("{} is already locked by this client".format(key))
+
+            self._create(key)
+
+            holder = {"client": self.cluster.client_id,
+                      "cookie": cookie,
+                      "pid": os.getpid(),
+                      "expires": time.time() + duration if duration else None}
+            self._atomic_write(self._lock_file(key, name), json.dumps(holder).encode('utf-8'))
+        finally:
+            guard.close()
+
+    def unlock(self, key, name, cookie):
+        _delay()
+        guard = self._guard(key)
+        try:
+            holder = self._holder(key, name)
+            if not holder or (holder['client'], holder['cookie']) != (self.cluster.client_id, cookie):
+                raise ObjectNotFound("{} is not locked by this client".format(key))
+            os.remove(self._lock_file(key, name))
+        finally:
+            guard.close()
+
+    def list_lockers(self, key, name):
+        holder = self._holder(key, name)
+        lockers = []
+        if holder:
+            lockers.append((holder['client'], holder['cookie'], str(holder['pid'])))
+        return {"tag": '', "exclusive": True, "lockers": lockers}
+
+    def break_lock(self, key, name, client, cookie):
+        _delay()
+        guard = self._guard(key)
+        try:
+            holder = self._holder(key, name)
+            if not holder or (holder['client'], holder['cookie']) != (client, cookie):
+                raise ObjectNotFound("{} is not locked by {}".format(key, client))
+            os.remove(self._lock_file(key, name))
+        finally:
+            guard.close()
@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+"""
+Fault injection for the config object protocol - how long does recovery take, and does
+the operation succeed?
+
+Scenarios;
+  lock-holder-crash  a gateway takes the config lock and dies (SIGKILL) without releasing
+                     it. Recovery is the time a healthy gateway's commit takes
+  slow-holder        a gateway with slow rados I/O (--slow-ms per operation) holds the
+                     lock through its commit, while a healthy gateway commits
+  owner-slow         a disk's owning gateway registers it (wwn and owner) after
+                     --publish-delay seconds; a non-owner waits for the disk's owner, as
+                     igw_lun/the reconciler do before setting the alua state of a new disk.
+                     Recovery is the time from publication to the non-owner seeing it
+  owner-crash        the owning gateway dies before registering the disk - the non-owner
+                     waits until it gives up
+  watch              a gateway agent follows --commits commits made by another gateway.
+                     Recovery is the worst time from a commit to the agent serving it
+  dropped-watch      the same, with the committer's notifies lost - the agent only has
+                     its poll of the config object to fall back on
+
+The limits are those shipped (Config.lock_time_limit, the reconciler's wait for a disk's
+owner and the agent's poll interval) unless overridden, so a run shows today's worst case - a
+scenario that times out reports the full wait.
+
+The 'cluster' is tools/fake_rados.py; each gateway is a separate process.
+
+usage: fault_config_protocol.py [--scenarios lock-holder-crash,...] [--slow-ms 500]
+                                [--lock-time-limit N] [--register-timeout N] [--poll-interval N]
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import time
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(TOOLS_DIR), 'common'))
+sys.path.insert(0, TOOLS_DIR)
+
+import fake_rados
+from bench_config_groups import prepare_config_module
+
+SCENARIOS = ['lock-holder-crash', 'slow-holder', 'owner-slow', 'owner-crash', 'watch', 'dropped-watch']
+
+IMAGE = 'fault-disk'
+
+
+def null_logger(name):
+    logger = logging.getLogger(name)
+    logger.addHandler(logging.NullHandler())
+    return logger
+
+
+def gateway_config(args, name, latency_ms=0):
+    """
+    Config for a simulated gateway, in the current process
+    :return: ceph_iscsi_gw.common.Config object
+    """
+
+    common = prepare_config_module(args.base_dir, latency_ms)
+    if args.lock_time_limit:
+        common.Config.lock_time_limit = args.lock_time_limit
+    return common.Config(null_logger(name), cfg_name=args.cfg_name, use_agent=False)
+
+
+def lock_and_crash(args, locked):
+
+    config = gateway_config(args, 'crashed')
+    config.lock()
+    locked.set()
+    os.kill(os.getpid(), signal.SIGKILL)
+
+
+def slow_commit(args, locked):
+
+    config = gateway_config(args, 'slow', latency_ms=args.slow_ms)
+    config.lock()
+    locked.set()
+    config.update_item('clients', 'slow', {"committed": time.time()})
+    config.commit()
+
+
+def register_disk(args, crash):
+
+    config = gateway_config(args, 'owner')
+    time.sleep(args.publish_delay)
+    if crash:
+        os.kill(os.getpid(), signal.SIGKILL)
+    config.update_item('disks', IMAGE, {"wwn": "fault-wwn", "owner": "owner"})
+    config.commit()
+
+
+def run_agent(args, socket_path):
+
+    prepare_config_module(args.base_dir, 0)
+
+    from ceph_iscsi_gw import agent
+    if args.poll_interval:
+        agent.POLL_INTERVAL = args.poll_interval
+    agent.GatewayAgent(null_logger('agent'), socket_path=socket_path, cfg_name=args.cfg_name).serve()
+
+
+def healthy_commit(args, holder):
+    """
+    Start a lock holder (holder(args, locked)), then time a healthy gateway's commit
+    :return: (ok, seconds, detail)
+    """
+
+    locked = multiprocessing.Event()
+    proc = multiprocessing.Process(target=holder, args=(args, locked))
+    proc.start()
+    locked.wait(30)
+
+    config = gateway_config(args, 'healthy')
+    config.update_item('clients', 'healthy', {"committed": time.time()})
+    start = time.time()
+    config.commit()
+    elapsed = time.time() - start
+    proc.join()
+
+    return not config.error, elapsed, config.error_msg
+
+
+def scenario_lock_holder_crash(args):
+    return healthy_commit(args, lock_and_crash)
+
+
+def scenario_slow_holder(args):
+    return healthy_commit(args, slow_commit)
+
+
+def wait_for_owner(args, crash):
+
+    from ceph_iscsi_gw import reconcile
+    from ceph_iscsi_gw.utils import wait_for
+
+    proc = multiprocessing.Process(target=register_disk, args=(args, crash))
+    start = time.time()
+    proc.start()
+
+    # the wwn is derived by every gateway, so what a non-owner waits for is the disk's owner
+    config = gateway_config(args, 'non-owner')
+    seen = wait_for(lambda: config.get_config()['disks'].get(IMAGE, {}).get('owner'),
+                    args.register_timeout or reconcile.TIME_OUT_SECS, reconcile.LOOP_DELAY)
+    elapsed = time.time() - start
+    proc.join()
+
+    if not seen:
+        return False, elapsed, "gave up waiting for the owner"
+    return True, elapsed - args.publish_delay, "owner seen {:.3f}s after the start".format(elapsed)
+
+
+def scenario_owner_slow(args):
+    return wait_for_owner(args, crash=False)
+
+
+def scenario_owner_crash(args):
+    return wait_for_owner(args, crash=True)
+
+
+def follow_commits(args, drop):
+
+    from ceph_iscsi_gw import agent
+
+    socket_path = os.path.join(args.base_dir, 'agent-{}.sock'.format(os.getpid()))
+    proc = multiprocessing.Process(target=run_agent, args=(args, socket_path))
+    # never outlive the harness, whatever goes wrong
+    proc.daemon = True
+    proc.start()
+
+    timeout = 3 * (args.poll_interval or agent.POLL_INTERVAL)
+    latencies = []
+    missed = 0
+    try:
+        client = agent.AgentClient(socket_path)
+        for _ in range(500):
+            if client.available():
+                break
+            time.sleep(0.01)
+        else:
+            return False, 0.0, "the agent didn't start (exit code {})".format(proc.exitcode)
+
+        config = gateway_config(args, 'committer')
+        if drop:
+            fake_rados.drop_notifies(True)
+
+        for seq in range(args.commits):
+            config.update_item('clients', 'committer', {"seq": seq})
+            config.commit('retain')
+            epoch = config.get_config()['epoch']
+            committed = time.time()
+            while client.request('ping')['epoch'] < epoch:
+                if time.time() - committed > timeout:
+                    missed += 1
+                    break
+                time.sleep(0.005)
+            else:
+                latencies.append(time.time() - committed)
+            time.sleep(args.commit_interval)
+    finally:
+        fake_rados.drop_notifies(False)
+        proc.terminate()
+        proc.join()
+
+    worst = timeout if missed else max(latencies)
+    return (not missed, worst,
+            "{} of {} commits seen (p50 {:.3f}s), {} not seen within {}s".format(
+                len(latencies), args.commits, sorted(latencies)[len(latencies) // 2] if latencies else 0,
+                missed, timeout))
+
+
+def scenario_watch(args):
+    return follow_commits(args, drop=False)
+
+
+def scenario_dropped_watch(args):
+    return follow_commits(args, drop=True)
+
+
+def run(scenario, args):
+    """
+    Run a scenario against a fresh cluster
+    :return: dict of results
+    """
+
+    args.base_dir = tempfile.mkdtemp(prefix='igw-fault-')
+    try:
+        fake_rados.install(args.base_dir)
+        fake_rados.Rados().create_pool('rbd')
+        seed = gateway_config(args, 'seed')
+        seed.ceph.shutdown()
+
+        ok, recovery, detail = globals()['scenario_{}'.format(scenario.replace('-', '_'))](args)
+        return {"scenario": scenario, "ok": ok, "recovery_secs": recovery, "detail": detail}
+    finally:
+        shutil.rmtree(args.base_dir, ignore_errors=True)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="config protocol fault injection")
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help="comma separated scenarios to run ({})".format(','.join(SCENARIOS)))
+    parser.add_argument('--slow-ms', type=float, default=500.0, help="latency per rados operation of a slow gateway")
+    parser.add_argument('--publish-delay', type=float, default=1.0,
+                        help="seconds before the owner registers the disk")
+    parser.add_argument('--commits', type=int, default=3, help="commits followed by the agent")
+    parser.add_argument('--commit-interval', type=float, default=0.3, help="seconds between those commits")
+    parser.add_argument('--lock-time-limit', type=int, help="override Config.lock_time_limit")
+    parser.add_argument('--register-timeout', type=int, help="override the wait for a disk's owner")
+    parser.add_argument('--poll-interval', type=float, help="override the agent's poll interval")
+    parser.add_argument('--max-recovery', type=float,
+                        help="fail (exit 1) if any scenario takes longer than this to recover")
+    parser.add_argument('--json', action='store_true', help="print the results as json")
+    args = parser.parse_args()
+    args.cfg_name = 'gateway.conf'
+
+    scenarios = args.scenarios.split(',')
+    for scenario in scenarios:
+        if scenario not in SCENARIOS:
+            parser.error("unknown scenario '{}'".format(scenario))
+
+    rows = []
+    for scenario in scenarios:
+        rows.append(run(scenario, args))
+        if not args.json:
+            print("{scenario:<18} {status:<7} recovery {recovery_secs:8.3f}s  {detail}".format(
+                status='ok' if rows[-1]['ok'] else 'FAILED', **rows[-1]))
+
+    if args.json:
+        print(json.dumps(rows, indent=2))
+
+    if args.max_recovery is not None:
+        sys.exit(1 if any(not row['ok'] or row['recovery_secs'] > args.max_recovery for row in rows) else 0)
+
+
+if __name__ == '__main__':
+
+    main()
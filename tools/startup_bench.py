@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+"""
+Measure the start up cost of the ceph_iscsi_gw package and the igw_* modules, and check
+it against the budget in startup_budget.json.
+
+Every measurement runs in a fresh interpreter, recording the wall time of the import (or
+first action) and which of the heavy modules (rados, rbd, rtslib_fb, netaddr, netifaces)
+were loaded as a side effect. A target fails when its median time is over max_ms, or when
+it pulls in a module listed in its 'forbid' list.
+
+usage: startup_bench.py [--budget FILE] [--runs N] [--json]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(TOOLS_DIR)
+BUDGET_FILE = os.path.join(TOOLS_DIR, 'startup_budget.json')
+
+HEAVY_MODULES = ['rados', 'rbd', 'rtslib_fb', 'netaddr', 'netifaces']
+
+# code run by the child interpreter for each first action, after the clock starts
+ACTIONS = {
+    "fingerprint_match": ("from ceph_iscsi_gw.fingerprint import RunFingerprint\n"
+                          "RunFingerprint('igw_lun', 'rbd/bench', {'image': 'bench'}).matches()\n"),
+    "get_platform": ("from ceph_iscsi_gw.common import Config\n"
+                     "Config.get_platform()\n")
+}
+
+CHILD = """
+import json, sys, time
+start = time.time()
+try:
+    exec(compile({code!r}, '<bench>', 'exec'))
+except ImportError as err:
+    print(json.dumps({{"skipped": str(err)}}))
+    sys.exit(0)
+elapsed = (time.time() - start) * 1000
+print(json.dumps({{"ms": elapsed,
+                   "loaded": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def measure(code, runs):
+    """
+    Run the code in a new interpreter 'runs' times
+    :param code: python source to time
+    :param runs: number of samples
+    :return: dict - median ms, heavy modules loaded, or the reason it was skipped
+    """
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([os.path.join(REPO_DIR, 'common'),
+                                         os.path.join(REPO_DIR, 'library'),
+                                         env.get('PYTHONPATH', '')])
+    env['PYTHONDONTWRITEBYTECODE'] = '1'
+
+    samples = []
+    loaded = set()
+    for _ in range(runs):
+        child = CHILD.format(code=code, heavy=HEAVY_MODULES)
+        output = subprocess.check_output([sys.executable, '-c', child], env=env)
+        result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+        if 'skipped' in result:
+            return result
+        samples.append(result['ms'])
+        loaded.update(result['loaded'])
+
+    samples.sort()
+    return {"ms": samples[len(samples) // 2], "loaded": sorted(loaded)}
+
+
+def check(name, budget, result):
+    """
+    Compare a measurement with its budget
+    :return: list of problems (empty when within budget)
+    """
+
+    if 'skipped' in result:
+        return []
+
+    problems = []
+    if result['ms'] > budget.get('max_ms', float('inf')):
+        problems.append("{:.1f}ms is over the {}ms budget".format(result['ms'], budget['max_ms']))
+    eager = sorted(set(result['loaded']) & set(budget.get('forbid', [])))
+    if eager:
+        problems.append("imports {} at start up".format(', '.join(eager)))
+    return problems
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="start up time budget check")
+    parser.add_argument('--budget', default=BUDGET_FILE, help="budget file")
+    parser.add_argument('--runs', type=int, help="samples per target (overrides the budget file)")
+    parser.add_argument('--json', action='store_true', help="print the results as json")
+    args = parser.parse_args()
+
+    with open(args.budget) as budget_file:
+        budget = json.load(budget_file)
+    runs = args.runs or budget.get('runs', 5)
+
+    targets = [(name, "import {}\n".format(name), limits)
+               for name, limits in sorted(budget.get('imports', {}).items())]
+    targets += [(name, ACTIONS[name], limits)
+                for name, limits in sorted(budget.get('actions', {}).items())]
+
+    results = {}
+    failed = False
+    for name, code, limits in targets:
+        result = measure(code, runs)
+        result['problems'] = check(name, limits, result)
+        results[name] = result
+        failed = failed or bool(result['problems'])
+
+        if not args.json:
+            if 'skipped' in result:
+                print("{:<28} skipped ({})".format(name, result['skipped']))
+            else:
+                print("{:<28} {:>8.1f}ms  {}".format(name, result['ms'],
+                                                    'FAIL: ' + '; '.join(result['problems'])
+                                                    if result['problems'] else 'ok'))
+
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+
+    main()
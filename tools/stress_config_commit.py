@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+"""
+Concurrent commit stress test for the config object.
+
+A number of writer processes (simulated gateways) race to commit random add, update and
+delete transactions to a single config object through ceph_iscsi_gw.Config. Each writer
+works on its own set of keys and tracks what the config should hold for them, so after
+each run the config object is checked for lost updates - keys missing, stale or wrongly
+present - and for commits missing from the epoch.
+
+The commit strategies compared are;
+  lock        - Config as shipped: exclusive lock, reread, replay the transactions, write.
+                A busy lock is retried every Config.lock_retry_delay (1s)
+  lock-fast   - the same, retrying a busy lock every --retry-ms
+  optimistic  - no lock: read the config and its object version, replay the transactions
+                and write with assert_version, starting again if another writer got in first
+  unlocked    - reread, replay and write without any lock - the control, which shows that
+                lost updates are detected
+
+The 'cluster' is tools/fake_rados.py, with --latency-ms added to every rados operation.
+
+usage: stress_config_commit.py [--strategies lock,lock-fast,optimistic,unlocked]
+                               [--writers 4] [--txns 10] [--keys 5] [--latency-ms 1]
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(TOOLS_DIR), 'common'))
+sys.path.insert(0, TOOLS_DIR)
+
+import fake_rados
+from bench_config_groups import prepare_config_module
+
+STRATEGIES = ['lock', 'lock-fast', 'optimistic', 'unlocked']
+
+CFG_NAME = 'gateway.conf'
+SECTION = 'clients'
+
+
+def config_class(common, strategy):
+    """
+    Build the Config class for a strategy, timing every wait for the config lock
+    :param common: ceph_iscsi_gw.common module
+    :param strategy: commit strategy name
+    :return: Config subclass
+    """
+
+    rados = fake_rados
+
+    class TimedConfig(common.Config):
+
+        def __init__(self, *args, **kwargs):
+            self.lock_waits = []
+            self.conflicts = 0
+            super(TimedConfig, self).__init__(*args, **kwargs)
+
+        def lock(self):
+            start = time.time()
+            super(TimedConfig, self).lock()
+            self.lock_waits.append(time.time() - start)
+
+    class UnlockedConfig(TimedConfig):
+
+        def lock(self):
+            self.config_locked = True
+
+        def unlock(self):
+            self.config_locked = False
+
+    class OptimisticConfig(TimedConfig):
+
+        def _commit_rbd(self, post_action):
+
+            ioctx = self.ceph.cluster.open_ioctx(self.pool)
+            deadline = time.time() + common.Config.lock_time_limit
+
+            while True:
+                current_config = json.loads(common.read_object(ioctx, self.config_name))
+                version = ioctx.get_last_version()
+
+                for txn in self.txn_list:
+                    if txn.action == 'add':
+                        current_config.setdefault(txn.type, {})[txn.item_name] = txn.item_content
+                    else:
+                        del current_config[txn.type][txn.item_name]
+                current_config["epoch"] += 1
+
+                config_str = json.dumps(current_config, sort_keys=True, indent=4, separators=(',', ': '))
+                with rados.WriteOpCtx() as op:
+                    op.assert_version(version)
+                    op.write_full(config_str)
+                    try:
+                        ioctx.operate_write_op(op, self.config_name)
+                        break
+                    except rados.OutOfRange:
+                        # another writer committed since the read - start again
+                        self.conflicts += 1
+
+                if time.time() >= deadline:
+                    self.error = True
+                    self.error_msg = "Timed out retrying the commit to {}".format(self.config_name)
+                    ioctx.close()
+                    return
+
+                time.sleep(random.uniform(0, 0.005))
+
+            del self.txn_list[:]
+            ioctx.close()
+
+            if post_action == 'close':
+                self.ceph.shutdown()
+
+    return {'lock': TimedConfig,
+            'lock-fast': TimedConfig,
+            'optimistic': OptimisticConfig,
+            'unlocked': UnlockedConfig}[strategy]
+
+
+def writer(base_dir, latency_ms, strategy, retry_ms, writer_name, txns, keys, seed, results):
+
+    report = {"writer": writer_name, "expected": {}, "commits": 0, "errors": [],
+              "commit_times": [], "lock_waits": [], "conflicts": 0}
+
+    try:
+        common = prepare_config_module(base_dir, latency_ms)
+        if strategy == 'lock-fast':
+            common.Config.lock_retry_delay = retry_ms / 1000.0
+
+        logger = logging.getLogger(writer_name)
+        logger.addHandler(logging.NullHandler())
+
+        config = config_class(common, strategy)(logger, cfg_name=CFG_NAME, use_agent=False)
+        if config.error:
+            raise RuntimeError(config.error_msg)
+
+        rand = random.Random(seed)
+        expected = report['expected']
+        for seq in range(1, txns + 1):
+            for _ in range(rand.randint(1, 3)):
+                key = '{}-k{}'.format(writer_name, rand.randrange(keys))
+                value = {"writer": writer_name, "seq": seq}
+                if key not in expected:
+                    config.add_item(SECTION, key, value)
+                    expected[key] = value
+                elif rand.random() < 0.5:
+                    config.update_item(SECTION, key, value)
+                    expected[key] = value
+                else:
+                    config.del_item(SECTION, key)
+                    del expected[key]
+
+            start = time.time()
+            config.commit('retain')
+            report['commit_times'].append(time.time() - start)
+            if config.error:
+                # the transactions are still queued, so they go with the next commit
+                report['errors'].append(config.error_msg)
+                config.error = False
+                config.error_msg = ''
+            else:
+                report['commits'] += 1
+
+        report['lock_waits'] = config.lock_waits
+        report['conflicts'] = config.conflicts
+        config.ceph.shutdown()
+
+    except Exception:
+        report['errors'].append(traceback.format_exc())
+
+    results.put(report)
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+def run(strategy, writers, txns, keys, latency_ms, retry_ms, seed):
+    """
+    Run one round of concurrent commits with a given strategy
+    :return: dict of results
+    """
+
+    base_dir = tempfile.mkdtemp(prefix='igw-stress-')
+    try:
+        fake_rados.install(base_dir)
+        cluster = fake_rados.Rados()
+        cluster.create_pool('rbd')
+        ioctx = cluster.open_ioctx('rbd')
+        ioctx.write_full(CFG_NAME, json.dumps({"disks": {}, "gateways": {}, "clients": {},
+                                               "backstore_profiles": {}, "epoch": 0}).encode('utf-8'))
+
+        results = multiprocessing.Queue()
+        procs = [multiprocessing.Process(target=writer,
+                                         args=(base_dir, latency_ms, strategy, retry_ms,
+                                               'w{}'.format(num), txns, keys, seed + num, results))
+                 for num in range(writers)]
+
+        start = time.time()
+        for proc in procs:
+            proc.start()
+        reports = [results.get() for _ in procs]
+        for proc in procs:
+            proc.join()
+        elapsed = time.time() - start
+
+        size, _ = ioctx.stat(CFG_NAME)
+        final = json.loads(ioctx.read(CFG_NAME, size))
+        clients = final.get(SECTION, {})
+
+        # every key a writer touched must hold its last value, or be absent if deleted
+        lost = 0
+        for report in reports:
+            for num in range(keys):
+                key = '{}-k{}'.format(report['writer'], num)
+                if clients.get(key) != report['expected'].get(key):
+                    lost += 1
+
+        commits = sum(report['commits'] for report in reports)
+        commit_times = [t for report in reports for t in report['commit_times']]
+        lock_waits = [t for report in reports for t in report['lock_waits']]
+        errors = [err for report in reports for err in report['errors']]
+
+        return {"strategy": strategy,
+                "writers": writers,
+                "commits": commits,
+                "elapsed": elapsed,
+                "commits_per_sec": commits / elapsed,
+                "commit_p50_ms": percentile(commit_times, 50) * 1000,
+                "commit_max_ms": percentile(commit_times, 100) * 1000,
+                "lock_wait_p50_ms": percentile(lock_waits, 50) * 1000,
+                "lock_wait_p90_ms": percentile(lock_waits, 90) * 1000,
+                "lock_wait_p99_ms": percentile(lock_waits, 99) * 1000,
+                "lock_wait_max_ms": percentile(lock_waits, 100) * 1000,
+                "conflicts": sum(report['conflicts'] for report in reports),
+                "errors": len(errors),
+                "error_detail": errors[:3],
+                "lost_updates": lost,
+                "epoch_drift": commits - final.get('epoch', 0)}
+    finally:
+        shutil.rmtree(base_dir, ignore_errors=True)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="concurrent config commit stress test")
+    parser.add_argument('--strategies', default=','.join(STRATEGIES),
+                        help="comma separated commit strategies to compare ({})".format(','.join(STRATEGIES)))
+    parser.add_argument('--writers', type=int, default=4, help="concurrent writers (gateways)")
+    parser.add_argument('--txns', type=int, default=10, help="transactions committed by each writer")
+    parser.add_argument('--keys', type=int, default=5, help="keys owned by each writer")
+    parser.add_argument('--latency-ms', type=float, default=1.0, help="added latency per rados operation")
+    parser.add_argument('--retry-ms', type=float, default=20.0, help="lock retry delay for lock-fast")
+    parser.add_argument('--seed', type=int, default=1, help="random seed for the transactions")
+    parser.add_argument('--json', action='store_true', help="print the results as json")
+    args = parser.parse_args()
+
+    strategies = args.strategies.split(',')
+    for strategy in strategies:
+        if strategy not in STRATEGIES:
+            parser.error("unknown strategy '{}'".format(strategy))
+
+    rows = []
+    for strategy in strategies:
+        rows.append(run(strategy, args.writers, args.txns, args.keys, args.latency_ms,
+                        args.retry_ms, args.seed))
+        if not args.json:
+            row = rows[-1]
+            print("{strategy:<11} commits {commits:>4}  {elapsed:7.2f}s  {commits_per_sec:7.2f} commits/s  "
+                  "commit p50 {commit_p50_ms:7.1f}ms max {commit_max_ms:7.1f}ms  "
+                  "lock wait p50/p90/p99/max {lock_wait_p50_ms:.1f}/{lock_wait_p90_ms:.1f}/"
+                  "{lock_wait_p99_ms:.1f}/{lock_wait_max_ms:.1f}ms  conflicts {conflicts}  "
+                  "errors {errors}  lost {lost_updates}  epoch drift {epoch_drift}".format(**row))
+            for err in row['error_detail']:
+                print("    {}".format(err.strip().splitlines()[-1]))
+
+    if args.json:
+        print(json.dumps(rows, indent=2))
+
+    # only the unlocked control is allowed to lose updates
+    sys.exit(1 if any(row['lost_updates'] or row['epoch_drift']
+                      for row in rows if row['strategy'] != 'unlocked') else 0)
+
+
+if __name__ == '__main__':
+
+    main()